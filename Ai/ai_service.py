@@ -25,9 +25,8 @@ try:
 except ImportError:
     pass
 
-from qdrant_client import QdrantClient
 from qdrant_client.http import models as rest
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
@@ -35,17 +34,15 @@ from langchain_core.runnables import RunnablePassthrough
 from Others.models import OpeningHours, Booking
 from Accounts.models import Company, Service
 from Finance.helper import create_stripe_checkout_for_service
+from Ai.vector_store import QDRANT_API_KEY, get_qdrant_client, get_collection_name, company_filter
+from Ai.embeddings import get_embedding_provider
 
 # Logging Configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Constants
-#QDRANT_URL = "https://deed639e-bc0e-43fe-8dc2-2edaed834f41.europe-west3-0.gcp.cloud.qdrant.io:6333"
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY") 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-COLLECTION_NAME = "company_knowledge"
 
 class MockRequest:
     """Mock Django Request object for reusing create_booking logic"""
@@ -279,13 +276,14 @@ def get_ai_response(company_id: int, query: str, history: Optional[List[Dict]] =
     if not OPENAI_API_KEY:
         return {"content": "System Error: OpenAI API Key missing.", "token_usage": {}}
         
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=OPENAI_API_KEY)
+    client = get_qdrant_client(timeout=None)
+    collection_name = get_collection_name(company_id)
     llm = ChatOpenAI(model="gpt-4o", openai_api_key=OPENAI_API_KEY, temperature=0.7)
     # llm = ChatOpenAI(model="gpt-5-mini-2025-08-07", openai_api_key=OPENAI_API_KEY, temperature=0.7)
     
     # 2. Embed Query & Search
     try:
+        embeddings = get_embedding_provider(company_id)
         query_vector = embeddings.embed_query(query)
     except Exception as e:
         logger.error(f"Embedding failed: {e}")
@@ -298,24 +296,18 @@ def get_ai_response(company_id: int, query: str, history: Optional[List[Dict]] =
         )
         return {"content": localized_message, "token_usage": {}}
         
-    search_filter = rest.Filter(
-        must=[
-            rest.FieldCondition(key="company_id", match=rest.MatchValue(value=company_id))
-        ]
-    )
+    search_filter = company_filter(company_id)
     
     # 3. Retrieve Mandatory Context (Company Profile)
     # We always want the company profile to be present so the AI knows who it is.
     forced_context = ""
     try:
-        profile_filter = rest.Filter(
-            must=[
-                rest.FieldCondition(key="company_id", match=rest.MatchValue(value=company_id)),
-                rest.FieldCondition(key="source_id", match=rest.MatchValue(value=f"cmp_{company_id}"))
-            ]
+        profile_filter = company_filter(
+            company_id,
+            rest.FieldCondition(key="source_id", match=rest.MatchValue(value=f"cmp_{company_id}"))
         )
         profile_results = client.scroll(
-            collection_name=COLLECTION_NAME,
+            collection_name=collection_name,
             scroll_filter=profile_filter,
             limit=1,
             with_payload=True,
@@ -329,7 +321,7 @@ def get_ai_response(company_id: int, query: str, history: Optional[List[Dict]] =
         logger.error(f"Failed to fetch profile: {e}")
 
     results = client.query_points(
-        collection_name=COLLECTION_NAME,
+        collection_name=collection_name,
         query=query_vector,
         query_filter=search_filter,
         limit=10, # Increased context window for better answers
@@ -744,10 +736,9 @@ def get_ai_response(company_id: int, query: str, history: Optional[List[Dict]] =
             print(f"--------------------------------------------------")
 
             if total > 0:
-                from Finance.models import Subscriptions 
-                sub = Subscriptions.objects.filter(company_id=company_id, active=True).first()
-                if sub:
-                    sub.deduct_tokens(total)
+                from Finance.quota import consume_tokens
+                granted, _ = consume_tokens(company_id, total, mode="force")
+                if granted is not None:
                     print(f"✅ Successfully deducted {total} tokens from subscription for company {company_id}")
                     logger.info(f"Deducted {total} tokens for company {company_id}")
                 else:
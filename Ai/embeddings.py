@@ -0,0 +1,78 @@
+import os
+import logging
+from typing import List, Optional
+
+from django.conf import settings
+from langchain_openai import OpenAIEmbeddings
+
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+class OpenAIEmbeddingProvider:
+    """Hosted embeddings (text-embedding-3-small). One network round-trip per call."""
+    name = "openai"
+    dimension = 1536
+
+    def __init__(self):
+        if not OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY is missing via os.getenv")
+        self.model = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=OPENAI_API_KEY)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+class LocalEmbeddingProvider:
+    """
+    In-process CPU embeddings using an ONNX model through fastembed.
+    No external calls; the model is downloaded once and loaded once per worker process.
+    """
+    name = "local"
+
+    def __init__(self, model_name: Optional[str] = None, batch_size: Optional[int] = None):
+        try:
+            from fastembed import TextEmbedding
+        except ImportError:
+            raise ValueError("The local embedding provider needs the 'fastembed' package installed")
+
+        self.model_name = model_name or settings.LOCAL_EMBEDDING_MODEL
+        self.batch_size = batch_size or settings.LOCAL_EMBEDDING_BATCH_SIZE
+        self.model = TextEmbedding(model_name=self.model_name)
+        self.dimension = self.model.embedding_size
+        logger.info(f"Loaded local embedding model {self.model_name} ({self.dimension} dims)")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self.model.embed(texts, batch_size=self.batch_size)]
+
+    def embed_query(self, text: str) -> List[float]:
+        return next(iter(self.model.query_embed(text))).tolist()
+
+EMBEDDING_PROVIDERS = {
+    OpenAIEmbeddingProvider.name: OpenAIEmbeddingProvider,
+    LocalEmbeddingProvider.name: LocalEmbeddingProvider,
+}
+
+# Providers are expensive to build (HTTP client / model load), keep one per process
+_provider_instances = {}
+
+def get_embedding_provider(company_id: Optional[int] = None, provider_name: Optional[str] = None):
+    """
+    Returns the embedding provider for a company (its override, else settings.EMBEDDING_PROVIDER).
+    Pass `provider_name` to ask for a specific backend.
+    """
+    if not provider_name:
+        if company_id is not None:
+            from Ai.vector_store import get_embedding_provider_name
+            provider_name = get_embedding_provider_name(company_id)
+        else:
+            provider_name = settings.EMBEDDING_PROVIDER
+
+    if provider_name not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"Unknown embedding provider '{provider_name}'. Choices: {', '.join(EMBEDDING_PROVIDERS)}")
+
+    if provider_name not in _provider_instances:
+        _provider_instances[provider_name] = EMBEDDING_PROVIDERS[provider_name]()
+    return _provider_instances[provider_name]
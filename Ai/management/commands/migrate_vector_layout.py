@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from Ai.vector_store import (
+    COLLECTION_NAME, LAYOUT_SHARED, LAYOUT_DEDICATED,
+    get_qdrant_client, dedicated_collection_name, shared_collection_name, get_embedding_provider_name,
+    move_company_to_collection, tune_collection,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move companies between the shared (payload-partitioned) Qdrant collection and "
+        "dedicated per-company collections, or re-apply HNSW/quantisation settings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("company_ids", nargs="*", type=int, help="Companies to move")
+        parser.add_argument(
+            "--to", choices=[LAYOUT_SHARED, LAYOUT_DEDICATED], default=LAYOUT_DEDICATED,
+            help="Target layout for the given companies (default: dedicated)"
+        )
+        parser.add_argument(
+            "--tune", nargs="*", metavar="COLLECTION",
+            help="Apply the configured HNSW/quantisation/on-disk settings and payload indexes to these "
+                 "collections and give older points their tenant id (no names = the shared collection)"
+        )
+
+    def handle(self, *args, **options):
+        company_ids = options["company_ids"]
+        tune = options["tune"]
+        if not company_ids and tune is None:
+            raise CommandError("Pass company ids to move and/or --tune.")
+
+        client = get_qdrant_client()
+
+        for company_id in company_ids:
+            if options["to"] == LAYOUT_SHARED:
+                target = shared_collection_name(get_embedding_provider_name(company_id))
+            else:
+                target = dedicated_collection_name(company_id)
+            moved = move_company_to_collection(client, company_id, target)
+            self.stdout.write(self.style.SUCCESS(f"Company {company_id}: moved {moved} points to {target}"))
+
+        if tune is not None:
+            for collection_name in tune or [COLLECTION_NAME]:
+                tune_collection(client, collection_name)
+                self.stdout.write(self.style.SUCCESS(f"Tuned {collection_name}"))
@@ -0,0 +1,123 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from Accounts.models import Company
+from Ai.models import CompanyVectorLayout, KnowledgeSource
+from Ai.embeddings import EMBEDDING_PROVIDERS
+from Ai.vector_store import (
+    get_qdrant_client, get_company_vector_config, get_layout_cache_key,
+    is_dedicated_collection, company_filter, dedicated_collection_name, shared_collection_name,
+)
+from qdrant_client.http import models as rest
+
+
+class Command(BaseCommand):
+    help = (
+        "Switch companies to another embedding provider and re-embed their knowledge into a "
+        "collection of the matching dimension."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("company_ids", nargs="*", type=int, help="Companies to re-embed")
+        parser.add_argument("--all", action="store_true", help="Re-embed every company")
+        parser.add_argument(
+            "--provider", choices=list(EMBEDDING_PROVIDERS), default=settings.EMBEDDING_PROVIDER,
+            help="Embedding provider to switch to (default: settings.EMBEDDING_PROVIDER)"
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            company_ids = list(Company.objects.values_list("id", flat=True))
+        else:
+            company_ids = options["company_ids"]
+        if not company_ids:
+            raise CommandError("Pass company ids or --all.")
+
+        provider_name = options["provider"]
+        client = get_qdrant_client()
+
+        failures = 0
+        for company_id in company_ids:
+            try:
+                new_collection = self.reembed_company(client, company_id, provider_name)
+            except Exception as e:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f"Company {company_id}: re-embed failed, layout unchanged: {e}"))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f"Company {company_id}: re-embedded with '{provider_name}' into {new_collection}"
+            ))
+
+        if failures:
+            raise CommandError(f"{failures} company(ies) failed to re-embed")
+
+    def reembed_company(self, client, company_id, provider_name):
+        """
+        Embeds the company's knowledge into the target collection while readers keep using
+        the current one, switches the layout once every source made it, then drops the old
+        vectors. On failure the new vectors are dropped and the manifest is restored.
+        """
+        from Ai.rag_ingestion import process_company_knowledge
+
+        old_collection = get_company_vector_config(company_id)["collection_name"]
+        if is_dedicated_collection(old_collection):
+            # A dedicated collection has a fixed dimension: build a new version next to it
+            new_collection = dedicated_collection_name(company_id, version=int(time.time()))
+        else:
+            new_collection = shared_collection_name(provider_name)
+
+        manifest = list(KnowledgeSource.objects.filter(company_id=company_id))
+        if new_collection == old_collection:
+            # Same collection: dropping the manifest makes the sync treat every source as changed
+            KnowledgeSource.objects.filter(company_id=company_id).delete()
+        else:
+            # Leftovers from an earlier stay in that collection must not pass for fresh vectors
+            self.drop_company_vectors(client, company_id, new_collection)
+
+        try:
+            failed_sources = process_company_knowledge(company_id, new_collection, provider_name)
+            if failed_sources:
+                raise CommandError(f"sources failed to embed: {', '.join(sorted(failed_sources))}")
+        except Exception:
+            self.discard_rebuild(client, company_id, old_collection, new_collection, manifest)
+            raise
+
+        CompanyVectorLayout.objects.update_or_create(
+            company_id=company_id,
+            defaults={
+                "collection_name": new_collection if is_dedicated_collection(new_collection) else "",
+                "embedding_provider": "" if provider_name == settings.EMBEDDING_PROVIDER else provider_name,
+            }
+        )
+        cache.delete(get_layout_cache_key(company_id))
+
+        if new_collection != old_collection:
+            self.drop_company_vectors(client, company_id, old_collection)
+        return new_collection
+
+    def discard_rebuild(self, client, company_id, old_collection, new_collection, manifest):
+        if new_collection == old_collection:
+            # Sources re-embedded in place already replaced their old chunks; restore the others
+            rewritten = set(KnowledgeSource.objects.filter(company_id=company_id).values_list("source_id", flat=True))
+            KnowledgeSource.objects.bulk_create([entry for entry in manifest if entry.source_id not in rewritten])
+            return
+        try:
+            self.drop_company_vectors(client, company_id, new_collection)
+        except Exception as e:
+            self.stdout.write(self.style.WARNING(f"Could not drop the partial rebuild in {new_collection}: {e}"))
+        with transaction.atomic():
+            KnowledgeSource.objects.filter(company_id=company_id).delete()
+            KnowledgeSource.objects.bulk_create(manifest)
+
+    def drop_company_vectors(self, client, company_id, collection_name):
+        if not client.collection_exists(collection_name):
+            return
+        if is_dedicated_collection(collection_name):
+            client.delete_collection(collection_name)
+        else:
+            client.delete(
+                collection_name=collection_name,
+                points_selector=rest.FilterSelector(filter=company_filter(company_id))
+            )
@@ -0,0 +1,44 @@
+from django.db import models
+from Accounts.models import Company
+
+# Create your models here.
+
+class KnowledgeSource(models.Model):
+    """
+    Manifest entry for one synced knowledge source (kb_*, af_*, svc_*, ...).
+    Lets consumers fetch a source's chunks by id, in order, without scrolling
+    the whole Qdrant collection.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='knowledge_sources')
+    source_id = models.CharField(max_length=100)
+    source_hash = models.CharField(max_length=64)
+    length = models.IntegerField(default=0)
+    chunk_ids = models.JSONField(default=list)  # Qdrant point ids ordered by chunk_index
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Knowledge Source"
+        verbose_name_plural = "Knowledge Sources"
+        unique_together = ('company', 'source_id')
+
+    def __str__(self):
+        return f"{self.company_id} - {self.source_id} ({len(self.chunk_ids)} chunks)"
+
+
+class CompanyVectorLayout(models.Model):
+    """
+    Per-company vector store settings. Companies without a row (or with blank
+    fields) use the deployment's embedding provider and its shared,
+    payload-partitioned collection.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name='vector_layout')
+    collection_name = models.CharField(max_length=150, blank=True, default='')  # blank = shared collection
+    embedding_provider = models.CharField(max_length=50, blank=True, default='')  # blank = settings.EMBEDDING_PROVIDER
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Company Vector Layout"
+        verbose_name_plural = "Company Vector Layouts"
+
+    def __str__(self):
+        return f"{self.company_id} -> {self.collection_name or 'shared'} ({self.embedding_provider or 'default'})"
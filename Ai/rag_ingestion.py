@@ -1,6 +1,8 @@
 import os
 import sys
+import uuid
 import django
+import hashlib
 import logging
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
@@ -16,13 +18,16 @@ django.setup()
 
 from Others.models import KnowledgeBase, AITrainingFile, Booking, OpeningHours
 from Accounts.models import Company, User, Service
+from Ai.models import KnowledgeSource
 from django.conf import settings
 
 # RAG / ML Imports
 import openai
-from qdrant_client import QdrantClient
 from qdrant_client.http import models as rest
-from langchain_openai import OpenAIEmbeddings
+from Ai.vector_store import (
+    TENANT_FIELD, get_qdrant_client, get_collection_name, ensure_collection_exists, get_tenant_id, iter_company_points,
+)
+from Ai.embeddings import get_embedding_provider
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # File Parsing
@@ -35,26 +40,8 @@ import io
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Constants
-QDRANT_URL = "https://deed639e-bc0e-43fe-8dc2-2edaed834f41.europe-west3-0.gcp.cloud.qdrant.io:6333"
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY") 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") 
-COLLECTION_NAME = "company_knowledge"
-
-# Initialize Clients
-def get_qdrant_client():
-    if not QDRANT_API_KEY:
-        logger.warning("QDRANT_API_KEY is not set. Connection might fail.")
-    return QdrantClient(
-        url=QDRANT_URL, 
-        api_key=QDRANT_API_KEY,
-        timeout=120
-    )
-
-def get_embedding_model():
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY is missing via os.getenv")
-    return OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=OPENAI_API_KEY)
+def get_embedding_model(company_id: Optional[int] = None, provider_name: Optional[str] = None):
+    return get_embedding_provider(company_id, provider_name)
 
 # --- Text Extraction Helpers ---
 
@@ -125,39 +112,23 @@ def get_file_content(file_obj, file_type: str) -> str:
 
 # --- Pipeline Logic ---
 
-def ensure_collection_exists(client: QdrantClient, vector_size: int = 1536):
-    if not client.collection_exists(COLLECTION_NAME):
-        client.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=rest.VectorParams(
-                size=vector_size,
-                distance=rest.Distance.COSINE
-            )
-        )
-        logger.info(f"Created collection {COLLECTION_NAME}")
-        
-    try:
-        client.create_payload_index(
-            collection_name=COLLECTION_NAME,
-            field_name="company_id",
-            field_schema=rest.PayloadSchemaType.INTEGER
-        )
-        client.create_payload_index(
-            collection_name=COLLECTION_NAME,
-            field_name="source_id",
-            field_schema=rest.PayloadSchemaType.KEYWORD
-        )
-    except Exception as e:
-        pass
+def compute_source_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def process_company_knowledge(company_id: int):
+def process_company_knowledge(company_id: int, collection_name: Optional[str] = None,
+                              provider_name: Optional[str] = None) -> List[str]:
+    """
+    Syncs a company's knowledge into its collection (or `collection_name`, embedded with
+    `provider_name`, when rebuilding elsewhere). Returns the source ids that failed to sync.
+    """
     print("Processing company knowledge for company_id: ", company_id)
     logger.info(f"Starting knowledge sync for Company ID: {company_id}")
     
     client = get_qdrant_client()
-    embeddings = get_embedding_model()
+    embeddings = get_embedding_model(company_id, provider_name)
     
-    ensure_collection_exists(client)
+    collection_name = collection_name or get_collection_name(company_id)
+    ensure_collection_exists(client, collection_name, vector_size=embeddings.dimension)
     
     # Map of source_id -> content/metadata
     current_sources = {}
@@ -273,43 +244,53 @@ def process_company_knowledge(company_id: int):
         }
 
     # Fetch Existing IDs from Qdrant
+    # Stream the inventory page by page and only pull the fields the sync needs,
+    # so memory stays bounded and tenants with more than one page are fully covered.
     existing_ids = set()
-    scroll_filter = rest.Filter(
-        must=[
-            rest.FieldCondition(key="company_id", match=rest.MatchValue(value=company_id))
-        ]
-    )
-    
-    points_iterator = client.scroll(
-        collection_name=COLLECTION_NAME,
-        scroll_filter=scroll_filter,
-        with_payload=True,
-        with_vectors=False,
-        limit=10000 
-    )[0]
-    
-    source_to_point_ids = {} 
-    
-    for point in points_iterator:
+    source_to_point_ids = {}
+    source_hashes = {}
+    source_chunk_counts = {}
+
+    for point in iter_company_points(client, company_id, payload_fields=["source_id", "source_hash", "chunk_count"],
+                                     collection_name=collection_name):
         payload = point.payload or {}
         sid = payload.get("source_id")
-        # IGNORE booking points if they still exist (bk_) so we don't accidentally delete them if we want to keep them, 
-        # OR better: if we want to CLEAN them, we should track them. 
-        # The user said "clean_bookings_vectors.py" is unused so maybe we should just ignore them or delete them?
-        # User said "remove unnecessary parts". If 'bk_' data is in DB, it's unnecessary. 
-        # But let's stick to syncing what's in 'current_sources'. 
-        
+        # Legacy booking points (bk_) are not in current_sources, so they end up
+        # in to_delete_source_ids below and get cleaned up.
         if sid:
             if sid not in source_to_point_ids:
                 source_to_point_ids[sid] = []
             source_to_point_ids[sid].append(point.id)
             existing_ids.add(sid)
+            # A source is only considered unchanged if every chunk carries the same hash
+            point_hash = payload.get("source_hash")
+            if source_hashes.get(sid, point_hash) != point_hash:
+                point_hash = None
+            source_hashes[sid] = point_hash
+            source_chunk_counts[sid] = payload.get("chunk_count")
+
+    # A partially written source (e.g. a failed upsert batch) must be re-embedded
+    for sid, point_ids in source_to_point_ids.items():
+        if source_chunk_counts.get(sid) != len(point_ids):
+            source_hashes[sid] = None
+
+    # Sources without a manifest entry predate chunk ordering metadata; re-embed them once
+    manifest_sids = set(
+        KnowledgeSource.objects.filter(company_id=company_id).values_list('source_id', flat=True)
+    )
             
     logger.info(f"Found {len(existing_ids)} existing sources in Vector DB.")
 
     # Sync Logic
     to_delete_source_ids = existing_ids - set(current_sources.keys())
-    to_upsert_source_ids = set(current_sources.keys())
+    # Only re-embed sources whose content changed since the last sync
+    to_upsert_source_ids = {
+        sid for sid, data in current_sources.items()
+        if sid not in manifest_sids
+        or source_hashes.get(sid) is None
+        or source_hashes[sid] != compute_source_hash(data["text"])
+    }
+    logger.info(f"Skipping {len(current_sources) - len(to_upsert_source_ids)} unchanged sources.")
     
     # Force cleanup of any 'bk_' (booking) sources if found in existing_ids
     # This effectively does what clean_bookings_vectors did.
@@ -325,50 +306,68 @@ def process_company_knowledge(company_id: int):
         
         if points_to_delete:
             client.delete(
-                collection_name=COLLECTION_NAME,
+                collection_name=collection_name,
                 points_selector=rest.PointIdsList(points=points_to_delete)
             )
 
+    KnowledgeSource.objects.filter(company_id=company_id).exclude(
+        source_id__in=list(current_sources.keys())
+    ).delete()
+
     # Upsert
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=700,
         chunk_overlap=150,
-        length_function=len
+        length_function=len,
+        add_start_index=True
     )
     
     logger.info(f"Upserting {len(to_upsert_source_ids)} sources.")
+    failed_sources = []
     
     for sid in to_upsert_source_ids:
         data = current_sources[sid]
         raw_text = data["text"]
         metadata = data["metadata"]
+        source_hash = compute_source_hash(raw_text)
         
-        if sid in source_to_point_ids:
-            old_points = source_to_point_ids[sid]
-            client.delete(
-                collection_name=COLLECTION_NAME,
-                points_selector=rest.PointIdsList(points=old_points)
-            )
+        # The previous version (points + manifest row) stays readable until the new one is fully written
+        old_points = source_to_point_ids.get(sid, [])
         
-        chunks = text_splitter.split_text(raw_text)
+        # create_documents keeps each chunk's start offset so consumers can rebuild the source in order
+        chunk_docs = text_splitter.create_documents([raw_text])
+        chunks = [doc.page_content for doc in chunk_docs]
         if not chunks:
+            if old_points:
+                client.delete(
+                    collection_name=collection_name,
+                    points_selector=rest.PointIdsList(points=old_points)
+                )
+            KnowledgeSource.objects.filter(company_id=company_id, source_id=sid).delete()
             continue
             
         try:
             vectors = embeddings.embed_documents(chunks)
         except Exception as e:
             logger.error(f"Failed to embed source {sid}: {e}")
+            failed_sources.append(sid)
             continue
             
         points = []
-        import uuid
         
-        for i, (chunk, vector) in enumerate(zip(chunks, vectors)):
+        for i, (doc, vector) in enumerate(zip(chunk_docs, vectors)):
             point_id = str(uuid.uuid4())
+            char_start = doc.metadata.get("start_index", -1)
             payload = {
                 "source_id": sid,
-                "text": chunk,
+                "source_hash": source_hash,
+                "chunk_count": len(chunks),
+                "chunk_index": i,
+                "char_start": char_start,
+                "char_end": char_start + len(doc.page_content) if char_start >= 0 else -1,
+                "text": doc.page_content,
                 "company_id": company_id,
+                TENANT_FIELD: get_tenant_id(company_id),
                 **metadata
             }
             points.append(rest.PointStruct(id=point_id, vector=vector, payload=payload))
@@ -376,22 +375,62 @@ def process_company_knowledge(company_id: int):
         if points:
             batch_size = 100
             total_batches = (len(points) + batch_size - 1) // batch_size
+            failed = False
             
             for batch_idx in range(0, len(points), batch_size):
                 batch = points[batch_idx:batch_idx + batch_size]
                 try:
                     client.upsert(
-                        collection_name=COLLECTION_NAME,
+                        collection_name=collection_name,
                         points=batch,
                         wait=True
                     )
                 except Exception as e:
                     logger.error(f"  Failed to upsert batch: {e}")
+                    failed = True
                     continue
+
+            if failed:
+                failed_sources.append(sid)
+                # Drop the partial new copy and keep serving the previous version; the next sync retries
+                try:
+                    client.delete(
+                        collection_name=collection_name,
+                        points_selector=rest.PointIdsList(points=[p.id for p in points])
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to remove partial upsert of source {sid}: {e}")
+                continue
+
+            # Point the manifest at the new chunks, then retire the old ones
+            try:
+                KnowledgeSource.objects.update_or_create(
+                    company_id=company_id,
+                    source_id=sid,
+                    defaults={
+                        "source_hash": source_hash,
+                        "length": len(raw_text),
+                        "chunk_ids": [p.id for p in points],
+                    }
+                )
+            except Exception as e:
+                logger.error(f"Failed to update manifest for source {sid}: {e}")
+                failed_sources.append(sid)
+
+            if old_points:
+                try:
+                    client.delete(
+                        collection_name=collection_name,
+                        points_selector=rest.PointIdsList(points=old_points)
+                    )
+                except Exception as e:
+                    # Leftovers break the chunk_count check, so the next sync re-embeds the source
+                    logger.error(f"Failed to delete old points of source {sid}: {e}")
             
             logger.info(f"Successfully processed {len(points)} chunks for source {sid}.")
             
-    logger.info("Sync completed.")
+    logger.info(f"Sync completed ({len(failed_sources)} sources failed).")
+    return failed_sources
 
 if __name__ == "__main__":
     # Test with company_id 2
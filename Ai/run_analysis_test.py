@@ -26,7 +26,7 @@ from Ai.data_analysis import analyze_company_data
 def main():
     company_id = 2
     print(f"Running analysis for Company ID: {company_id}...")
-    result = analyze_company_data(company_id)
+    result = analyze_company_data(company_id, force_refresh=True)
     
     print("\n--- JSON OUTPUT ---")
     print(json.dumps(result, indent=2))
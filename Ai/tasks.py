@@ -1,6 +1,7 @@
 from celery import shared_task
 from Ai.rag_ingestion import process_company_knowledge
-from Ai.data_analysis import analyze_company_data
+from Ai.data_analysis import analyze_company_data, schedule_analysis_refresh, get_analysis_lock_key
+from django.core.cache import cache
 from Socials.consumers import send_alert
 from Accounts.models import Company
 import logging
@@ -14,9 +15,9 @@ def sync_company_knowledge_task(company_id):
         process_company_knowledge(company_id)
         logger.info(f"CELERY: Successfully synced knowledge for company {company_id}")
         
-        # Refresh the analysis cache immediately after sync
-        logger.info(f"CELERY: Refreshing analysis cache for company {company_id}")
-        analyze_company_data(company_id, force_refresh=True)
+        # Refresh the analysis cache in the background; readers get the previous result meanwhile
+        logger.info(f"CELERY: Queueing analysis refresh for company {company_id}")
+        schedule_analysis_refresh(company_id)
         
         send_alert(Company.objects.get(id=company_id), "Your knowledge base is now updated.")
         return f"Success: Company {company_id} synced and analysis refreshed"
@@ -39,3 +40,15 @@ def analyze_company_data_task(company_id):
         logger.error(f"CELERY ERROR: Failed to analyze data for company {company_id}: {str(e)}")
         # We don't raise here to prevent login flow errors if it was triggered from there (though it's async)
         return str(e)
+
+@shared_task(name="Ai.tasks.refresh_company_analysis_task")
+def refresh_company_analysis_task(company_id):
+    """Recomputes the analysis; queued by schedule_analysis_refresh, which holds the per-company lock."""
+    try:
+        analyze_company_data(company_id, force_refresh=True)
+        return f"Success: Analysis refreshed for company {company_id}"
+    except Exception as e:
+        logger.error(f"CELERY ERROR: Failed to refresh analysis for company {company_id}: {str(e)}")
+        return str(e)
+    finally:
+        cache.delete(get_analysis_lock_key(company_id))
@@ -0,0 +1,246 @@
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+from Accounts.models import Company, User
+from Ai.data_analysis import aggregate_counts, extract_company_source, extract_company_sources, get_free_text_source
+from Ai.models import CompanyVectorLayout, KnowledgeSource
+from Ai.vector_store import (
+    TENANT_FIELD, backfill_tenant_ids, company_filter, dedicated_collection_name, ensure_collection_exists,
+    get_collection_name, iter_company_points, move_company_to_collection, shared_collection_name,
+)
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+VECTOR_SIZE = 4
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class VectorStoreTests(TestCase):
+    """Shared / dedicated collection layout against an in-memory Qdrant."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = QdrantClient(":memory:")
+        self.shared = shared_collection_name("openai")
+        self.company_a = self.create_company("a@example.com")
+        self.company_b = self.create_company("b@example.com")
+        ensure_collection_exists(self.client, self.shared, vector_size=VECTOR_SIZE)
+        self.add_points(self.company_a, 3, vector=[1, 0, 0, 0])
+        self.add_points(self.company_b, 2, vector=[0.9, 0.1, 0, 0])
+
+    def create_company(self, email):
+        user = User.objects.create(email=email, role="user")
+        return Company.objects.filter(user=user).first() or Company.objects.create(user=user, name=email)
+
+    def add_points(self, company, count, vector):
+        self.client.upsert(collection_name=self.shared, wait=True, points=[
+            rest.PointStruct(
+                id=company.id * 1000 + i,
+                vector=vector,
+                payload={"company_id": company.id, "source_id": f"kb_{i}", "chunk_index": 0, "text": f"chunk {i}"}
+            )
+            for i in range(count)
+        ])
+
+    def count(self, collection_name, company):
+        return self.client.count(collection_name, count_filter=company_filter(company.id), exact=True).count
+
+    def test_shared_collection_is_created_with_tenant_settings_and_indexes(self):
+        # The local Qdrant ignores HNSW settings and payload indexes, so check what is requested
+        collection_name = shared_collection_name("test")
+        with mock.patch.object(self.client, "create_collection", wraps=self.client.create_collection) as create, \
+                mock.patch.object(self.client, "create_payload_index") as create_index:
+            ensure_collection_exists(self.client, collection_name, vector_size=VECTOR_SIZE)
+
+        self.assertTrue(self.client.collection_exists(collection_name))
+        self.assertEqual(self.client.get_collection(collection_name).config.params.vectors.size, VECTOR_SIZE)
+        hnsw_config = create.call_args.kwargs["hnsw_config"]
+        self.assertEqual((hnsw_config.m, hnsw_config.payload_m), (0, 16))
+        schemas = {call.kwargs["field_name"]: call.kwargs["field_schema"] for call in create_index.call_args_list}
+        self.assertEqual(set(schemas), {TENANT_FIELD, "company_id", "source_id"})
+        self.assertTrue(schemas[TENANT_FIELD].is_tenant)
+
+    def test_failed_index_creation_is_logged(self):
+        with mock.patch.object(self.client, "create_payload_index", side_effect=RuntimeError("boom")), \
+                self.assertLogs("Ai.vector_store", level="ERROR") as logs:
+            ensure_collection_exists(self.client, self.shared, vector_size=VECTOR_SIZE)
+
+        self.assertEqual(len(logs.records), 3)
+
+    def test_backfill_gives_older_points_their_tenant_id(self):
+        self.assertEqual(backfill_tenant_ids(self.client, self.shared), 2)
+
+        for company in (self.company_a, self.company_b):
+            payloads = [p.payload for p in iter_company_points(self.client, company.id)]
+            self.assertTrue(all(payload[TENANT_FIELD] == str(company.id) for payload in payloads))
+        self.assertEqual(backfill_tenant_ids(self.client, self.shared), 0)
+
+    def test_ensure_collection_rejects_a_different_vector_size(self):
+        with self.assertRaises(ValueError):
+            ensure_collection_exists(self.client, self.shared, vector_size=VECTOR_SIZE * 2)
+
+    def test_move_company_to_dedicated_collection(self):
+        before = {p.id: p.payload for p in iter_company_points(self.client, self.company_a.id)}
+        target = dedicated_collection_name(self.company_a.id)
+
+        moved = move_company_to_collection(self.client, self.company_a.id, target)
+
+        self.assertEqual(moved, 3)
+        self.assertEqual(get_collection_name(self.company_a.id), target)
+        self.assertEqual(CompanyVectorLayout.objects.get(company=self.company_a).collection_name, target)
+        after = {p.id: p.payload for p in iter_company_points(self.client, self.company_a.id)}
+        self.assertEqual(after, {
+            point_id: {**payload, TENANT_FIELD: str(self.company_a.id)} for point_id, payload in before.items()
+        })
+        self.assertEqual(self.count(self.shared, self.company_a), 0)
+        self.assertEqual(self.count(self.shared, self.company_b), 2)
+
+    def test_move_back_to_shared_drops_the_dedicated_collection(self):
+        target = dedicated_collection_name(self.company_a.id)
+        move_company_to_collection(self.client, self.company_a.id, target)
+
+        moved = move_company_to_collection(self.client, self.company_a.id, self.shared)
+
+        self.assertEqual(moved, 3)
+        self.assertEqual(get_collection_name(self.company_a.id), self.shared)
+        self.assertEqual(self.count(self.shared, self.company_a), 3)
+        self.assertFalse(self.client.collection_exists(target))
+
+    def test_migrate_vector_layout_command(self):
+        with mock.patch("Ai.management.commands.migrate_vector_layout.get_qdrant_client", return_value=self.client):
+            call_command("migrate_vector_layout", str(self.company_b.id), stdout=mock.Mock())
+
+        self.assertEqual(get_collection_name(self.company_b.id), dedicated_collection_name(self.company_b.id))
+        self.assertEqual(self.count(dedicated_collection_name(self.company_b.id), self.company_b), 2)
+        self.assertEqual(self.count(self.shared, self.company_a), 3)
+
+    def reembed(self, company, process_knowledge):
+        with mock.patch("Ai.management.commands.reembed_knowledge.get_qdrant_client", return_value=self.client), \
+                mock.patch("Ai.rag_ingestion.process_company_knowledge", side_effect=process_knowledge):
+            call_command("reembed_knowledge", str(company.id), "--provider", "openai", stdout=mock.Mock())
+
+    def test_reembed_builds_a_new_dedicated_collection_before_switching(self):
+        old_collection = dedicated_collection_name(self.company_a.id)
+        move_company_to_collection(self.client, self.company_a.id, old_collection)
+
+        def process_knowledge(company_id, collection_name, provider_name):
+            # Readers still use the live collection while the rebuild runs
+            self.assertEqual(get_collection_name(company_id), old_collection)
+            ensure_collection_exists(self.client, collection_name, vector_size=VECTOR_SIZE)
+            self.client.upsert(collection_name=collection_name, wait=True, points=[rest.PointStruct(
+                id=1, vector=[0, 1, 0, 0], payload={"company_id": company_id, "source_id": "kb_1", "text": "new"}
+            )])
+            return []
+
+        self.reembed(self.company_a, process_knowledge)
+
+        new_collection = get_collection_name(self.company_a.id)
+        self.assertNotEqual(new_collection, old_collection)
+        self.assertTrue(new_collection.startswith(old_collection + "_v"))
+        self.assertEqual(self.count(new_collection, self.company_a), 1)
+        self.assertFalse(self.client.collection_exists(old_collection))
+
+    def test_failed_reembed_keeps_the_live_collection_and_manifest(self):
+        old_collection = dedicated_collection_name(self.company_a.id)
+        move_company_to_collection(self.client, self.company_a.id, old_collection)
+        KnowledgeSource.objects.create(company=self.company_a, source_id="kb_0", source_hash="h", chunk_ids=["a"])
+        built = []
+
+        def process_knowledge(company_id, collection_name, provider_name):
+            built.append(collection_name)
+            ensure_collection_exists(self.client, collection_name, vector_size=VECTOR_SIZE)
+            KnowledgeSource.objects.filter(company_id=company_id).update(chunk_ids=["b"])
+            return ["kb_0"]
+
+        with self.assertRaises(CommandError):
+            self.reembed(self.company_a, process_knowledge)
+
+        self.assertEqual(get_collection_name(self.company_a.id), old_collection)
+        self.assertEqual(self.count(old_collection, self.company_a), 3)
+        self.assertFalse(self.client.collection_exists(built[0]))
+        self.assertEqual(
+            list(KnowledgeSource.objects.filter(company=self.company_a).values_list("chunk_ids", flat=True)), [["a"]]
+        )
+
+    def test_company_filtered_search_only_returns_the_company_points(self):
+        hits = self.client.query_points(
+            collection_name=self.shared,
+            query=[1, 0, 0, 0],
+            query_filter=company_filter(self.company_b.id),
+            limit=10
+        ).points
+
+        self.assertEqual(len(hits), 2)
+        self.assertTrue(all(hit.payload["company_id"] == self.company_b.id for hit in hits))
+
+
+COMPANY_SOURCE = """Company Profile: Acme Dental
+Industry: Health
+Description: Family dental clinic.
+Cancellations must be made 24 hours in advance.
+Address: 1 Main Street
+Website: https://acme.example
+Hours: 09:00:00 - 17:00:00
+Language: English
+Summary: Deposits are refundable.
+Brand Tone: Friendly
+"""
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SourceExtractionTests(TestCase):
+    """Rule-based cmp_ parsing and the per-source extraction cache."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hours_line_becomes_opening_hours(self):
+        self.assertEqual(
+            extract_company_source(COMPANY_SOURCE)["openingHours"],
+            [{"day": "Daily", "start": "09:00", "end": "17:00"}]
+        )
+        self.assertEqual(
+            extract_company_source("Company Profile: Acme\nHours: Open 24 Hours\n")["openingHours"],
+            [{"day": "Daily", "start": "00:00", "end": "24:00"}]
+        )
+        self.assertEqual(extract_company_source("Company Profile: Acme\n")["openingHours"], [])
+
+    def test_free_text_keeps_description_continuation_lines(self):
+        free_text = get_free_text_source({"source": "cmp_1", "content": COMPANY_SOURCE})
+        self.assertEqual(free_text["source"], "freetext_cmp_1")
+        self.assertEqual(
+            free_text["content"],
+            "Family dental clinic.\nCancellations must be made 24 hours in advance.\nDeposits are refundable."
+        )
+        self.assertIsNone(get_free_text_source({"source": "cmp_1", "content": "Company Profile: Acme\n"}))
+
+    def test_company_source_scores_hours_and_llm_policies(self):
+        llm_result = {"policies": [{"type": "cancellation", "explicit": True}], "services": [{"name": "Cleaning"}]}
+        with mock.patch("Ai.data_analysis.extract_packed_sources", return_value={"freetext_cmp_1": llm_result}) as packed:
+            results, failed = extract_company_sources(1, [{"source": "cmp_1", "content": COMPANY_SOURCE}])
+
+        self.assertEqual(failed, [])
+        self.assertEqual(packed.call_args.args[0][0]["source"], "freetext_cmp_1")
+        counts = aggregate_counts(results)["counts"]
+        self.assertEqual(counts["openingHours"], 1)
+        self.assertEqual(counts["policies"], 1)
+
+    def test_empty_extraction_results_are_cached(self):
+        source = {"source": "kb_1", "content": "Nothing useful here."}
+        with mock.patch("Ai.data_analysis.extract_packed_sources", return_value={"kb_1": {}}) as packed:
+            first, _ = extract_company_sources(1, [source])
+            second, failed = extract_company_sources(1, [source])
+
+        self.assertEqual(packed.call_count, 1)
+        self.assertEqual((first, second, failed), ([{}], [{}], []))
+
+    def test_failed_extractions_are_not_cached(self):
+        source = {"source": "kb_1", "content": "Nothing useful here."}
+        with mock.patch("Ai.data_analysis.extract_packed_sources", return_value={"kb_1": None}) as packed:
+            extract_company_sources(1, [source])
+            _, failed = extract_company_sources(1, [source])
+
+        self.assertEqual(packed.call_count, 2)
+        self.assertEqual(failed, ["kb_1"])
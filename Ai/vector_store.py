@@ -0,0 +1,274 @@
+import logging
+from typing import Iterator, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+logger = logging.getLogger(__name__)
+
+# Constants
+QDRANT_URL = settings.QDRANT_URL
+QDRANT_API_KEY = settings.QDRANT_API_KEY
+COLLECTION_NAME = settings.QDRANT_COLLECTION_NAME
+LAYOUT_CACHE_TTL = 60 * 60  # 1 hour
+
+LAYOUT_SHARED = "shared"
+LAYOUT_DEDICATED = "dedicated"
+
+# Qdrant only offers the tenant index (points of a tenant stored together) on keyword / uuid
+# fields, so every point also carries the company id as a string; filters stay on company_id
+TENANT_FIELD = "tenant_id"
+
+def get_qdrant_client(timeout: int = 120) -> QdrantClient:
+    if not QDRANT_API_KEY:
+        logger.warning("QDRANT_API_KEY is not set. Connection might fail.")
+    return QdrantClient(
+        url=QDRANT_URL,
+        api_key=QDRANT_API_KEY,
+        timeout=timeout
+    )
+
+def dedicated_collection_name(company_id: int, version: Optional[int] = None) -> str:
+    """`version` names a rebuild (see reembed_knowledge) built next to the live collection."""
+    name = f"{settings.QDRANT_DEDICATED_COLLECTION_PREFIX}{company_id}"
+    return f"{name}_v{version}" if version else name
+
+def is_dedicated_collection(collection_name: str) -> bool:
+    prefix = settings.QDRANT_DEDICATED_COLLECTION_PREFIX
+    if not collection_name.startswith(prefix):
+        return False
+    company_id, _, version = collection_name[len(prefix):].partition("_v")
+    return company_id.isdigit() and (not version or version.isdigit())
+
+def shared_collection_name(provider_name: str) -> str:
+    """Vectors of different providers differ in dimension, so each gets its own shared collection."""
+    if provider_name == "openai":
+        return COLLECTION_NAME
+    return f"{COLLECTION_NAME}_{provider_name}"
+
+def get_layout_cache_key(company_id: int) -> str:
+    return f"vector_layout_{company_id}"
+
+def get_company_vector_config(company_id: int) -> dict:
+    """
+    Returns {"collection_name": ..., "embedding_provider": ...} for a company.
+    Large tenants can be moved into their own collection (see migrate_vector_layout) and
+    companies can use a different embedding provider (see reembed_knowledge);
+    everyone else shares the deployment provider's collection, partitioned by company_id.
+    """
+    cache_key = get_layout_cache_key(company_id)
+    config = cache.get(cache_key)
+    if config:
+        return config
+
+    from Ai.models import CompanyVectorLayout
+    layout = CompanyVectorLayout.objects.filter(company_id=company_id).first()
+    provider_name = (layout.embedding_provider if layout else "") or settings.EMBEDDING_PROVIDER
+    collection_name = (layout.collection_name if layout else "") or shared_collection_name(provider_name)
+
+    config = {"collection_name": collection_name, "embedding_provider": provider_name}
+    cache.set(cache_key, config, timeout=LAYOUT_CACHE_TTL)
+    return config
+
+def get_collection_name(company_id: int) -> str:
+    return get_company_vector_config(company_id)["collection_name"]
+
+def get_embedding_provider_name(company_id: int) -> str:
+    return get_company_vector_config(company_id)["embedding_provider"]
+
+def get_tenant_id(company_id: int) -> str:
+    return str(company_id)
+
+def company_filter(company_id: int, *conditions: rest.FieldCondition) -> rest.Filter:
+    return rest.Filter(
+        must=[
+            rest.FieldCondition(key="company_id", match=rest.MatchValue(value=company_id)),
+            *conditions
+        ]
+    )
+
+# --- Collection Setup ---
+
+def get_collection_params(layout: str):
+    """
+    HNSW / storage settings per layout.
+    - shared: global graph disabled (m=0) and per-tenant graphs built on the company_id
+      index (payload_m), so filtered searches only walk the tenant's own subgraph.
+    - dedicated: one tenant per collection, a regular global graph is the fast path.
+    """
+    if layout == LAYOUT_SHARED:
+        hnsw_config = rest.HnswConfigDiff(m=0, payload_m=16)
+    else:
+        hnsw_config = rest.HnswConfigDiff(m=16, payload_m=0)
+
+    quantization_config = None
+    if settings.QDRANT_SCALAR_QUANTIZATION:
+        # int8 vectors kept in RAM, originals on disk for rescoring
+        quantization_config = rest.ScalarQuantization(
+            scalar=rest.ScalarQuantizationConfig(
+                type=rest.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+
+    return hnsw_config, quantization_config
+
+def ensure_collection_exists(client: QdrantClient, collection_name: str = COLLECTION_NAME, vector_size: int = 1536):
+    layout = LAYOUT_DEDICATED if is_dedicated_collection(collection_name) else LAYOUT_SHARED
+    hnsw_config, quantization_config = get_collection_params(layout)
+
+    if client.collection_exists(collection_name):
+        existing_size = client.get_collection(collection_name).config.params.vectors.size
+        if existing_size != vector_size:
+            raise ValueError(
+                f"Collection {collection_name} stores {existing_size}-dim vectors, got {vector_size}. "
+                f"Run reembed_knowledge to switch embedding providers."
+            )
+    else:
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=rest.VectorParams(
+                size=vector_size,
+                distance=rest.Distance.COSINE,
+                on_disk=settings.QDRANT_ON_DISK_VECTORS
+            ),
+            hnsw_config=hnsw_config,
+            quantization_config=quantization_config
+        )
+        logger.info(f"Created collection {collection_name} ({layout} layout)")
+
+    ensure_payload_indexes(client, collection_name)
+
+def ensure_payload_indexes(client: QdrantClient, collection_name: str = COLLECTION_NAME):
+    indexes = {
+        TENANT_FIELD: rest.KeywordIndexParams(type=rest.KeywordIndexType.KEYWORD, is_tenant=True),
+        # Exact-match lookups only; no range index needed for tenant ids
+        "company_id": rest.IntegerIndexParams(type=rest.IntegerIndexType.INTEGER, lookup=True, range=False),
+        "source_id": rest.PayloadSchemaType.KEYWORD,
+    }
+    for field_name, field_schema in indexes.items():
+        try:
+            client.create_payload_index(collection_name=collection_name, field_name=field_name, field_schema=field_schema)
+        except Exception as e:
+            logger.error(f"Could not create the {field_name} index on {collection_name}: {e}")
+
+def tune_collection(client: QdrantClient, collection_name: str = COLLECTION_NAME):
+    """Applies the current HNSW / quantisation / on-disk settings to an existing collection."""
+    layout = LAYOUT_DEDICATED if is_dedicated_collection(collection_name) else LAYOUT_SHARED
+    hnsw_config, quantization_config = get_collection_params(layout)
+
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": rest.VectorParamsDiff(on_disk=settings.QDRANT_ON_DISK_VECTORS)},
+        hnsw_config=hnsw_config,
+        quantization_config=quantization_config or rest.Disabled.DISABLED
+    )
+    ensure_payload_indexes(client, collection_name)
+    backfilled = backfill_tenant_ids(client, collection_name)
+    logger.info(f"Tuned collection {collection_name} ({layout} layout, {backfilled} companies given a tenant id)")
+
+def backfill_tenant_ids(client: QdrantClient, collection_name: str = COLLECTION_NAME, page_size: int = 1000) -> int:
+    """Adds the tenant field to points stored before it existed. Returns the number of companies updated."""
+    missing = rest.Filter(must=[rest.IsEmptyCondition(is_empty=rest.PayloadField(key=TENANT_FIELD))])
+    companies = set()
+    while True:
+        points, _ = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=missing,
+            limit=page_size,
+            with_payload=["company_id"],
+            with_vectors=False
+        )
+        company_ids = {point.payload.get("company_id") for point in points} - {None}
+        if not company_ids or company_ids <= companies:
+            # Nothing left, or only points the company filter can't reach (e.g. no integer company_id)
+            break
+        for company_id in company_ids:
+            client.set_payload(
+                collection_name=collection_name,
+                payload={TENANT_FIELD: get_tenant_id(company_id)},
+                points=rest.FilterSelector(filter=company_filter(company_id, *missing.must)),
+                wait=True
+            )
+        companies |= company_ids
+    return len(companies)
+
+# --- Iteration ---
+
+def iter_company_points(client: QdrantClient, company_id: int, payload_fields=None, page_size: int = 1000,
+                        with_vectors: bool = False, collection_name: Optional[str] = None) -> Iterator[rest.Record]:
+    """
+    Yields every point of a company, following Qdrant's scroll offset page by page.
+    `payload_fields` restricts the payload to the given keys (None = full payload).
+    """
+    collection_name = collection_name or get_collection_name(company_id)
+    offset = None
+
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=company_filter(company_id),
+            with_payload=payload_fields if payload_fields is not None else True,
+            with_vectors=with_vectors,
+            limit=page_size,
+            offset=offset
+        )
+        yield from points
+        if offset is None:
+            break
+
+# --- Layout Migration ---
+
+def move_company_to_collection(client: QdrantClient, company_id: int, target_collection: str, page_size: int = 256) -> int:
+    """
+    Copies a company's points (same ids, vectors and payload) into `target_collection`,
+    switches the company's layout, then deletes the points from the old collection.
+    Returns the number of points moved.
+    """
+    from Ai.models import CompanyVectorLayout
+
+    source_collection = get_collection_name(company_id)
+    if source_collection == target_collection:
+        logger.info(f"Company {company_id} already lives in {target_collection}")
+        return 0
+
+    vector_size = client.get_collection(source_collection).config.params.vectors.size
+    ensure_collection_exists(client, target_collection, vector_size=vector_size)
+
+    moved = 0
+    batch: List[rest.PointStruct] = []
+    for point in iter_company_points(client, company_id, page_size=page_size, with_vectors=True,
+                                     collection_name=source_collection):
+        payload = {**point.payload, TENANT_FIELD: get_tenant_id(company_id)}
+        batch.append(rest.PointStruct(id=point.id, vector=point.vector, payload=payload))
+        if len(batch) >= page_size:
+            client.upsert(collection_name=target_collection, points=batch, wait=True)
+            moved += len(batch)
+            batch = []
+    if batch:
+        client.upsert(collection_name=target_collection, points=batch, wait=True)
+        moved += len(batch)
+
+    # Switch readers over before removing the old copy
+    CompanyVectorLayout.objects.update_or_create(
+        company_id=company_id,
+        defaults={"collection_name": target_collection if is_dedicated_collection(target_collection) else ""}
+    )
+    cache.delete(get_layout_cache_key(company_id))
+
+    client.delete(
+        collection_name=source_collection,
+        points_selector=rest.FilterSelector(filter=company_filter(company_id))
+    )
+
+    if is_dedicated_collection(source_collection):
+        try:
+            client.delete_collection(source_collection)
+        except Exception as e:
+            logger.warning(f"Could not drop old collection {source_collection}: {e}")
+
+    logger.info(f"Moved {moved} points for company {company_id}: {source_collection} -> {target_collection}")
+    return moved
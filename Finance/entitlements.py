@@ -0,0 +1,92 @@
+"""
+Cached per-company entitlement snapshot for the message hot path: the active
+subscription, its plan limits and whether any chat profile still has the bot on.
+Invalidated by Subscriptions / Plan / ChatProfile saves, the Stripe webhook and the
+bulk bot_active updates, so while nothing changes no billing table is read.
+
+The quota checks read a process-local copy (get_local_entitlements), so a check costs
+no cache round-trip; other processes pick up a change within LOCAL_ENTITLEMENTS_TTL.
+"""
+import time
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+ENTITLEMENTS_CACHE_TTL = 60 * 15  # 15 minutes; a safety net, changes invalidate explicitly
+LOCAL_ENTITLEMENTS_TTL = 10  # seconds a worker reuses its in-memory copy
+
+_local_entitlements = {}  # company_id -> (expires_at, snapshot)
+
+
+def get_entitlements_cache_key(company_id):
+    return f"entitlements_{company_id}"
+
+
+def build_entitlements(company_id):
+    from .models import Subscriptions
+    from Socials.models import ChatProfile
+
+    subscription = Subscriptions.objects.filter(
+        company__id=company_id,
+        active=True,
+        end__gt=timezone.now()
+    ).select_related('plan').first()
+    plan = subscription.plan if subscription else None
+
+    return {
+        "subscription_id": subscription.id if subscription else None,
+        "plan_id": plan.id if plan else None,
+        "plan_name": plan.name if plan else None,
+        "msg_limit": plan.msg_limit if plan else 0,
+        "token_limit": plan.token_limit if plan else 0,
+        "user_limit": plan.user_limit if plan else 0,
+        "end": subscription.end if subscription else None,
+        "bot_active": ChatProfile.objects.filter(user__company__id=company_id, bot_active=True).exists(),
+    }
+
+
+def get_entitlements(company_id):
+    """
+    Returns the company's snapshot (see build_entitlements). A snapshot whose
+    subscription has ended since it was cached is rebuilt.
+    """
+    cache_key = get_entitlements_cache_key(company_id)
+    entitlements = cache.get(cache_key)
+    if entitlements is not None:
+        if not (entitlements["end"] and entitlements["end"] <= timezone.now()):
+            return entitlements
+
+    entitlements = build_entitlements(company_id)
+    cache.set(cache_key, entitlements, timeout=ENTITLEMENTS_CACHE_TTL)
+    return entitlements
+
+
+def get_local_entitlements(company_id):
+    """get_entitlements through a short-lived in-process copy, for the per-message quota checks."""
+    now = time.monotonic()
+    cached = _local_entitlements.get(company_id)
+    if cached and cached[0] > now:
+        entitlements = cached[1]
+        if not (entitlements["end"] and entitlements["end"] <= timezone.now()):
+            return entitlements
+
+    entitlements = get_entitlements(company_id)
+    _local_entitlements[company_id] = (now + LOCAL_ENTITLEMENTS_TTL, entitlements)
+    return entitlements
+
+
+def drop_entitlements(company_ids, keys):
+    cache.delete_many(keys)
+    for company_id in company_ids:
+        _local_entitlements.pop(company_id, None)
+
+
+def invalidate_entitlements(*company_ids):
+    """Drops the snapshots now and again once the surrounding transaction commits."""
+    company_ids = [company_id for company_id in company_ids if company_id]
+    keys = [get_entitlements_cache_key(company_id) for company_id in company_ids]
+    if not keys:
+        return
+    drop_entitlements(company_ids, keys)
+    # A reader between now and COMMIT would cache the old rows again
+    transaction.on_commit(lambda: drop_entitlements(company_ids, keys))
@@ -50,6 +50,10 @@ class Plan(models.Model):
 
         super().save(*args, **kwargs)
 
+        # Limits changed for every company on this plan
+        from .entitlements import invalidate_entitlements
+        invalidate_entitlements(*Subscriptions.objects.filter(plan=self, active=True).values_list('company_id', flat=True))
+
     history = HistoricalRecords()
 
 
@@ -98,26 +102,20 @@ class Subscriptions(models.Model):
             end__gte=timezone.now()
         ).update(active=False)
 
+        # Reload the quota counters from the saved token_count
+        from .quota import invalidate_subscription_quota
+        invalidate_subscription_quota(self)
+
     def deduct_tokens(self, amount):
         """
-        Deduct tokens from the subscription and update Redis cache.
+        Record token usage against the subscription's atomic quota counter
+        (written back to token_count by Finance.tasks.flush_quota_counters).
         """
         if amount <= 0:
             return
 
-        self.token_count -= amount
-        self.save(update_fields=['token_count'])
-
-        # Update Redis to keep it in sync with Socials/helper.py
-        try:
-            from django_redis import get_redis_connection
-            redis = get_redis_connection("default")
-            cache_key = f"company_token_{self.company.id}"
-            redis.set(cache_key, self.token_count)
-        except ImportError:
-            pass # django_redis might not be installed or configured in all envs
-        except Exception as e:
-            print(f"Error updating redis cache: {e}")
+        from .quota import consume_subscription_tokens
+        consume_subscription_tokens(self.id, amount, mode="force")
 
     def __str__(self):
         return f"{self.company} - {self.plan.name}"
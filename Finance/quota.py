@@ -0,0 +1,251 @@
+"""
+Token and daily message quotas enforced with atomic Redis counters.
+
+- quota_balance_{subscription_id}: remaining tokens, loaded once from Subscriptions.token_count
+- quota_used_{subscription_id}: tokens consumed since the last flush
+- quota_msgs_{company_id}_{date}: AI replies sent on that day
+
+Every check is a single Lua call on top of the worker's in-memory copy of the
+entitlement snapshot (Finance.entitlements.get_local_entitlements). Finance.tasks.flush_quota_counters writes the consumed
+tokens and daily counts back to Subscriptions / DailyUsage in batches.
+"""
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+from django_redis import get_redis_connection
+from .entitlements import get_local_entitlements, invalidate_entitlements
+
+QUOTA_MSGS_TTL = 60 * 60 * 48  # daily counters outlive their day long enough to be flushed
+DIRTY_TOKENS_KEY = "quota_dirty_tokens"
+DIRTY_MSGS_KEY = "quota_dirty_msgs"
+
+# KEYS: balance, used, dirty set | ARGV: requested, mode (all / partial / force), initial balance or ''
+# Returns {granted, remaining}, or {-1, 0} when the balance has to be loaded from the DB first.
+CONSUME_TOKENS_SCRIPT = """
+local balance = tonumber(redis.call('GET', KEYS[1]))
+if balance == nil then
+    if ARGV[3] == '' then
+        return {-1, 0}
+    end
+    balance = tonumber(ARGV[3]) - (tonumber(redis.call('GET', KEYS[2])) or 0)
+    redis.call('SET', KEYS[1], balance)
+end
+
+local requested = tonumber(ARGV[1])
+local granted = 0
+if ARGV[2] == 'force' then
+    granted = requested
+elseif ARGV[2] == 'partial' then
+    granted = math.max(0, math.min(requested, balance))
+elseif balance >= requested then
+    granted = requested
+end
+
+if granted > 0 then
+    balance = redis.call('DECRBY', KEYS[1], granted)
+    redis.call('INCRBY', KEYS[2], granted)
+    redis.call('SADD', KEYS[3], ARGV[4])
+end
+return {granted, balance}
+"""
+
+# KEYS: daily count, dirty set | ARGV: limit, initial count or '', ttl, dirty member
+# Returns {allowed, count}, or {-1, 0} when the count has to be loaded from the DB first.
+CONSUME_MESSAGE_SCRIPT = """
+local count = tonumber(redis.call('GET', KEYS[1]))
+if count == nil then
+    if ARGV[2] == '' then
+        return {-1, 0}
+    end
+    count = tonumber(ARGV[2])
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[3])
+end
+
+if count >= tonumber(ARGV[1]) then
+    return {0, count}
+end
+count = redis.call('INCR', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[4])
+return {1, count}
+"""
+
+
+# KEYS: balance, used, dirty set | ARGV: amount, dirty member
+# An unloaded balance is left alone: it is loaded as token_count - used, which already counts the refund.
+REFUND_TOKENS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+redis.call('DECRBY', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2])
+return 1
+"""
+
+
+def get_balance_key(subscription_id):
+    return f"quota_balance_{subscription_id}"
+
+
+def get_used_key(subscription_id):
+    return f"quota_used_{subscription_id}"
+
+
+def get_msgs_key(company_id, day):
+    """`day` is an ISO date string."""
+    return f"quota_msgs_{company_id}_{day}"
+
+
+#---------------------------------------------
+# CONSUMPTION
+#---------------------------------------------
+
+def consume_subscription_tokens(subscription_id, count, mode="all"):
+    """
+    Atomically takes tokens from a subscription's balance.
+    mode "all": all or nothing; "partial": as many as are left; "force": always (usage already happened).
+    Returns (granted, remaining).
+    """
+    from .models import Subscriptions
+    redis = get_redis_connection("default")
+    keys = [get_balance_key(subscription_id), get_used_key(subscription_id), DIRTY_TOKENS_KEY]
+
+    granted, remaining = redis.eval(CONSUME_TOKENS_SCRIPT, len(keys), *keys, count, mode, "", subscription_id)
+    if granted == -1:
+        initial = Subscriptions.objects.filter(id=subscription_id).values_list("token_count", flat=True).first() or 0
+        granted, remaining = redis.eval(CONSUME_TOKENS_SCRIPT, len(keys), *keys, count, mode, initial, subscription_id)
+    return int(granted), int(remaining)
+
+
+def consume_tokens(company_id, count, mode="all"):
+    """consume_subscription_tokens for the company's active subscription; (None, 0) without one."""
+    subscription_id = get_local_entitlements(company_id)["subscription_id"]
+    if not subscription_id:
+        return None, 0
+    return consume_subscription_tokens(subscription_id, count, mode)
+
+
+def refund_tokens(company_id, count):
+    """Gives back tokens taken by consume_tokens for work that didn't happen (e.g. a message that wasn't stored)."""
+    subscription_id = get_local_entitlements(company_id)["subscription_id"]
+    if not subscription_id or count <= 0:
+        return
+    keys = [get_balance_key(subscription_id), get_used_key(subscription_id), DIRTY_TOKENS_KEY]
+    get_redis_connection("default").eval(REFUND_TOKENS_SCRIPT, len(keys), *keys, count, subscription_id)
+
+
+def consume_daily_message(company_id):
+    """
+    Counts one AI reply against the plan's daily limit.
+    Returns (allowed, count, limit); allowed is None without an active subscription.
+    """
+    from .models import DailyUsage
+    entitlements = get_local_entitlements(company_id)
+    if not entitlements["subscription_id"]:
+        return None, 0, 0
+
+    limit = entitlements["msg_limit"]
+    today = timezone.now().date()
+    redis = get_redis_connection("default")
+    keys = [get_msgs_key(company_id, today.isoformat()), DIRTY_MSGS_KEY]
+    member = f"{company_id}:{today.isoformat()}"
+
+    allowed, count = redis.eval(CONSUME_MESSAGE_SCRIPT, len(keys), *keys, limit, "", QUOTA_MSGS_TTL, member)
+    if allowed == -1:
+        initial = DailyUsage.objects.filter(company_id=company_id, date=today).values_list("msg_count", flat=True).first() or 0
+        allowed, count = redis.eval(CONSUME_MESSAGE_SCRIPT, len(keys), *keys, limit, initial, QUOTA_MSGS_TTL, member)
+    return bool(allowed), int(count), limit
+
+
+def get_remaining_tokens(subscription):
+    """Live balance: the Redis counter if loaded, else the stored token_count."""
+    try:
+        balance = get_redis_connection("default").get(get_balance_key(subscription.id))
+    except Exception:
+        balance = None
+    return int(balance) if balance is not None else subscription.token_count
+
+#---------------------------------------------
+# FLUSHING
+#---------------------------------------------
+
+def flush_token_usage(subscription_ids=None):
+    """Applies consumed tokens to Subscriptions.token_count in one UPDATE. Returns the number of rows."""
+    from .models import Subscriptions
+    redis = get_redis_connection("default")
+    if subscription_ids is None:
+        subscription_ids = [int(sid) for sid in redis.smembers(DIRTY_TOKENS_KEY)]
+    if not subscription_ids:
+        return 0
+
+    pipe = redis.pipeline()
+    for subscription_id in subscription_ids:
+        pipe.srem(DIRTY_TOKENS_KEY, subscription_id)
+        pipe.getset(get_used_key(subscription_id), 0)
+    results = pipe.execute()
+    used = {
+        subscription_id: int(value)
+        for subscription_id, value in zip(subscription_ids, results[1::2])
+        if value and int(value)
+    }
+    if not used:
+        return 0
+
+    try:
+        Subscriptions.objects.filter(id__in=list(used)).update(
+            token_count=F("token_count") - Case(
+                *[When(id=subscription_id, then=Value(amount)) for subscription_id, amount in used.items()],
+                default=Value(0),
+                output_field=IntegerField()
+            )
+        )
+    except Exception:
+        # Put the usage back so the next flush retries it
+        pipe = redis.pipeline()
+        for subscription_id, amount in used.items():
+            pipe.incrby(get_used_key(subscription_id), amount)
+            pipe.sadd(DIRTY_TOKENS_KEY, subscription_id)
+        pipe.execute()
+        raise
+    return len(used)
+
+
+def flush_message_counts():
+    """Upserts the daily reply counters into DailyUsage in one statement. Returns the number of rows."""
+    from .models import DailyUsage
+    redis = get_redis_connection("default")
+    members = [m.decode() if isinstance(m, bytes) else m for m in redis.smembers(DIRTY_MSGS_KEY)]
+    if not members:
+        return 0
+
+    pipe = redis.pipeline()
+    for member in members:
+        company_id, day = member.split(":")
+        pipe.srem(DIRTY_MSGS_KEY, member)
+        pipe.get(get_msgs_key(company_id, day))
+    results = pipe.execute()
+
+    rows = [
+        DailyUsage(company_id=int(member.split(":")[0]), date=member.split(":")[1], msg_count=int(count))
+        for member, count in zip(members, results[1::2])
+        if count is not None
+    ]
+    try:
+        DailyUsage.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=["company", "date"], update_fields=["msg_count"]
+        )
+    except Exception:
+        redis.sadd(DIRTY_MSGS_KEY, *members)
+        raise
+    return len(rows)
+
+
+def invalidate_subscription_quota(subscription):
+    """
+    Called when a subscription is saved: pending usage is written to the DB and the
+    balance is reloaded from token_count on next use, so admin top-ups and renewals apply.
+    """
+    invalidate_entitlements(subscription.company_id)
+    try:
+        flush_token_usage([subscription.id])
+        get_redis_connection("default").delete(get_balance_key(subscription.id))
+    except Exception as e:
+        print(f"⚠️ Could not reset token quota for subscription {subscription.id}: {e}")
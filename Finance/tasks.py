@@ -0,0 +1,10 @@
+from celery import shared_task
+from .quota import flush_token_usage, flush_message_counts
+
+
+@shared_task(name="Finance.tasks.flush_quota_counters")
+def flush_quota_counters():
+    """Writes the Redis quota counters back to Subscriptions.token_count and DailyUsage."""
+    subscriptions = flush_token_usage()
+    usage_rows = flush_message_counts()
+    return f"Flushed token usage of {subscriptions} subscriptions and {usage_rows} daily usage rows"
@@ -1,3 +1,35 @@
-from django.test import TestCase
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from Accounts.models import Company, User
+from Finance import entitlements
+from Finance.entitlements import get_local_entitlements, invalidate_entitlements
 
-# Create your tests here.
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class LocalEntitlementsTests(TestCase):
+    """The in-process entitlement copy the quota checks read."""
+
+    def setUp(self):
+        cache.clear()
+        entitlements._local_entitlements.clear()
+        user = User.objects.create(email="owner@example.com", role="user")
+        self.company = Company.objects.get(user=user)
+
+    def test_repeated_checks_skip_the_cache(self):
+        get_local_entitlements(self.company.id)
+        with mock.patch("Finance.entitlements.cache.get") as cache_get:
+            for _ in range(3):
+                get_local_entitlements(self.company.id)
+        cache_get.assert_not_called()
+
+    def test_invalidation_drops_the_local_copy(self):
+        get_local_entitlements(self.company.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_entitlements(self.company.id)
+
+        with mock.patch("Finance.entitlements.build_entitlements", wraps=entitlements.build_entitlements) as build:
+            get_local_entitlements(self.company.id)
+        build.assert_called_once_with(self.company.id)
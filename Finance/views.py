@@ -16,6 +16,7 @@ from rest_framework.decorators import api_view,permission_classes
 from Socials.consumers import send_alert
 from decimal import Decimal
 from .helper import *
+from .entitlements import invalidate_entitlements
 import logging
 import traceback
 from Accounts.utils import get_company_user
@@ -170,6 +171,7 @@ def stripe_webhook(request):
                     
                     sub_obj._history_user = company.user
                     sub_obj.save()
+                    invalidate_entitlements(company.id)
                     
                     logger.info(f"✅ Subscription {subscription_id} activated for company {company_id}")
 
@@ -260,6 +262,7 @@ def stripe_webhook(request):
                         sub_obj.end = None 
                         sub_obj._history_user = sub_obj.company.user
                         sub_obj.save()
+                        invalidate_entitlements(sub_obj.company_id)
 
                         # Record the renewal payment
                         payment = Payment(
@@ -298,6 +301,7 @@ def stripe_webhook(request):
             sub_obj.active = False
             sub_obj._history_user = sub_obj.company.user
             sub_obj.save()
+            invalidate_entitlements(sub_obj.company_id)
             send_alert(
                 [sub_obj.company],
                 "Subscription Cancelled/Expired",
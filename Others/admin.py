@@ -11,4 +11,5 @@ admin.site.register(SupportTicket,ModelAdmin)
 admin.site.register(GoogleCalendar,ModelAdmin)
 admin.site.register(UserSession,ModelAdmin)
 admin.site.register(AITrainingFile,ModelAdmin)
+admin.site.register(DailyStats,ModelAdmin)
 
@@ -3,7 +3,9 @@ from Socials.models import *
 from Socials.webhook import *
 import re,pytz,requests
 from datetime import timedelta,datetime
+from django.utils import timezone
 from Socials.helper import send_message
+from Socials.outbound import OUTBOUND_PRIORITY_BULK
 from rest_framework.response import Response
 from rest_framework import status
 from .serializers import BookingSerializer
@@ -180,9 +182,9 @@ def send_via_webhook_style(client_number, message_text):
     if not profile:
         return {"error": "No active WhatsApp profile"}
     
-    # Use the same send_message function your webhook uses
+    # Use the same send_message function your webhook uses; reminders yield to live replies
     print('☘️ Send successfuly')
-    return send_message(profile, client_obj, message_text)
+    return send_message(profile, client_obj, message_text, priority=OUTBOUND_PRIORITY_BULK)
 
 def parse_timezone_offset(tz_string):
     """Convert timezone string like '+6' to pytz FixedOffset"""
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from Others.rollups import RECONCILE_DAYS, reconcile_daily_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the DailyStats analytics rollups from the raw tables (e.g. --days 3650 once after deploying them)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=RECONCILE_DAYS, help="Rebuild this many days back, today included")
+        parser.add_argument("--company", type=int, action="append", help="Only these company ids")
+
+    def handle(self, *args, **options):
+        rows = reconcile_daily_stats(days=options["days"], company_ids=options["company"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} daily stats rows"))
@@ -23,6 +23,12 @@ class Booking(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     google_event_id = models.CharField(max_length=255, blank=True, null=True)
     event_link = models.URLField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Day views, availability and overlap checks all filter a company's bookings by start_time
+            models.Index(fields=['company', 'start_time'], name='booking_company_start_idx'),
+        ]
     
     def __str__(self):
         return f'{self.company.name} - {self.start_time}'
@@ -218,3 +224,27 @@ class AITrainingFile(models.Model):
 
     def __str__(self):
         return f"{self.company.name} - {self.file.name}"
+
+
+class DailyStats(models.Model):
+    """
+    Per-company, per-day, per-platform analytics rollup (see Others.rollups). Bookings
+    and revenue aren't tied to a channel and live in the platform="" row.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    platform = models.CharField(max_length=20, blank=True, default="")
+    incoming = models.IntegerField(default=0)
+    outgoing_ai = models.IntegerField(default=0)
+    outgoing_human = models.IntegerField(default=0)
+    new_clients = models.IntegerField(default=0)
+    bookings = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Daily Stats"
+        verbose_name_plural = "Daily Stats"
+        unique_together = ('company', 'date', 'platform')
+
+    def __str__(self):
+        return f"{self.company.name} - {self.date} - {self.platform or 'all'}"
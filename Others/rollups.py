@@ -0,0 +1,135 @@
+"""
+Daily analytics rollups (DailyStats): one row per company, day and platform.
+
+Counters are bumped where the rows are inserted (inbound batches, the outbox, the
+Booking / Payment signals). reconcile_daily_stats recomputes the latest days from the
+raw tables every night, before cleanup_system prunes them, so older days live on in
+the rollup and the analytics keep their history after pruning.
+
+Days are bucketed like the `__date` lookups the analytics used to run (settings.TIME_ZONE).
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import DailyStats
+
+COMPANY_WIDE = ""  # platform of the bookings / revenue rows
+STATS_FIELDS = ("incoming", "outgoing_ai", "outgoing_human", "new_clients", "bookings", "revenue")
+RECONCILE_DAYS = 2  # yesterday is recomputed once more when it's complete
+
+
+def get_stats_date(timestamp):
+    return timezone.localdate(timestamp)
+
+
+def bump_daily_stats(company_id, day, platform=COMPANY_WIDE, **deltas):
+    """Adds `deltas` (field=amount) to one rollup row, creating it if needed."""
+    deltas = {field: amount for field, amount in deltas.items() if amount}
+    if not company_id or not deltas:
+        return
+    row = DailyStats.objects.filter(company_id=company_id, date=day, platform=platform)
+    increments = {field: F(field) + amount for field, amount in deltas.items()}
+    if row.update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            DailyStats.objects.create(company_id=company_id, date=day, platform=platform, **deltas)
+    except IntegrityError:
+        # Created concurrently
+        row.update(**increments)
+
+
+def get_message_field(message):
+    if message.type == "incoming":
+        return "incoming"
+    return "outgoing_ai" if message.send_by_bot else "outgoing_human"
+
+
+def record_message_stats(company_id, platform, messages):
+    """Counts newly stored ChatMessages; never lets the rollup break the message path."""
+    counts = defaultdict(lambda: defaultdict(int))
+    for message in messages:
+        counts[get_stats_date(message.timestamp or timezone.now())][get_message_field(message)] += 1
+    try:
+        # Savepoint: a failed bump must not break the caller's transaction
+        with transaction.atomic():
+            for day, deltas in counts.items():
+                bump_daily_stats(company_id, day, platform, **deltas)
+    except Exception as e:
+        print(f"⚠️ Daily stats not updated for company {company_id}: {e}")
+
+
+def record_new_clients(company_id, platform, count=1, timestamp=None):
+    """Counts new conversations (ChatRooms) on the day they were opened."""
+    try:
+        with transaction.atomic():
+            bump_daily_stats(company_id, get_stats_date(timestamp or timezone.now()), platform, new_clients=count)
+    except Exception as e:
+        print(f"⚠️ Daily stats not updated for company {company_id}: {e}")
+
+#---------------------------------------------
+# RECONCILE
+#---------------------------------------------
+
+def reconcile_daily_stats(days=RECONCILE_DAYS, company_ids=None):
+    """
+    Rebuilds every rollup row dated from `days` days ago (today included) onwards
+    from the raw tables. Bookings are bucketed by start_time, so future days are
+    rebuilt as well. Returns the number of rows written.
+    """
+    from Finance.models import Payment
+    from Socials.models import ChatMessage, ChatRoom
+    from .models import Booking
+
+    since = timezone.localdate() - timedelta(days=days - 1)
+    start = timezone.make_aware(datetime.combine(since, time.min))
+
+    def scoped(queryset, company_field):
+        if company_ids is not None:
+            queryset = queryset.filter(**{f"{company_field}__in": company_ids})
+        return queryset.filter(**{f"{company_field}__isnull": False})
+
+    rows = defaultdict(lambda: dict.fromkeys(STATS_FIELDS, 0))
+
+    messages = scoped(ChatMessage.objects.filter(timestamp__gte=start), "room__profile__user__company").values(
+        "type", "send_by_bot",
+        company=F("room__profile__user__company"), platform=F("room__profile__platform"), day=TruncDate("timestamp")
+    ).annotate(count=Count("id"))
+    for entry in messages:
+        if entry["type"] == "incoming":
+            field = "incoming"
+        else:
+            field = "outgoing_ai" if entry["send_by_bot"] else "outgoing_human"
+        rows[(entry["company"], entry["day"], entry["platform"])][field] += entry["count"]
+
+    rooms = scoped(ChatRoom.objects.filter(created_at__gte=start), "profile__user__company").values(
+        company=F("profile__user__company"), platform=F("profile__platform"), day=TruncDate("created_at")
+    ).annotate(count=Count("client", distinct=True))
+    for entry in rooms:
+        rows[(entry["company"], entry["day"], entry["platform"])]["new_clients"] = entry["count"]
+
+    bookings = scoped(Booking.objects.filter(start_time__gte=start), "company").values(
+        "company", day=TruncDate("start_time")
+    ).annotate(count=Count("id"))
+    for entry in bookings:
+        rows[(entry["company"], entry["day"], COMPANY_WIDE)]["bookings"] = entry["count"]
+
+    payments = scoped(Payment.objects.filter(created_at__gte=start), "company").values(
+        "company", day=TruncDate("created_at")
+    ).annotate(total=Sum("amount"))
+    for entry in payments:
+        rows[(entry["company"], entry["day"], COMPANY_WIDE)]["revenue"] = entry["total"] or 0
+
+    with transaction.atomic():
+        stale = DailyStats.objects.filter(date__gte=since)
+        if company_ids is not None:
+            stale = stale.filter(company_id__in=company_ids)
+        stale.delete()
+        DailyStats.objects.bulk_create([
+            DailyStats(company_id=company_id, date=day, platform=platform, **values)
+            for (company_id, day, platform), values in rows.items()
+        ], batch_size=1000)
+    return len(rows)
@@ -1,11 +1,14 @@
+from decimal import Decimal
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.db import transaction
 from .models import Booking, KnowledgeBase, FAQ, OpeningHours, AITrainingFile, Company
+from Finance.models import Payment
 from Finance.helper import create_stripe_checkout_for_service
 from django.utils import timezone
 from .task import send_booking_reminder
 from .helper import *
+from .rollups import bump_daily_stats, get_stats_date
 
 @receiver(post_save, sender=Booking)
 def create_payment_for_booking(sender, instance, created, **kwargs):
@@ -68,6 +71,23 @@ def schedule_booking_reminder(sender, instance, created, **kwargs):
         import traceback
         traceback.print_exc()
 
+# Analytics rollups (see Others.rollups); edits and deletes are picked up by the nightly reconcile
+@receiver(post_save, sender=Booking)
+def count_booking(sender, instance, created, **kwargs):
+    if created and instance.company_id:
+        try:
+            bump_daily_stats(instance.company_id, get_stats_date(instance.start_time), bookings=1)
+        except Exception as e:
+            print(f"⚠️ Daily stats not updated for booking {instance.id}: {e}")
+
+@receiver(post_save, sender=Payment)
+def count_payment(sender, instance, created, **kwargs):
+    if created:
+        try:
+            bump_daily_stats(instance.company_id, get_stats_date(instance.created_at), revenue=Decimal(str(instance.amount)))
+        except Exception as e:
+            print(f"⚠️ Daily stats not updated for payment {instance.id}: {e}")
+
 def trigger_ai_sync(company_id):
     if not company_id:
         return
@@ -1,11 +1,17 @@
 from django.utils import timezone
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
 from django.core.mail import send_mail
 from .models import Booking
-import time    
+import logging
+import uuid
 from Socials.models import ChatRoom, ChatMessage
 from Socials.helper import *
 
+logger = logging.getLogger(__name__)
+
 def get_msg_history(room_id):
     """
     Get last 20 messages for a chat room in OpenAI chat format.
@@ -95,21 +101,59 @@ def send_booking_reminder(booking_id):
         traceback.print_exc()
         raise
 
+def get_reply_token_key(room_id):
+    return f"reply_debounce_{room_id}"
+
+
+def schedule_reply(room_id, delay=None):
+    """
+    Debounces the AI reply for a room: every incoming burst stores a fresh token for the
+    room and schedules wait_and_reply `delay` seconds ahead. Only the task holding the
+    latest token replies; earlier ones exit as soon as they start. No worker sleeps.
+    """
+    delay = settings.REPLY_DEBOUNCE_SECONDS if delay is None else delay
+    token = uuid.uuid4().hex
+    try:
+        get_redis_connection("default").set(get_reply_token_key(room_id), token, ex=int(delay) + 3600)
+    except Exception as e:
+        # Without the token, wait_and_reply falls back to room.last_incoming_time
+        print(f"⚠️ Reply debounce token unavailable for room {room_id}: {e}")
+        token = None
+    wait_and_reply.apply_async((room_id,), {"delay": delay, "token": token}, countdown=delay)
+
+
+def is_latest_reply_token(room_id, token):
+    try:
+        current = get_redis_connection("default").get(get_reply_token_key(room_id))
+    except Exception as e:
+        print(f"⚠️ Reply debounce token unavailable for room {room_id}: {e}")
+        return None
+    if current is None:
+        # Token expired while the task sat in a backlog: fall back to last_incoming_time
+        return None
+    if isinstance(current, bytes):
+        current = current.decode()
+    return current == token
+
+
 @shared_task(ignore_result=True)
-def wait_and_reply(room_id, delay):
+def wait_and_reply(room_id, delay=0, token=None):
     """
-    Waits for 'delay' seconds to batch incoming messages for a room,
-    then sends AI-generated reply for all unprocessed incoming messages
+    Sends an AI-generated reply for all unprocessed incoming messages of a room
     that arrived after the last outgoing message.
-    
-    FIXED: Now reschedules itself if new messages arrive during delay period.
+
+    Scheduled with a countdown by schedule_reply; a task whose token has been
+    superseded by a newer incoming message exits without touching the room.
     """
-    import time
-    print(f"⏰ wait_and_reply task started for room {room_id}, waiting {delay}s...")
-    time.sleep(delay)  # Wait for additional messages
+    print(f"⏰ wait_and_reply task started for room {room_id}")
+
+    latest = is_latest_reply_token(room_id, token) if token else None
+    if latest is False:
+        print(f"⏭️ Newer incoming message for room {room_id} → superseded reply task exits")
+        return f"Superseded reply task for room {room_id}"
 
     try:
-        room = ChatRoom.objects.get(id=room_id)
+        room = ChatRoom.objects.select_related("profile__user__company", "client").get(id=room_id)
         print(f"✅ Room found: {room.profile.platform} - {room.client.client_id}")
     except ChatRoom.DoesNotExist:
         print(f"❌ Room {room_id} does not exist")
@@ -117,12 +161,10 @@ def wait_and_reply(room_id, delay):
 
     now = timezone.now()
 
-    # If new message arrived within delay → reschedule task (FIXED)
-    if room.last_incoming_time and (now - room.last_incoming_time).total_seconds() < delay:
-        print(f"⏭️ [{room.profile.platform}] New incoming detected → rescheduling task for room {room_id}")
-        # Don't reset is_waiting_reply, just schedule a new task
-        wait_and_reply.delay(room_id, delay=delay)
-        return f"New incoming detected → rescheduled for room {room_id}"
+    # No token to compare against: a message within the debounce window has its own task queued
+    if latest is None and delay and room.last_incoming_time and (now - room.last_incoming_time).total_seconds() < delay:
+        print(f"⏭️ [{room.profile.platform}] New incoming detected → newer reply task will handle room {room_id}")
+        return f"New incoming detected → deferred for room {room_id}"
 
     # Fetch all unprocessed incoming messages after last outgoing
     if room.last_outgoing_time:
@@ -145,6 +187,20 @@ def wait_and_reply(room_id, delay):
         print(f"⏭️ No unprocessed incoming messages → nothing to reply for room {room_id}")
         return "No unprocessed incoming messages → nothing to reply"
 
+    # Claim the batch up front: rows another reply task holds or has already processed are
+    # skipped, so overlapping tasks never answer the same messages twice. Messages arriving
+    # while the reply is generated are left for the next task.
+    with transaction.atomic():
+        incoming_msgs = list(incoming_msgs.select_for_update(skip_locked=True))
+        ChatMessage.objects.filter(id__in=[msg.id for msg in incoming_msgs]).update(processed=True)
+    if not incoming_msgs:
+        print(f"⏭️ Messages of room {room_id} already claimed by another reply task")
+        return f"Messages already claimed for room {room_id}"
+
+    def release_claim():
+        # Not answered after all: leave the messages for the next reply task
+        ChatMessage.objects.filter(id__in=[msg.id for msg in incoming_msgs]).update(processed=False)
+
     # Combine all incoming texts
     full_text = "\\n".join(msg.text for msg in incoming_msgs)
     print(f"📝 [{room.profile.platform}] Combined message text ({len(incoming_msgs)} messages): {full_text[:100]}...")
@@ -158,31 +214,32 @@ def wait_and_reply(room_id, delay):
     # Check Daily Message Limit
     if not check_msg_limit(company.id):
         print(f"🛑 [{room.profile.platform}] Daily message limit reached for company {company.id}. Skipping reply.")
+        release_claim()
         room.is_waiting_reply = False
         room.save(update_fields=["is_waiting_reply"])
         return f"Daily limit reached for company {company.id}"
 
-    reply_data = get_ai_response(
-        company_id=company.id, 
-        query=full_text, 
-        history=get_msg_history(room_id=room.id)
-    )
-    reply_text = reply_data['content']
-    print(f"✅ [{room.profile.platform}] AI response generated: {reply_text[:100]}...")
-
-    # Send reply via existing send_message function
-    print(f"📤 [{room.profile.platform}] Sending reply to {room.client.client_id}...")
-    result = send_message(room.profile, room.client, reply_text)
-    print(f"✅ [{room.profile.platform}] Reply sent, result: {result}")
+    try:
+        reply_data = get_ai_response(
+            company_id=company.id, 
+            query=full_text, 
+            history=get_msg_history(room_id=room.id)
+        )
+        reply_text = reply_data['content']
+        print(f"✅ [{room.profile.platform}] AI response generated: {reply_text[:100]}...")
 
-    # Mark messages as processed
-    incoming_msgs.update(processed=True)
+        # Send reply via existing send_message function
+        print(f"📤 [{room.profile.platform}] Sending reply to {room.client.client_id}...")
+        result = send_message(room.profile, room.client, reply_text)
+        print(f"✅ [{room.profile.platform}] Reply sent, result: {result}")
+    except Exception:
+        release_claim()
+        raise
 
-    # Update room timestamps & reset waiting flag
-    room.last_outgoing_time = timezone.now()
-    room.last_incoming_time = None
-    room.is_waiting_reply = False
-    room.save(update_fields=["last_outgoing_time", "last_incoming_time", "is_waiting_reply"])
+    # Update room timestamps & reset waiting flag. The reply covers messages up to the task
+    # start, so anything that arrived while generating stays eligible for the newer task.
+    ChatRoom.objects.filter(id=room.id).update(last_outgoing_time=now)
+    ChatRoom.objects.filter(id=room.id, last_incoming_time__lte=now).update(last_incoming_time=None, is_waiting_reply=False)
 
     print(f"🎉 [{room.profile.platform}] Reply sent successfully for room {room.id}")
     return f"Reply sent for room {room.id}"
@@ -191,11 +248,13 @@ def wait_and_reply(room_id, delay):
 def cleanup_system():
     """
     Periodic task to clean up:
-    1. Useless Redis token cache for inactive companies.
+    0. First reconciles the daily analytics rollups while the raw rows still exist.
+    1. Redis quota counters of inactive subscriptions.
     2. Extra UserSession data (keep only last 20 per user).
     3. Extra ChatMessage data (keep only last 20 per room).
     4. Extra Alert data (keep only last 20 per user).
-    5. Reset stuck ChatRooms.
+    5. Processed inbound webhook events and delivered outbox rows.
+    6. Reset stuck ChatRooms.
     """
     from django_redis import get_redis_connection
     from Finance.models import Subscriptions
@@ -203,6 +262,14 @@ def cleanup_system():
     from Socials.models import ChatRoom, ChatMessage
     from django.db.models import Count
     from django.utils import timezone
+    from Others.rollups import reconcile_daily_stats
+
+    # 0. Rollups first: pruned messages and bookings are only counted there afterwards
+    try:
+        rows = reconcile_daily_stats()
+        logger.info("Reconciled %s daily stats rows", rows)
+    except Exception:
+        logger.exception("Daily stats reconcile failed")
     
     # 1. Cleanup Token Cache & Daily Usage
     try:
@@ -215,19 +282,23 @@ def cleanup_system():
         if deleted_usage > 0:
             print(f"🗑️ Deleted {deleted_usage} old DailyUsage records")
 
+        # Legacy per-company token mirrors, superseded by Finance.quota counters
         for key in redis.scan_iter("company_token_*"):
+            redis.delete(key)
+
+        from Finance.quota import flush_token_usage, get_balance_key, get_used_key
+        for key in redis.scan_iter("quota_balance_*"):
             try:
-                # Key is usually company_token_<id>
-                # Using decode() as redis keys can be bytes
                 key_str = key.decode() if isinstance(key, bytes) else key
-                company_id = key_str.split("_")[-1]
-                # Check if company has an active plan
-                plan = Subscriptions.objects.filter(company_id=company_id, active=True, end__gt=timezone.now()).exists()
-                if not plan:
-                    redis.delete(key)
-                    print(f"🗑️ Deleted useless token cache for company {company_id}")
+                subscription_id = int(key_str.split("_")[-1])
+                # Drop quota counters of subscriptions that are no longer active
+                active = Subscriptions.objects.filter(id=subscription_id, active=True, end__gt=timezone.now()).exists()
+                if not active:
+                    flush_token_usage([subscription_id])
+                    redis.delete(get_balance_key(subscription_id), get_used_key(subscription_id))
+                    print(f"🗑️ Deleted quota counters for subscription {subscription_id}")
             except Exception as e:
-                print(f"Error checking token key {key}: {e}")
+                print(f"Error checking quota key {key}: {e}")
     except Exception as e:
         print(f"Errors during redis/usage cleanup: {e}")
 
@@ -265,7 +336,23 @@ def cleanup_system():
             deleted_count = Booking.objects.filter(company_id=company_id).exclude(id__in=list(bookings_to_keep)).delete()[0]
             print(f"🗑️ Deleted {deleted_count} extra bookings for company {company_id}")
 
-    # 6. Reset stuck ChatRooms (stuck for > 30 mins)
+    # 6. Cleanup processed inbound webhook events (keep 7 days)
+    from Socials.models import InboundEvent
+    deleted_events = InboundEvent.objects.filter(
+        status="done", received_at__lt=timezone.now() - timezone.timedelta(days=7)
+    ).delete()[0]
+    if deleted_events > 0:
+        print(f"🗑️ Deleted {deleted_events} processed inbound events")
+
+    # Delivered outbox rows (keep 7 days; the message keeps its delivery_status)
+    from Socials.models import OutboundMessage
+    deleted_outbox = OutboundMessage.objects.filter(
+        status="sent", sent_at__lt=timezone.now() - timezone.timedelta(days=7)
+    ).delete()[0]
+    if deleted_outbox > 0:
+        print(f"🗑️ Deleted {deleted_outbox} delivered outbox rows")
+
+    # 7. Reset stuck ChatRooms (stuck for > 30 mins)
     stuck_rooms = ChatRoom.objects.filter(
         is_waiting_reply=True,
         last_incoming_time__lt=timezone.now() - timezone.timedelta(minutes=30)
@@ -14,7 +14,7 @@ import requests
 from django.utils import timezone
 import pytz
 from datetime import timedelta, datetime
-from django.db.models import Sum,Count
+from django.db.models import Sum,Count,F
 from Accounts.permissions import *
 from .helper import *
 import urllib.parse
@@ -22,6 +22,8 @@ from django.shortcuts import render,redirect
 from Ai.tasks import sync_company_knowledge_task
 from Ai.data_analysis import analyze_company_data
 from Accounts.utils import get_company_user
+from Socials.consumers import send_alert
+from .rollups import COMPANY_WIDE
 
 
 class ClientBookingView(APIView):
@@ -50,19 +52,9 @@ class DashboardView(APIView):
 
     # --- Chat related function ---
     def get_open_chats_count(self, user, minutes=10):
-        user_profiles = ChatProfile.objects.filter(user=user)
-        rooms = ChatRoom.objects.filter(profile__in=user_profiles)
-
-        now = timezone.now()
-        threshold_time = now - timedelta(minutes=minutes)
-
-        open_chat_count = 0
-        for room in rooms:
-            last_message = room.messages.order_by('-timestamp').first()
-            if last_message and last_message.timestamp >= threshold_time:
-                open_chat_count += 1
-
-        return open_chat_count
+        # One COUNT over the denormalised last-message column (see ChatRoom.record_last_message)
+        threshold_time = timezone.now() - timedelta(minutes=minutes)
+        return ChatRoom.objects.filter(profile__user=user, last_message_at__gte=threshold_time).count()
 
     # --- Payment related function ---
     def get_today_payments(self, company, timezone_name=None):
@@ -490,31 +482,37 @@ class AnalyticsView(generics.GenericAPIView):
 
         return Response(data)
 
-    def get_message(self, request, company):
-        # ChatRoom এর মাধ্যমে messages filter করুন
-        rooms = ChatRoom.objects.filter(profile__user=company.user)
-        qs = ChatMessage.objects.filter(room__in=rooms)
-
+    def get_stats(self, request, company):
+        # Daily rollups (see Others.rollups) in the requested time range
         time_filter = request.GET.get("time", "all")
-        channel = request.GET.get("channel", "all")
-        msg_type = request.GET.get("type", "all")
         start_date = request.GET.get("start_date")
         end_date = request.GET.get("end_date")
         tz = request.GET.get("timezone", "UTC")
+        qs = DailyStats.objects.filter(company=company)
+        return self.filter_by_date(qs, time_filter, start_date, end_date, tz)
+
+    def get_message(self, request, company):
+        channel = request.GET.get("channel", "all")
+        msg_type = request.GET.get("type", "all")
+
+        qs = self.get_stats(request, company).exclude(platform=COMPANY_WIDE)
 
-        qs = self.filter_by_time(qs, time_filter, start_date, end_date, tz)
-        
         # Messages এর জন্য channel filter
         if channel != "all":
-            qs = qs.filter(room__profile__platform=channel)
-            
-        qs = self.filter_by_type(qs, msg_type)
+            qs = qs.filter(platform=channel)
+
+        if msg_type == "human":
+            count_expr = F("outgoing_human")
+        elif msg_type == "ai":
+            count_expr = F("outgoing_ai")
+        else:
+            count_expr = F("incoming") + F("outgoing_ai") + F("outgoing_human")
 
-        # Get total count
-        total_count = qs.count()
-        
         # Get count per platform
-        platforms = qs.values("room__profile__platform").annotate(count=Count("id"))
+        platforms = list(qs.values("platform").annotate(count=Sum(count_expr)))
+
+        # Get total count
+        total_count = sum(p["count"] for p in platforms)
         
         # Initialize result with 0 for all platforms
         result = {
@@ -525,7 +523,7 @@ class AnalyticsView(generics.GenericAPIView):
         
         # Update with actual counts and calculate percentages
         for p in platforms:
-            platform = p["room__profile__platform"]
+            platform = p["platform"]
             count = p["count"]
             percentage = round((count / total_count * 100), 2) if total_count > 0 else 0.0
             result[platform] = {
@@ -544,49 +542,24 @@ class AnalyticsView(generics.GenericAPIView):
         }
 
     def get_booking_count(self, request, company):
-        qs = Booking.objects.filter(company=company)
-
-        time_filter = request.GET.get("time", "all")
-        tz = request.GET.get("timezone", "UTC")
-        start_date = request.GET.get("start_date")
-        end_date = request.GET.get("end_date")
-
-        qs = self.filter_by_time_generic(qs, time_filter, "start_time", start_date, end_date, tz)
-
-        return qs.count()
+        qs = self.get_stats(request, company).filter(platform=COMPANY_WIDE)
+        return qs.aggregate(total=Sum("bookings"))["total"] or 0
 
     def get_total_revenue(self, request, company):
-        qs = Payment.objects.filter(company=company)
-
-        time_filter = request.GET.get("time", "all")
-        tz = request.GET.get("timezone", "UTC")
-        start_date = request.GET.get("start_date")
-        end_date = request.GET.get("end_date")
-
-        qs = self.filter_by_time_generic(qs, time_filter, "created_at", start_date, end_date, tz)
-
-        total = qs.aggregate(total=Sum("amount"))["total"]
+        qs = self.get_stats(request, company).filter(platform=COMPANY_WIDE)
+        total = qs.aggregate(total=Sum("revenue"))["total"]
         return float(total) if total else 0.0
 
     def get_new_customers(self, company, request):
-        user = company.user
-        rooms = ChatRoom.objects.filter(profile__user=user)
-
-        time_filter = request.GET.get("time", "all")
         channel = request.GET.get("channel", "all")
-        tz = request.GET.get("timezone", "UTC")
-        start_date = request.GET.get("start_date")
-        end_date = request.GET.get("end_date")
 
-        rooms = self.filter_by_time_generic(
-            rooms, time_filter, "created_at", start_date, end_date, tz
-        )
+        qs = self.get_stats(request, company).exclude(platform=COMPANY_WIDE)
 
         # Rooms এর জন্য channel filter
         if channel != "all":
-            rooms = rooms.filter(profile__platform=channel)
+            qs = qs.filter(platform=channel)
 
-        return rooms.values("client").distinct().count()
+        return qs.aggregate(total=Sum("new_clients"))["total"] or 0
 
     def get_unanswered_messages(self, company, request):
         user = company.user
@@ -602,43 +575,22 @@ class AnalyticsView(generics.GenericAPIView):
         if channel != "all":
             rooms = rooms.filter(profile__platform=channel)
 
-        count = 0
-
-        for room in rooms:
-            last_msg = ChatMessage.objects.filter(room=room).order_by("-timestamp").first()
-            if not last_msg:
-                continue
-
-            qs = ChatMessage.objects.filter(id=last_msg.id)
-            qs = self.filter_by_time(qs, time_filter, start_date, end_date, tz)
-
-            if not qs.exists():
-                continue
-
-            if last_msg.type == "incoming":
-                count += 1
-
-        return count
+        # A room is unanswered when its latest message is incoming; one COUNT over the
+        # denormalised last-message columns, time-filtered on that message
+        rooms = rooms.filter(last_message_type="incoming")
+        rooms = self.filter_by_time_generic(rooms, time_filter, "last_message_at", start_date, end_date, tz)
+        return rooms.count()
 
     def channel_data(self, company, request):
-        user = company.user
-        
         time_filter = request.GET.get("time", "all")
         start_date = request.GET.get("start_date")
         end_date = request.GET.get("end_date")
         tz = request.GET.get("timezone") or request.GET.get("tz") or "UTC"
 
-        chat_profiles = ChatProfile.objects.filter(user=user)
-        rooms = ChatRoom.objects.filter(profile__in=chat_profiles)
-        
-        qs = ChatMessage.objects.filter(
-            room__in=rooms,
-            type="incoming"
-        )
-
-        qs = self.filter_by_time(qs, time_filter, start_date, end_date, tz)
+        qs = DailyStats.objects.filter(company=company).exclude(platform=COMPANY_WIDE)
+        qs = self.filter_by_date(qs, time_filter, start_date, end_date, tz)
 
-        platforms = qs.values("room__profile__platform").annotate(count=Count("id"))
+        platforms = qs.values("platform").annotate(count=Sum("incoming"))
 
         # সব platform এর জন্য 0 দিয়ে initialize করুন
         result = {
@@ -649,75 +601,64 @@ class AnalyticsView(generics.GenericAPIView):
         
         # যে platform এ message আছে সেগুলো update করুন
         for p in platforms:
-            platform = p["room__profile__platform"]
+            platform = p["platform"]
             result[platform] = p["count"]
 
         return result
     
     @staticmethod
-    def filter_by_time(queryset, time_filter, start_date=None, end_date=None, tz="UTC"):
+    def filter_by_time_generic(queryset, time_filter, date_field, start_date=None, end_date=None, tz="UTC"):
         user_tz = pytz.timezone(tz)
         now = timezone.now().astimezone(user_tz)
 
         if time_filter == "today":
-            return queryset.filter(timestamp__date=now.date())
+            return queryset.filter(**{f"{date_field}__date": now.date()})
 
         if time_filter == "this_week":
             week_start = now - timedelta(days=now.weekday())
-            return queryset.filter(timestamp__date__gte=week_start.date())
+            return queryset.filter(**{f"{date_field}__date__gte": week_start.date()})
 
         if time_filter == "this_month":
             return queryset.filter(
-                timestamp__year=now.year,
-                timestamp__month=now.month
+                **{
+                    f"{date_field}__year": now.year,
+                    f"{date_field}__month": now.month
+                }
             )
 
         if time_filter == "this_year":
-            return queryset.filter(timestamp__year=now.year)
+            return queryset.filter(**{f"{date_field}__year": now.year})
 
         if time_filter == "custom" and start_date and end_date:
-            return queryset.filter(timestamp__date__range=[start_date, end_date])
+            return queryset.filter(**{f"{date_field}__date__range": [start_date, end_date]})
 
         return queryset
 
     @staticmethod
-    def filter_by_time_generic(queryset, time_filter, date_field, start_date=None, end_date=None, tz="UTC"):
+    def filter_by_date(queryset, time_filter, start_date=None, end_date=None, tz="UTC"):
+        """filter_by_time_generic for DailyStats.date (a DateField), with the same day boundaries."""
         user_tz = pytz.timezone(tz)
         now = timezone.now().astimezone(user_tz)
 
         if time_filter == "today":
-            return queryset.filter(**{f"{date_field}__date": now.date()})
+            return queryset.filter(date=now.date())
 
         if time_filter == "this_week":
             week_start = now - timedelta(days=now.weekday())
-            return queryset.filter(**{f"{date_field}__date__gte": week_start.date()})
+            return queryset.filter(date__gte=week_start.date())
 
+        # Ranges rather than __year / __month so (company, date, platform) stays usable
         if time_filter == "this_month":
-            return queryset.filter(
-                **{
-                    f"{date_field}__year": now.year,
-                    f"{date_field}__month": now.month
-                }
-            )
+            month_start = now.date().replace(day=1)
+            next_month = (month_start + timedelta(days=32)).replace(day=1)
+            return queryset.filter(date__gte=month_start, date__lt=next_month)
 
         if time_filter == "this_year":
-            return queryset.filter(**{f"{date_field}__year": now.year})
+            year_start = now.date().replace(month=1, day=1)
+            return queryset.filter(date__gte=year_start, date__lt=year_start.replace(year=now.year + 1))
 
         if time_filter == "custom" and start_date and end_date:
-            return queryset.filter(**{f"{date_field}__date__range": [start_date, end_date]})
-
-        return queryset
-
-    @staticmethod
-    def filter_by_type(queryset, msg_type):
-        if msg_type == "all":
-            return queryset
-
-        if msg_type == "human":
-            return queryset.filter(type="outgoing", send_by_bot=False)
-
-        if msg_type == "ai":
-            return queryset.filter(type="outgoing", send_by_bot=True)
+            return queryset.filter(date__range=[start_date, end_date])
 
         return queryset
 
@@ -8,3 +8,5 @@ admin.site.register(ChatProfile,ModelAdmin)
 admin.site.register(ChatClient,ModelAdmin)
 admin.site.register(ChatRoom,ModelAdmin)
 admin.site.register(ChatMessage,ModelAdmin)
+admin.site.register(InboundEvent,ModelAdmin)
+admin.site.register(OutboundMessage,ModelAdmin)
@@ -10,6 +10,9 @@ from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.utils import timezone
 from Socials.models import *
+from .pagination import (
+    InvalidCursor, get_first_room_pages, paginate_messages, paginate_rooms, serialize_message, serialize_room,
+)
 from Ai.ai_service import get_ai_response
 from rest_framework_simplejwt.tokens import AccessToken
 User = get_user_model()
@@ -59,40 +62,27 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
 
     @database_sync_to_async
     def get_profiles_data(self, profiles):
-        from django.db.models import OuterRef, Subquery
+        # Only the first inbox page of each profile (one query for all of them); the rest is
+        # fetched with get_rooms + cursor
+        pages = get_first_room_pages(profiles)
         profiles_data = []
-
         for p in profiles:
-            # Annotate rooms with last message details to avoid N+1
-            last_message_qs = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp')
-            
-            rooms = p.rooms.select_related('client').annotate(
-                last_msg_text=Subquery(last_message_qs.values('text')[:1]),
-                last_msg_type=Subquery(last_message_qs.values('type')[:1]),
-                last_msg_time=Subquery(last_message_qs.values('timestamp')[:1])
-            )
-
-            rooms_list = []
-            for room in rooms:
-                rooms_list.append({
-                    'client_id': room.client.name if room.client.name else room.client.client_id,
-                    'room_id': room.id,
-                    'last_msg': room.last_msg_text,
-                    'type': room.last_msg_type,
-                    'timestamp': room.last_msg_time.isoformat() if room.last_msg_time else None
-                })
-            
-            # Sort rooms by timestamp (newest first)
-            rooms_list.sort(key=lambda x: x['timestamp'] or "0000-00-00", reverse=True)
-            
-            profile_info = {
+            rooms, next_cursor = pages[p.pk]
+            rooms_list = [{
+                'client_id': room.client.name if room.client.name else room.client.client_id,
+                'room_id': room.id,
+                'last_msg': room.last_message_text,
+                'type': room.last_message_type,
+                'timestamp': room.last_message_at.isoformat() if room.last_message_at else None
+            } for room in rooms]
+            profiles_data.append({
                 'platform': p.platform,
                 'profile_id': p.profile_id,
                 'profile_name': p.name if p.name else p.profile_id,
                 'room': rooms_list,
+                'next_cursor': next_cursor,
                 '_latest_timestamp': rooms_list[0]['timestamp'] if rooms_list else None
-            }
-            profiles_data.append(profile_info)
+            })
 
         # Sort profiles by latest activity
         profiles_data.sort(key=lambda x: x['_latest_timestamp'] or "0000-00-00", reverse=True)
@@ -148,11 +138,14 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
             # --- Action: Get Room List ---
             elif action == 'get_rooms':
                 platform = data.get('platform')
-                rooms = await self.get_rooms_list(self.target_user, platform)
+                rooms, next_cursor = await self.get_rooms_list(
+                    self.target_user, platform, data.get('limit'), data.get('cursor'), data.get('profile_id')
+                )
                 
                 await self.send(text_data=json.dumps({
                     'type': 'rooms_list',
-                    'rooms': rooms
+                    'rooms': rooms,
+                    'next_cursor': next_cursor
                 }))
 
             # --- Action: Get Room Messages ---
@@ -161,15 +154,16 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
                 client_id = data.get('client_id')
                 limit = data.get('limit', 50)
 
-                messages = await self.get_room_messages(
-                    self.target_user, platform, client_id, limit
+                messages, next_cursor = await self.get_room_messages(
+                    self.target_user, platform, client_id, limit, data.get('cursor')
                 )
 
                 await self.send(text_data=json.dumps({
                     'type': 'room_messages',
                     'platform': platform,
                     'client_id': client_id,
-                    'messages': messages
+                    'messages': messages,
+                    'next_cursor': next_cursor
                 }))
 
         except Exception as e:
@@ -195,6 +189,11 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
             'room_id': event.get('room_id')
         }))
 
+    async def chat_messages(self, event):
+        """A batch broadcast from the webhook worker; delivered to the socket one message at a time."""
+        for message in event['messages']:
+            await self.chat_message({**event, 'message': message})
+
     # ----- Database Helper Methods -----
     @database_sync_to_async
     def get_user_from_token(self, token):
@@ -223,41 +222,20 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
         return list(ChatProfile.objects.filter(user=user))
 
     @database_sync_to_async
-    def get_rooms_list(self, user, platform=None):
-        """User এর সব rooms with latest message"""
-        from django.db.models import OuterRef, Subquery
+    def get_rooms_list(self, user, platform=None, limit=None, cursor=None, profile_id=None):
+        """One inbox page of the user's rooms, newest conversation first. Returns (rooms, next_cursor)."""
         profiles = ChatProfile.objects.filter(user=user)
         if platform:
             profiles = profiles.filter(platform=platform)
+        if profile_id:
+            profiles = profiles.filter(profile_id=profile_id)
 
-        rooms_result = []
-        for profile in profiles:
-            last_message_qs = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp')
-            
-            rooms = profile.rooms.select_related('client').annotate(
-                last_msg_text=Subquery(last_message_qs.values('text')[:1]),
-                last_msg_type=Subquery(last_message_qs.values('type')[:1]),
-                last_msg_time=Subquery(last_message_qs.values('timestamp')[:1])
-            )
-            
-            for room in rooms:
-                rooms_result.append({
-                    'room_id': room.id,
-                    'platform': profile.platform,
-                    'profile_id': profile.profile_id,
-                    'client_id': room.client.name if room.client.name else room.client.client_id,
-                    'last_msg': room.last_msg_text,
-                    'timestamp': room.last_msg_time.isoformat() if room.last_msg_time else None,
-                    'type': room.last_msg_type,
-                })
-
-        # Sort by latest message
-        rooms_result.sort(key=lambda x: x['timestamp'] or '0000-00-00', reverse=True)
-        return rooms_result
+        rooms, next_cursor = paginate_rooms(profiles, cursor, limit)
+        return [serialize_room(room) for room in rooms], next_cursor
 
     @database_sync_to_async
-    def get_room_messages(self, user, platform, client_id, limit=50):
-        """Specific room এর messages"""
+    def get_room_messages(self, user, platform, client_id, limit=50, cursor=None):
+        """Specific room এর messages, one page older than `cursor`. Returns (messages, next_cursor)."""
         try:
             profile = ChatProfile.objects.get(
                 user=user, platform=platform
@@ -265,26 +243,20 @@ class GlobalChatConsumer(AsyncWebsocketConsumer):
             client = ChatClient.objects.get(platform=platform, client_id=client_id)
             room = ChatRoom.objects.get(profile=profile, client=client)
 
-            messages = room.messages.order_by('-timestamp')[:limit]
-            messages = reversed(messages)  # Latest last
-
-            return [{
-                'id': msg.id,
-                'type': msg.type,
-                'text': msg.text,
-                'message_id': msg.message_id,
-                'timestamp': msg.timestamp.isoformat(),
-            } for msg in messages]
+            messages, next_cursor = paginate_messages(room.messages.all(), cursor, limit)  # Latest last
+            return [serialize_message(msg) for msg in messages], next_cursor
 
+        except InvalidCursor:
+            raise
         except Exception as e:
             print(f"❌ Get Messages Error: {e}")
-            return []
+            return [], None
 
     @database_sync_to_async
     def send_outgoing_message(self, user, platform, client_id, message_text):
         """Frontend থেকে message পাঠানো (webhook এর send_message call করবে)"""
         try:
-            from ..Chat.views import send_message  # Your existing function
+            from .outbound import send_message
             
             profile = ChatProfile.objects.get(
                 user=user, platform=platform, bot_active=True
@@ -327,6 +299,31 @@ def broadcast_message(profile, client_obj, message_text, message_type, room_id=N
     except Exception as e:
         print(f"❌ Broadcast Error: {e}")
 
+def broadcast_messages(profile, client_obj, message_texts, message_type, room_id=None):
+    """Sends several messages of one room with a single channel-layer call."""
+    if len(message_texts) == 1:
+        return broadcast_message(profile, client_obj, message_texts[0], message_type, room_id)
+    try:
+        channel_layer = get_channel_layer()
+        group_name = f"chat_{profile.platform}_{profile.profile_id}"
+
+        async_to_sync(channel_layer.group_send)(
+            group_name,
+            {
+                'type': 'chat_messages',  # Consumer এর method name
+                'platform': profile.platform,
+                'client_id': client_obj.name if client_obj.name else client_obj.client_id,
+                'messages': message_texts,
+                'message_type': message_type,
+                'timestamp': timezone.now().isoformat(),
+                'room_id': room_id
+            }
+        )
+        print(f"✅ Broadcast Success: {group_name} ({len(message_texts)} messages)")
+
+    except Exception as e:
+        print(f"❌ Broadcast Error: {e}")
+
 class AlertConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Get JWT token from query params
@@ -450,10 +447,11 @@ class TestChatConsumer(AsyncWebsocketConsumer):
 
             if action == 'get_messages':
                 limit = data.get('limit', 50)
-                messages = await self.get_db_messages(self.company, limit)
+                messages, next_cursor = await self.get_db_messages(self.company, limit, data.get('cursor'))
                 await self.send(text_data=json.dumps({
                     "type": "room_messages",
-                    "messages": messages
+                    "messages": messages,
+                    "next_cursor": next_cursor
                 }))
                 return
 
@@ -547,11 +545,11 @@ class TestChatConsumer(AsyncWebsocketConsumer):
         return history
 
     @database_sync_to_async
-    def get_db_messages(self, company, limit=50):
-        messages = TestChat.objects.filter(company=company).order_by('-timestamp')[:limit]
+    def get_db_messages(self, company, limit=50, cursor=None):
+        messages, next_cursor = paginate_messages(TestChat.objects.filter(company=company), cursor, limit)
         return [{
             "id": msg.id,
             "type": msg.type,
             "text": msg.text,
             "timestamp": msg.timestamp.isoformat()
-        } for msg in reversed(messages)]
\ No newline at end of file
+        } for msg in messages], next_cursor
\ No newline at end of file
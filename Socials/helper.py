@@ -8,113 +8,73 @@ from django_redis import get_redis_connection
 from Others.models import Alert
 from Accounts.models import Company
 from Finance.models import Subscriptions, DailyUsage
+from Finance.quota import consume_tokens, consume_daily_message, refund_tokens
+from Finance.entitlements import get_entitlements, invalidate_entitlements
 from .models import ChatProfile, ChatRoom, ChatMessage, ChatClient
+from .outbound import send_message
 
-def send_message(profile: ChatProfile, client_obj: ChatClient, message_text):
+def deactivate_for_token_limit(company_id):
+    """Deactivate Chat Profiles + Send Alert"""
     try:
-        res_data = {}
-        if profile.platform == "whatsapp":
-            url = f"https://graph.facebook.com/v17.0/{profile.profile_id}/messages"
-            headers = {"Authorization": f"Bearer {profile.access_token}", "Content-Type": "application/json"}
-            payload = {
-                "messaging_product": "whatsapp",
-                "to": client_obj.client_id,
-                "type": "text",
-                "text": {"body": message_text},
-            }
-            response = requests.post(url, headers=headers, json=payload)
-            res_data = response.json()
+        # Already deactivated: nothing to update, no repeated alert
+        if not get_entitlements(company_id)["bot_active"]:
+            return
 
-        elif profile.platform == "facebook":
-            url = "https://graph.facebook.com/v19.0/me/messages"
-            params = {"access_token": profile.access_token}
-            payload = {"recipient": {"id": client_obj.client_id}, "message": {"text": message_text}}
-            response = requests.post(url, params=params, json=payload)
-            res_data = response.json()
-
-        elif profile.platform == "instagram":
-            url = f"https://graph.instagram.com/v22.0/me/messages"
-            params = {"access_token": profile.access_token}
-            payload = {
-                "recipient": {"id": client_obj.client_id},
-                "message": {"text": message_text}
-            }
-            response = requests.post(url, params=params, json=payload)
-            res_data = response.json()
-
-        else:
-            raise Exception("Unknown platform")
-
-        # Save outgoing message
-        room, _ = ChatRoom.objects.get_or_create(profile=profile, client=client_obj)
-        ChatMessage.objects.create(
-            room=room,
-            type="outgoing",
-            text=message_text,
-            message_id=res_data.get("message_id") or res_data.get("messages", [{}])[0].get("id"),
-            send_by_bot=True,
+        company = Company.objects.get(id=company_id)
+        
+        # Deactivate Chat Profiles
+        ChatProfile.objects.filter(user=company.user).update(bot_active=False)
+        invalidate_entitlements(company_id)
+        
+        # Send Real-time Alert
+        from .consumers import send_alert
+        send_alert(
+            company, 
+            "Token Limit Reached", 
+            "Your AI tokens have been exhausted. Chat profiles are now inactive.", 
+            type="error"
         )
-        room.last_outgoing_time = timezone.now()
-        room.last_message_time = ''
-        room.save()
+        print(f"⚠️ Tokens exhausted for Company {company_id}. Profiles deactivated.")
+    except Exception as e:
+        print(f"Error handling token exhaustion: {e}")
+
+def reserve_tokens(company_id, count):
+    """
+    Batch version of check_token_count: atomically takes up to `count` tokens and
+    returns how many were granted. Profiles are only deactivated once tokens run out.
+    """
+    try:
+        granted, _ = consume_tokens(company_id, count, mode="partial")
+        if granted is None:
+            print(f"❌ [Debug] No active or unexpired subscription found for Company {company_id}")
+            return 0
+        if granted < count:
+            deactivate_for_token_limit(company_id)
+        return granted
 
-        # Broadcast
-        broadcast_message(profile, client_obj, message_text, 'outgoing',room.id)
-        return res_data
+    except Exception as e:
+        print(f"❌ Error in reserve_tokens: {e}")
+        return 0
 
+def release_tokens(company_id, count):
+    """Returns tokens taken by reserve_tokens for messages that were not stored after all."""
+    try:
+        refund_tokens(company_id, count)
     except Exception as e:
-        print(f"❌ Error sending message: {e}")
-        room, _ = ChatRoom.objects.get_or_create(profile=profile, client=client_obj)
-        ChatMessage.objects.create(room=room, type="outgoing", text=message_text)
-        return {"error": str(e)}
+        print(f"❌ Error in release_tokens: {e}")
 
 def check_token_count(company_id, count):
     """
-    Simplified token count check. Direct database operation without Redis cache.
+    Takes `count` tokens from the company's quota (one atomic Redis call, see Finance.quota).
     """
     try:
-        # 1. Fetch active subscription
-        subscription = Subscriptions.objects.filter(
-            company__id=company_id, 
-            active=True,
-            end__gt=timezone.now()
-        ).first()
-
-        if not subscription:
+        granted, _ = consume_tokens(company_id, count, mode="all")
+        if granted is None:
             print(f"❌ [Debug] No active or unexpired subscription found for Company {company_id}")
-            # Check if any subscription exists at all for debugging
-            any_sub = Subscriptions.objects.filter(company__id=company_id).last()
-            if any_sub:
-                print(f"   - Last Sub ID: {any_sub.id}, Active: {any_sub.active}, End: {any_sub.end}, Now: {timezone.now()}")
             return False
-
-        # 2. Check if tokens are exhausted
-        if subscription.token_count < count:
-            # Logic: Deactivate Chat Profiles + Send Alert
-            try:
-                company = Company.objects.get(id=company_id)
-                
-                # Deactivate Chat Profiles
-                ChatProfile.objects.filter(user=company.user).update(bot_active=False)
-                
-                # Send Real-time Alert
-                from .consumers import send_alert
-                send_alert(
-                    company, 
-                    "Token Limit Reached", 
-                    "Your AI tokens have been exhausted. Chat profiles are now inactive.", 
-                    type="error"
-                )
-                print(f"⚠️ Tokens exhausted for Company {company_id}. Profiles deactivated.")
-            except Exception as e:
-                print(f"Error handling token exhaustion: {e}")
-            
+        if granted < count:
+            deactivate_for_token_limit(company_id)
             return False
-
-        # 3. Deduct tokens and save
-        subscription.token_count -= count
-        subscription.save(update_fields=['token_count'])
-        
         return True
 
     except Exception as e:
@@ -127,40 +87,18 @@ def check_msg_limit(company_id):
     If limit reached, deactivate chat profiles and send alert.
     """
     try:
-        # 1. Fetch active subscription and plan
-        subscription = Subscriptions.objects.filter(
-            company__id=company_id, 
-            active=True,
-            end__gt=timezone.now()
-        ).select_related('plan').first()
+        allowed, count, msg_limit = consume_daily_message(company_id)
 
-        if not subscription or not subscription.plan:
+        if allowed is None:
             print(f"⚠️ No active subscription or plan found for Company {company_id}")
             return False
 
-        plan = subscription.plan
-        msg_limit = plan.msg_limit
-
-        # 2. Get or create daily usage record
-        today = timezone.now().date()
-        usage, created = DailyUsage.objects.get_or_create(
-            company_id=company_id,
-            date=today,
-            defaults={'msg_count': 0}
-        )
-
-        # 3. Check if limit is already reached
-        if usage.msg_count >= msg_limit:
-            # Action: Deactivate & Alert (if not already done, but we'll do it safely)
+        if not allowed:
             deactivate_and_alert_limit(company_id, "Daily Message Limit Reached")
             return False
 
-        # 4. Increment count
-        usage.msg_count += 1
-        usage.save(update_fields=['msg_count'])
-
-        # 5. Check if THIS message hits the limit
-        if usage.msg_count >= msg_limit:
+        # Check if THIS message hits the limit
+        if count >= msg_limit:
             deactivate_and_alert_limit(company_id, "Daily Message Limit Reached")
 
         return True
@@ -174,10 +112,14 @@ def deactivate_and_alert_limit(company_id, reason):
     Deactivates bot for all chat profiles and sends a real-time alert.
     """
     try:
+        if not get_entitlements(company_id)["bot_active"]:
+            return
+
         company = Company.objects.get(id=company_id)
         
         # Deactivate Chat Profiles
         updated_count = ChatProfile.objects.filter(user=company.user).update(bot_active=False)
+        invalidate_entitlements(company_id)
         
         if updated_count > 0:
             # Send alert only if we actually deactivated something or as a reminder
@@ -0,0 +1,687 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.db import transaction
+from django.db.models import Avg, Case, DateTimeField, F, Min, Q, Value, When
+from django.utils import timezone
+import random
+import uuid
+import requests
+from Others.task import schedule_reply
+from Others.rollups import record_message_stats, record_new_clients
+from .models import ChatProfile, ChatClient, ChatRoom, ChatMessage, InboundEvent
+from .consumers import broadcast_messages
+from .helper import release_tokens, reserve_tokens
+from .profile_routing import resolve_profiles, schedule_profile_reconciliation
+
+INBOUND_PLATFORMS = ("whatsapp", "facebook", "instagram")
+INBOUND_LOCK_TTL = 60 * 5  # a crashed worker's partition is picked up again after 5 minutes
+INBOUND_MAX_ATTEMPTS = 5
+INBOUND_BASE_BACKOFF = 30  # seconds, doubled per attempt
+INBOUND_MAX_BACKOFF = 60 * 30  # 30 minutes
+INBOUND_BATCH_SIZE = 100
+INBOUND_DEDUP_TTL = 60 * 60 * 48  # Meta keeps redelivering failed webhooks for up to ~36 hours
+SENDER_NAME_CACHE_TTL = 60 * 60 * 24 * 7  # 7 days
+SENDER_NAME_NEGATIVE_TTL = 60 * 60  # 1 hour
+SENDER_NAME_REFRESH_LOCK_TTL = 60 * 5  # 5 minutes
+
+#---------------------------------------------
+# DURABLE INBOUND QUEUE
+#---------------------------------------------
+
+def get_partition_key(platform, data):
+    """All events of one business account share a key, so its rooms see messages in order."""
+    entry = data.get("entry") or []
+    account_id = entry[0].get("id") if entry and isinstance(entry[0], dict) else None
+    return f"{platform}:{account_id}" if account_id else platform
+
+
+def enqueue_inbound_event(platform, data):
+    return InboundEvent.objects.create(
+        platform=platform,
+        partition_key=get_partition_key(platform, data),
+        payload=data
+    )
+
+
+def get_partition_lock_key(partition_key):
+    return f"inbound_lock_{partition_key}"
+
+
+def get_inbound_backoff(attempts):
+    backoff = min(INBOUND_MAX_BACKOFF, INBOUND_BASE_BACKOFF * 2 ** (attempts - 1))
+    return backoff + random.uniform(0, backoff / 2)  # jitter, so failed partitions don't retry in lockstep
+
+
+def schedule_inbound_drain(partition_key, countdown=0):
+    from .tasks import process_inbound_events
+    try:
+        process_inbound_events.apply_async((partition_key,), countdown=countdown)
+    except Exception as e:
+        # requeue_stalled_inbound_events picks the partition up once it is due
+        print(f"⚠️ Could not queue inbound drain for {partition_key}: {e}")
+
+
+def process_inbound_event(event):
+    """
+    Applies a stored event. A multi-entry payload is applied as one batch; if that fails it
+    is applied entry by entry, so one bad entry (e.g. an unrouted account) doesn't hold back
+    the others. The entries that still fail are kept as the event's payload for the retry.
+    """
+    entries = event.payload.get("entry") or []
+    try:
+        return process_webhook_event(event.platform, event.payload, event.id)
+    except Exception:
+        if len(entries) < 2:
+            raise
+
+    results, failed, error = [], [], None
+    for entry in entries:
+        try:
+            results.append(process_webhook_event(event.platform, {**event.payload, "entry": [entry]}, event.id))
+        except Exception as e:
+            failed.append(entry)
+            error = error or e
+    if failed:
+        print(f"⚠️ Inbound event {event.id}: {len(entries) - len(failed)}/{len(entries)} entries applied, {len(failed)} kept for retry")
+        event.payload = {**event.payload, "entry": failed}
+        event.save(update_fields=["payload"])
+        raise error
+    return ",".join(sorted(set(results)))[:100]
+
+
+def drain_inbound_partition(partition_key):
+    """
+    Processes the partition's pending events in arrival order.
+    Only one worker drains a partition at a time. A failing event stops the drain so later
+    events don't overtake it; it is retried with exponential backoff (next_attempt_at) until
+    INBOUND_MAX_ATTEMPTS, and drains started before then leave the partition alone.
+    Returns (processed_count, needs_requeue).
+    """
+    lock_key = get_partition_lock_key(partition_key)
+    if not cache.add(lock_key, 1, timeout=INBOUND_LOCK_TTL):
+        return 0, False
+
+    processed = 0
+    try:
+        while True:
+            events = list(
+                InboundEvent.objects.filter(partition_key=partition_key, status="pending").order_by("id")[:INBOUND_BATCH_SIZE]
+            )
+            if not events:
+                break
+            for event in events:
+                if event.next_attempt_at and event.next_attempt_at > timezone.now():
+                    # Backing off; its scheduled drain (or the sweeper) resumes the partition
+                    return processed, False
+
+                event.attempts += 1
+                try:
+                    event.result = process_inbound_event(event)
+                    event.status = "done"
+                    event.error = None
+                    event.next_attempt_at = None
+                except Exception as e:
+                    import traceback
+                    event.error = traceback.format_exc()
+                    if event.attempts >= INBOUND_MAX_ATTEMPTS:
+                        event.status = "failed"
+                        print(f"❌ Inbound event {event.id} ({partition_key}) failed for good: {e}")
+                    else:
+                        retry_in = get_inbound_backoff(event.attempts)
+                        event.next_attempt_at = timezone.now() + timezone.timedelta(seconds=retry_in)
+                        print(f"🔁 Inbound event {event.id} ({partition_key}) failed ({e}), retry {event.attempts} in {retry_in:.0f}s")
+                        schedule_inbound_drain(partition_key, countdown=retry_in)
+                    event.processed_at = timezone.now()
+                    event.save(update_fields=["attempts", "status", "error", "next_attempt_at", "processed_at"])
+                    return processed, False
+
+                event.processed_at = timezone.now()
+                event.save(update_fields=["attempts", "status", "result", "error", "next_attempt_at", "processed_at"])
+                processed += 1
+    finally:
+        cache.delete(lock_key)
+
+    # Events that arrived while we held the lock were not picked up by their own task
+    needs_requeue = InboundEvent.objects.filter(partition_key=partition_key, status="pending").exists()
+    return processed, needs_requeue
+
+
+def get_stalled_partitions(older_than_seconds=30):
+    """Partitions with due pending events nobody picked up (lost task, crashed worker, failed attempt)."""
+    now = timezone.now()
+    cutoff = now - timezone.timedelta(seconds=older_than_seconds)
+    return list(
+        InboundEvent.objects.filter(status="pending", received_at__lt=cutoff)
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+        .values_list("partition_key", flat=True).distinct()
+    )
+
+
+def get_inbound_queue_stats():
+    """Queue depth and lag, for monitoring."""
+    now = timezone.now()
+    pending = InboundEvent.objects.filter(status="pending")
+    oldest_pending = pending.aggregate(oldest=Min("received_at"))["oldest"]
+    recent_lag = InboundEvent.objects.filter(
+        status="done", processed_at__gte=now - timezone.timedelta(minutes=5)
+    ).aggregate(lag=Avg(F("processed_at") - F("received_at")))["lag"]
+
+    return {
+        "pending": pending.count(),
+        "retrying": pending.filter(next_attempt_at__gt=now).count(),
+        "failed": InboundEvent.objects.filter(status="failed").count(),
+        "pending_partitions": pending.values("partition_key").distinct().count(),
+        "oldest_pending_age_seconds": (now - oldest_pending).total_seconds() if oldest_pending else 0,
+        "avg_lag_seconds_5m": recent_lag.total_seconds() if recent_lag else 0,
+    }
+
+#---------------------------------------------
+# DEDUPLICATION
+#---------------------------------------------
+
+def get_dedup_key(platform, message_id):
+    return f"inbound_msg_{platform}_{message_id}"
+
+
+def claim_message_ids(platform, incoming, owner=None):
+    """
+    SETNX every platform message id in one Redis round-trip and drops the messages whose id
+    was already claimed (redelivery, or a duplicate inside the same payload).
+    The key holds `owner` (the InboundEvent id): an id claimed by the same event counts as
+    free, so a retry after a worker died between claim and commit isn't dropped; the DB
+    check in persist_incoming_messages still catches what that attempt did store.
+    Returns (fresh_messages, claimed_keys). Falls back to the DB constraint if Redis is down.
+    """
+    keyed = [msg for msg in incoming if msg["message_id"]]
+    if not keyed:
+        return incoming, []
+
+    value = str(owner) if owner is not None else uuid.uuid4().hex
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline(transaction=False)
+        for msg in keyed:
+            key = get_dedup_key(platform, msg["message_id"])
+            pipe.set(key, value, nx=True, ex=INBOUND_DEDUP_TTL)
+            pipe.get(key)
+        replies = pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Inbound dedup pre-check unavailable: {e}")
+        return incoming, []
+
+    claimed, duplicates, seen = [], set(), set()
+    for msg, ok, holder in zip(keyed, replies[::2], replies[1::2]):
+        if isinstance(holder, bytes):
+            holder = holder.decode()
+        # `seen`: the same id twice in one payload is still a duplicate
+        if msg["message_id"] in seen or not (ok or holder == value):
+            duplicates.add(id(msg))
+            continue
+        seen.add(msg["message_id"])
+        claimed.append(get_dedup_key(platform, msg["message_id"]))
+    if duplicates:
+        print(f"♻️ [{platform}] Dropped {len(duplicates)} redelivered messages")
+    return [msg for msg in incoming if id(msg) not in duplicates], claimed
+
+
+def release_message_ids(claimed_keys):
+    """Lets a failed event be retried without its messages being treated as duplicates."""
+    if not claimed_keys:
+        return
+    try:
+        get_redis_connection("default").delete(*claimed_keys)
+    except Exception as e:
+        print(f"⚠️ Could not release inbound dedup keys: {e}")
+
+#---------------------------------------------
+# EVENT PROCESSING
+#---------------------------------------------
+
+class UnroutedEvent(Exception):
+    """The event's account isn't in the routing index yet; the event stays queued for a retry."""
+
+
+def incoming_message(profile, client_id, text, message_id=None, name="Unknown"):
+    return {"profile": profile, "client_id": client_id, "text": text, "message_id": message_id, "name": name}
+
+
+def get_active_profiles(platform, profile_ids):
+    return {
+        alias: profile
+        for alias, profile in resolve_profiles(platform, profile_ids).items()
+        if profile.bot_active
+    }
+
+
+def parse_whatsapp_event(data):
+    """Every message of every change of every entry."""
+    values = [
+        change.get("value", {})
+        for entry in data.get("entry", []) or []
+        for change in entry.get("changes", []) or []
+    ]
+    profiles = get_active_profiles(
+        "whatsapp", [value.get("metadata", {}).get("phone_number_id") for value in values]
+    )
+
+    incoming = []
+    for value in values:
+        profile_id = value.get("metadata", {}).get("phone_number_id")
+        profile = profiles.get(profile_id)
+        if not profile:
+            print(f"❌ [WhatsApp] No active profile found for {profile_id}")
+            continue
+
+        names = {
+            contact.get("wa_id"): contact.get("profile", {}).get("name")
+            for contact in value.get("contacts", []) or []
+        }
+        for msg in value.get("messages", []) or []:
+            client_id = msg.get("from")
+            incoming.append(incoming_message(
+                profile, client_id, msg.get("text", {}).get("body", ""),
+                message_id=msg.get("id"), name=names.get(client_id) or "Unknown"
+            ))
+    return incoming
+
+
+def parse_facebook_event(data):
+    """Every messaging event of every entry."""
+    entries = data.get("entry", []) or []
+    profiles = get_active_profiles("facebook", [entry.get("id") for entry in entries])
+
+    incoming = []
+    for entry in entries:
+        profile = profiles.get(entry.get("id"))
+        if not profile:
+            print(f"❌ [Facebook] No active profile found for {entry.get('id')}")
+            continue
+
+        for msg_event in entry.get("messaging", []) or []:
+            message_obj = msg_event.get("message", {})
+            if message_obj.get("is_echo"):
+                continue
+            incoming.append(incoming_message(
+                profile, msg_event.get("sender", {}).get("id"), message_obj.get("text", ""),
+                message_id=message_obj.get("mid")
+            ))
+    return incoming
+
+
+def parse_instagram_event(data):
+    """Every messaging event (or comment/mention change) of every entry."""
+    entries = data.get("entry", []) or []
+    # Identify the profiles — check ALL profiles (bot_active or not)
+    profiles = resolve_profiles("instagram", [str(entry.get("id")) for entry in entries])
+
+    incoming = []
+    for entry in entries:
+        profile_id = str(entry.get("id"))
+        profile = profiles.get(profile_id)
+        if not profile:
+            # Webhook ids can differ from the id stored at connect time: the reconcile re-fetches
+            # the accounts' aliases, and the queue retries this event (with backoff) once they route
+            print(f"🔍 [Instagram] Entry ID {profile_id} not in routing index. Scheduling reconciliation...")
+            schedule_profile_reconciliation("instagram")
+            raise UnroutedEvent(f"Instagram account {profile_id} is not routed to a profile yet")
+        if not profile.bot_active:
+            print(f"⚠️ [Instagram] Profile found but bot_active=False: {profile.name}. Skipping.")
+            continue
+
+        messaging = entry.get("messaging", []) or []
+        for msg_event in messaging:
+            message_obj = msg_event.get("message", {})
+            if message_obj.get("is_echo"):
+                continue
+            incoming.append(incoming_message(
+                profile, str(msg_event.get("sender", {}).get("id")), message_obj.get("text", ""),
+                message_id=message_obj.get("mid")
+            ))
+        if not messaging:
+            for change in entry.get("changes", []) or []:
+                value = change.get("value", {})
+                incoming.append(incoming_message(
+                    profile, str(value.get("from", {}).get("id")), value.get("message") or value.get("text", ""),
+                    message_id=value.get("id")
+                ))
+
+    # Final safety check (Bot talking to Bot)
+    own_ids = set(resolve_profiles("instagram", {msg["client_id"] for msg in incoming}))
+    return [msg for msg in incoming if msg["client_id"] not in own_ids]
+
+
+def get_sender_name_cache_key(platform, client_id):
+    return f"sender_name_{platform}_{client_id}"
+
+
+def get_cached_sender_names(platform, incoming, clients, skip=()):
+    """
+    Names for senders without one in the payload, without calling the Graph API.
+    Known senders keep their stored ChatClient.name; a missing/expired cache entry (or a new
+    sender) queues refresh_sender_name_task, which fills in the name off the critical path.
+    The task is queued on commit, once the batch's new ChatClient rows exist.
+    Returns {client_id: name} for names that are already known from the cache.
+    """
+    if platform not in ("facebook", "instagram"):
+        return {}
+
+    profiles = {}
+    for msg in incoming:
+        if msg["client_id"] not in skip:
+            profiles.setdefault(msg["client_id"], msg["profile"])
+    if not profiles:
+        return {}
+
+    keys = {cid: get_sender_name_cache_key(platform, cid) for cid in profiles}
+    cached = cache.get_many(list(keys.values()))
+
+    names = {}
+    for cid, profile in profiles.items():
+        name = cached.get(keys[cid])
+        if name is not None:
+            if name != "Unknown" and cid not in clients:
+                names[cid] = name
+            continue
+        # One refresh per sender at a time, however many messages arrive meanwhile
+        if cache.add(f"{keys[cid]}_refresh", 1, timeout=SENDER_NAME_REFRESH_LOCK_TTL):
+            transaction.on_commit(
+                lambda cid=cid, profile_id=profile.id: queue_sender_name_refresh(platform, profile_id, cid)
+            )
+    return names
+
+
+def queue_sender_name_refresh(platform, profile_id, client_id):
+    from .tasks import refresh_sender_name_task
+    try:
+        refresh_sender_name_task.delay(platform, profile_id, client_id)
+    except Exception as e:
+        print(f"⚠️ [{platform}] Could not queue sender name refresh for {client_id}: {e}")
+
+
+def refresh_sender_name(platform, profile_id, client_id):
+    """Fetches the sender's name from the Graph API and stores it on the ChatClient and in the cache."""
+    key = get_sender_name_cache_key(platform, client_id)
+    try:
+        profile = ChatProfile.objects.filter(id=profile_id).first()
+        name = fetch_sender_name(platform, profile, client_id) if profile else "Unknown"
+        if name and name != "Unknown":
+            # Only cached once stored: later batches skip senders with a cached name
+            if ChatClient.objects.filter(platform=platform, client_id=client_id).update(name=name):
+                cache.set(key, name, timeout=SENDER_NAME_CACHE_TTL)
+        else:
+            # Don't hammer the Graph API for senders it won't resolve
+            cache.set(key, "Unknown", timeout=SENDER_NAME_NEGATIVE_TTL)
+        return name
+    finally:
+        cache.delete(f"{key}_refresh")
+
+
+def fetch_sender_name(platform, profile, client_id):
+    try:
+        if platform == "facebook":
+            user_url = f"https://graph.facebook.com/{client_id}?fields=first_name,last_name,name&access_token={profile.access_token}"
+            user_res = requests.get(user_url, timeout=5)
+            if user_res.status_code == 200:
+                user_data = user_res.json()
+                return user_data.get("name") or f"{user_data.get('first_name','')} {user_data.get('last_name','')}"
+        elif platform == "instagram":
+            user_url = f"https://graph.instagram.com/{client_id}?fields=username&access_token={profile.access_token}"
+            user_res = requests.get(user_url, timeout=5)
+            if user_res.status_code == 200:
+                return user_res.json().get("username", "Instagram User")
+    except Exception as e:
+        print(f"⚠️ [{platform}] Error fetching sender name for {client_id}: {e}")
+    return "Unknown"
+
+
+PARSERS = {
+    "whatsapp": parse_whatsapp_event,
+    "facebook": parse_facebook_event,
+    "instagram": parse_instagram_event,
+}
+
+
+def process_webhook_event(platform, data, owner=None):
+    """
+    Applies one webhook payload. Meta batches several entries / messages into one POST,
+    so everything is parsed first and then written with bulk queries: one lookup per
+    model, one bulk_create for the messages and one broadcast per room.
+    `owner` (the InboundEvent id) marks the message ids this event claims.
+    Returns a short status string.
+    """
+    parser = PARSERS.get(platform)
+    if not parser:
+        return "unknown_platform"
+
+    #---------------------------------------------
+    # VALIDATION
+    #---------------------------------------------
+    incoming = []
+    for msg in parser(data):
+        if not msg["client_id"] or not msg["text"]:
+            print(f"⚠️ Validation Failed: client_id={msg['client_id']}, text_len={len(msg['text']) if msg['text'] else 0}")
+            continue
+        if msg["client_id"] == msg["profile"].profile_id:
+            continue
+        incoming.append(msg)
+    if not incoming:
+        return "no_messages"
+
+    incoming, claimed_keys = claim_message_ids(platform, incoming, owner)
+    if not incoming:
+        return "duplicate"
+
+    try:
+        return store_incoming_messages(platform, incoming)
+    except Exception:
+        release_message_ids(claimed_keys)
+        raise
+
+
+def record_new_rooms(incoming, new_room_profile_ids):
+    """Counts the conversations opened by this batch in the daily rollups (one per new room)."""
+    profiles = {msg["profile"].id: msg["profile"] for msg in incoming}
+    counts = {}
+    for profile_id in new_room_profile_ids:
+        profile = profiles[profile_id]
+        key = (profile.user.company.id, profile.platform)
+        counts[key] = counts.get(key, 0) + 1
+    for (company_id, platform), count in counts.items():
+        record_new_clients(company_id, platform, count)
+
+
+def record_incoming_stats(incoming, new_messages):
+    """Counts a stored batch in the daily rollups; `new_messages` lines up with `incoming`."""
+    by_key = {}
+    for msg, message in zip(incoming, new_messages):
+        by_key.setdefault((msg["profile"].user.company.id, msg["profile"].platform), []).append(message)
+    for (company_id, platform), messages in by_key.items():
+        record_message_stats(company_id, platform, messages)
+
+
+def record_last_messages(messages):
+    """Denormalises each room's newest message onto ChatRoom with one UPDATE for the whole batch."""
+    latest = {}
+    for message in messages:
+        if message.room_id not in latest or message.timestamp >= latest[message.room_id].timestamp:
+            latest[message.room_id] = message
+    if not latest:
+        return
+
+    # Skip rooms that already recorded a newer message (e.g. a reply sent meanwhile)
+    newer_or_unset = Q()
+    for room_id, m in latest.items():
+        newer_or_unset |= Q(id=room_id) & (Q(last_message_at__isnull=True) | Q(last_message_at__lte=m.timestamp))
+
+    ChatRoom.objects.filter(newer_or_unset).update(
+        last_message_text=Case(*[When(id=room_id, then=Value(m.text)) for room_id, m in latest.items()]),
+        last_message_type=Case(*[When(id=room_id, then=Value(m.type)) for room_id, m in latest.items()]),
+        last_message_at=Case(
+            *[When(id=room_id, then=Value(m.timestamp)) for room_id, m in latest.items()],
+            output_field=DateTimeField()
+        ),
+    )
+
+
+def store_incoming_messages(platform, incoming):
+    """
+    Stores a validated batch in one transaction. Broadcasts and reply scheduling run on
+    commit, so a batch that fails (and is retried) never announces messages it didn't store.
+    Tokens and stats only count the messages this call actually inserted.
+    """
+    reserved = {}
+    try:
+        with transaction.atomic():
+            return persist_incoming_messages(platform, incoming, reserved)
+    except Exception:
+        # Rolled back: nothing was stored, so nothing is billed
+        for company_id, count in reserved.items():
+            release_tokens(company_id, count)
+        raise
+
+
+def persist_incoming_messages(platform, incoming, reserved):
+    #---------------------------------------------
+    # UNIFIED CHAT HANDLING
+    #---------------------------------------------
+    # Clients
+    client_ids = {msg["client_id"] for msg in incoming}
+    clients = {c.client_id: c for c in ChatClient.objects.filter(platform=platform, client_id__in=client_ids)}
+
+    names = {}
+    for msg in incoming:
+        if msg["name"] != "Unknown":
+            names[msg["client_id"]] = msg["name"]
+    # Senders whose payload carries no name (Messenger / Instagram) are resolved in the background
+    names.update(get_cached_sender_names(platform, incoming, clients, skip=set(names)))
+
+    missing = client_ids - set(clients)
+    if missing:
+        ChatClient.objects.bulk_create(
+            [ChatClient(platform=platform, client_id=cid, name=names.get(cid, "Unknown")) for cid in missing],
+            ignore_conflicts=True
+        )
+        clients.update({c.client_id: c for c in ChatClient.objects.filter(platform=platform, client_id__in=missing)})
+
+    renamed = []
+    for cid, name in names.items():
+        client_obj = clients[cid]
+        if name != "Unknown" and client_obj.name != name:
+            client_obj.name = name
+            renamed.append(client_obj)
+    if renamed:
+        ChatClient.objects.bulk_update(renamed, ["name"])
+
+    # Rooms
+    pairs = {(msg["profile"].id, clients[msg["client_id"]].id) for msg in incoming}
+    profile_ids = {p for p, _ in pairs}
+    room_client_ids = {c for _, c in pairs}
+
+    def load_rooms():
+        return {
+            (room.profile_id, room.client_id): room
+            for room in ChatRoom.objects.filter(profile_id__in=profile_ids, client_id__in=room_client_ids)
+            if (room.profile_id, room.client_id) in pairs
+        }
+
+    rooms = load_rooms()
+    if len(rooms) < len(pairs):
+        # get_or_create rather than bulk_create(ignore_conflicts): a room opened concurrently
+        # by another delivery is found, not counted a second time
+        created_profile_ids = []
+        for profile_id, client_id in pairs - set(rooms):
+            room, created = ChatRoom.objects.get_or_create(profile_id=profile_id, client_id=client_id)
+            rooms[(profile_id, client_id)] = room
+            if created:
+                created_profile_ids.append(profile_id)
+        record_new_rooms(incoming, created_profile_ids)
+
+    def get_room(msg):
+        return rooms[(msg["profile"].id, clients[msg["client_id"]].id)]
+
+    # Held until commit: a concurrent delivery of the same messages to these rooms waits
+    # here and then finds them stored
+    list(ChatRoom.objects.select_for_update().filter(
+        id__in=[room.id for room in rooms.values()]
+    ).order_by("id").values_list("id", flat=True))
+
+    # Second line of defence behind the Redis pre-check (e.g. keys expired, Redis flushed),
+    # checked before billing so a redelivery never costs tokens
+    message_ids = [msg["message_id"] for msg in incoming if msg["message_id"]]
+    stored_ids = set(ChatMessage.objects.filter(
+        room__in=list(rooms.values()), message_id__in=message_ids
+    ).values_list("room_id", "message_id"))
+    incoming = [msg for msg in incoming if (get_room(msg).id, msg["message_id"]) not in stored_ids]
+    if not incoming:
+        return "duplicate"
+
+    # Token count check, one reservation per company
+    by_company = {}
+    for msg in incoming:
+        by_company.setdefault(msg["profile"].user.company.id, []).append(msg)
+    incoming = []
+    for company_id, msgs in by_company.items():
+        granted = reserve_tokens(company_id, len(msgs))
+        reserved[company_id] = granted
+        if granted < len(msgs):
+            print(f"❌ Token limit reached for Company {company_id}: dropped {len(msgs) - granted} messages")
+        incoming.extend(msgs[:granted])
+    if not incoming:
+        return "token_limit"
+
+    new_messages = [
+        ChatMessage(room=get_room(msg), type="incoming", text=msg["text"], message_id=msg["message_id"])
+        for msg in incoming
+    ]
+    ChatMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+
+    # Only rows that are new since the check count; anything the constraint skipped gives
+    # its token back. Messages without a platform id can't conflict.
+    inserted_ids = set(ChatMessage.objects.filter(
+        room__in=list(rooms.values()), message_id__in=[msg["message_id"] for msg in incoming if msg["message_id"]]
+    ).values_list("room_id", "message_id")) - stored_ids
+    kept, skipped = [], {}
+    for msg, message in zip(incoming, new_messages):
+        if not msg["message_id"] or (message.room_id, msg["message_id"]) in inserted_ids:
+            kept.append((msg, message))
+        else:
+            company_id = msg["profile"].user.company.id
+            skipped[company_id] = skipped.get(company_id, 0) + 1
+    for company_id, count in skipped.items():
+        release_tokens(company_id, count)
+        reserved[company_id] -= count
+    if not kept:
+        return "duplicate"
+    incoming = [msg for msg, _ in kept]
+    new_messages = [message for _, message in kept]
+
+    record_incoming_stats(incoming, new_messages)
+
+    now = timezone.now()
+    room_messages = {}
+    for msg in incoming:
+        room = get_room(msg)
+        room_messages.setdefault(room.id, (room, msg["profile"], clients[msg["client_id"]], []))[3].append(msg["text"])
+    ChatRoom.objects.filter(id__in=list(room_messages)).update(last_incoming_time=now)
+    record_last_messages(new_messages)
+
+    reply_room_ids = [
+        room_id for room_id, (room, profile, _, _) in room_messages.items()
+        if profile.bot_active and room.bot_active
+    ]
+    if reply_room_ids:
+        # Every burst pushes the room's reply deadline; only the latest scheduled task replies
+        ChatRoom.objects.filter(id__in=reply_room_ids).update(is_waiting_reply=True)
+
+    # Side effects only once the batch is committed; each one is independent and safe to
+    # repeat (a broadcast is a UI refresh, schedule_reply only pushes the reply deadline)
+    for room_id, (room, profile, client_obj, texts) in room_messages.items():
+        transaction.on_commit(
+            lambda profile=profile, client_obj=client_obj, texts=texts, room_id=room_id:
+                broadcast_messages(profile, client_obj, texts, "incoming", room_id),
+            robust=True
+        )
+    for room_id in reply_room_ids:
+        transaction.on_commit(lambda room_id=room_id: schedule_reply(room_id), robust=True)
+
+    return f"received:{len(new_messages)}"
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from Socials.models import ChatRoom, ChatMessage
+
+
+class Command(BaseCommand):
+    help = "Fill ChatRoom.last_message_* from the newest ChatMessage of each room (run once after deploying the fields)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Recompute every room, not only rooms without a last message")
+
+    def handle(self, *args, **options):
+        latest = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+        rooms = ChatRoom.objects.all()
+        if not options["all"]:
+            rooms = rooms.filter(last_message_at__isnull=True)
+
+        updated = rooms.update(
+            last_message_text=Subquery(latest.values('text')[:1]),
+            last_message_type=Subquery(latest.values('type')[:1]),
+            last_message_at=Subquery(latest.values('timestamp')[:1]),
+        )
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} rooms"))
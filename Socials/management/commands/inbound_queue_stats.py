@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from Socials.inbound import get_inbound_queue_stats, get_stalled_partitions
+from Socials.tasks import process_inbound_events
+
+
+class Command(BaseCommand):
+    help = "Show inbound webhook queue depth and lag, optionally requeueing stalled partitions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requeue", action="store_true", help="Queue a drain for every stalled partition")
+
+    def handle(self, *args, **options):
+        for key, value in get_inbound_queue_stats().items():
+            self.stdout.write(f"{key}: {value}")
+
+        if options["requeue"]:
+            partitions = get_stalled_partitions(older_than_seconds=0)
+            for partition_key in partitions:
+                process_inbound_events.delay(partition_key)
+            self.stdout.write(self.style.SUCCESS(f"Requeued {len(partitions)} partitions"))
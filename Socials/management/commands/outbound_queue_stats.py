@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from Socials.outbound import get_outbound_queue_stats, get_stalled_outbound_messages, resend_outbound_message, schedule_outbound_delivery
+
+
+class Command(BaseCommand):
+    help = "Show outbound send queue depth and throttle counters per profile, optionally requeueing stalled sends."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requeue", action="store_true", help="Queue a delivery for every stalled outbox row")
+        parser.add_argument(
+            "--resend", type=int, action="append", metavar="OUTBOX_ID",
+            help="Resend an 'unknown' outbox row after checking the customer didn't receive it"
+        )
+
+    def handle(self, *args, **options):
+        stats = get_outbound_queue_stats()
+        if not stats:
+            self.stdout.write("No queued sends or send metrics")
+        for profile_id, values in sorted(stats.items()):
+            details = ", ".join(f"{key}={value}" for key, value in values.items())
+            self.stdout.write(f"profile {profile_id}: {details}")
+
+        if options["requeue"]:
+            stalled = get_stalled_outbound_messages()
+            for outbox_id, priority in stalled:
+                schedule_outbound_delivery(outbox_id, priority=priority)
+            self.stdout.write(self.style.SUCCESS(f"Requeued {len(stalled)} outbound messages"))
+
+        for outbox_id in options["resend"] or []:
+            if resend_outbound_message(outbox_id):
+                self.stdout.write(self.style.SUCCESS(f"Requeued outbox row {outbox_id}"))
+            else:
+                self.stdout.write(self.style.ERROR(f"Outbox row {outbox_id} is not 'unknown'"))
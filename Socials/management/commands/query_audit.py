@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from Accounts.models import Company
+from Socials.models import ChatRoom
+from Socials.query_budget import FULL_SCAN_MIN_ROWS, HOT_PATHS, QueryBudgetExceeded, query_budget
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the hot chat paths for a company and fail when one exceeds its query budget "
+        "or (PostgreSQL) sequentially scans a hot table of at least --min-rows rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", type=int, help="Company id (default: the company of the most recently active room)")
+        parser.add_argument("--path", action="append", choices=sorted(HOT_PATHS), help="Only audit these paths")
+        parser.add_argument(
+            "--min-rows", type=int, default=FULL_SCAN_MIN_ROWS,
+            help=f"Only check the plans of tables at least this big (default {FULL_SCAN_MIN_ROWS})"
+        )
+
+    def handle(self, *args, **options):
+        if options["company"]:
+            company = Company.objects.filter(id=options["company"]).select_related("user").first()
+        else:
+            room = ChatRoom.objects.order_by(F("last_message_at").desc(nulls_last=True)).select_related("profile__user__company").first()
+            company = getattr(room.profile.user, "company", None) if room else None
+        if not company:
+            raise CommandError("No company to audit")
+
+        room = ChatRoom.objects.filter(profile__user=company.user).order_by(F("last_message_at").desc(nulls_last=True)).first()
+        if not room:
+            raise CommandError(f"Company {company.id} has no chat rooms")
+        context = {"company": company, "user": company.user, "room": room}
+
+        failures = 0
+        for name in options["path"] or HOT_PATHS:
+            budget, runner = HOT_PATHS[name]
+            try:
+                # Read-only by intent; rolled back anyway so an audit never changes data
+                with transaction.atomic():
+                    with query_budget(budget, label=name, min_rows=options["min_rows"]) as captured:
+                        runner(context)
+                    transaction.set_rollback(True)
+                self.stdout.write(self.style.SUCCESS(f"✔ {name}: {len(captured)}/{budget} queries"))
+            except QueryBudgetExceeded as e:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f"✘ {e}"))
+
+        if failures:
+            raise CommandError(f"{failures} hot path(s) over budget")
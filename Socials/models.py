@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from encrypted_model_fields.fields import EncryptedCharField
 
@@ -11,6 +12,13 @@ MESSAGE_TYPE = [
     ('outgoing', 'Outgoing'),
 ]
 
+DELIVERY_STATUS = [
+    ('pending', 'Pending'),
+    ('sent', 'Sent'),
+    ('failed', 'Failed'),
+    ('unknown', 'Unknown'),
+]
+
 
 class ChatProfile(models.Model):
     PLATFORM_CHOICES = [
@@ -25,6 +33,7 @@ class ChatProfile(models.Model):
     # Generic IDs
     name = models.CharField(max_length=150, blank=True, null=True)
     profile_id = models.CharField(max_length=150, unique=True)   # e.g. number_id, page_id, instagram_id
+    aliases = models.JSONField(default=list, blank=True)   # other ids / username webhooks may use for this account
     access_token = EncryptedCharField(max_length=5000)
     bot_active = models.BooleanField(default=False)
     is_approved = models.BooleanField(default=False)
@@ -64,15 +73,30 @@ class ChatRoom(models.Model):
     last_outgoing_time  = models.DateTimeField(null=True, blank=True)
     last_incoming_time  = models.DateTimeField(null=True, blank=True)
     is_waiting_reply = models.BooleanField(default=False)
+    # Latest message, kept in sync on insert so the inbox is a single indexed query
+    last_message_text = models.TextField(blank=True, null=True)
+    last_message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE, blank=True, null=True)
+    last_message_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         verbose_name = "Chat Room"
         verbose_name_plural = "Chat Rooms"
         unique_together = ('profile', 'client')
+        indexes = [
+            models.Index(fields=['profile', '-last_message_at'], name='chatroom_profile_last_msg_idx'),
+        ]
 
     def __str__(self):
         return f"{self.profile.platform} Room: {self.profile.profile_id} ↔ {self.client.client_id}"
 
+    @staticmethod
+    def record_last_message(room_id, text, message_type, timestamp, **extra):
+        """Stores a room's latest message unless a newer one is already recorded."""
+        return ChatRoom.objects.filter(
+            models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=timestamp),
+            id=room_id
+        ).update(last_message_text=text, last_message_type=message_type, last_message_at=timestamp, **extra)
+
 
 class ChatMessage(models.Model):
     room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
@@ -82,16 +106,108 @@ class ChatMessage(models.Model):
     message_id = models.CharField(max_length=150, blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     send_by_bot = models.BooleanField(default=False)
+    # Outgoing messages only: tracks the OutboundMessage delivering it to the platform
+    delivery_status = models.CharField(max_length=10, choices=DELIVERY_STATUS, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         verbose_name = "Chat Message"
         verbose_name_plural = "Chat Messages"
+        constraints = [
+            # Meta redelivers webhooks; a platform message id is stored once per room (NULLs don't collide)
+            models.UniqueConstraint(fields=['room', 'message_id'], name='unique_room_message_id'),
+        ]
+        indexes = [
+            # History, pagination, AI context and cleanup: a room's messages newest first
+            models.Index(fields=['room', '-timestamp', '-id'], name='chatmsg_room_ts_idx'),
+            # wait_and_reply: a room's incoming messages still waiting for a reply (a small slice of the table)
+            models.Index(
+                fields=['room', 'created_at'], name='chatmsg_room_unprocessed_idx',
+                condition=models.Q(type='incoming', processed=False)
+            ),
+            # Platform-wide sent / received counts in the admin dashboard
+            models.Index(fields=['type', 'created_at'], name='chatmsg_type_created_idx'),
+        ]
 
     def __str__(self):
         return f"[{self.room.profile.platform}] {self.type} - {self.timestamp}"
 
 
+class InboundEvent(models.Model):
+    """
+    Raw webhook payload, persisted by unified_webhook before it ACKs Meta and
+    processed later by Socials.tasks.process_inbound_events.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    platform = models.CharField(max_length=20, choices=ChatProfile.PLATFORM_CHOICES)
+    # Events sharing a key (platform + business account id) are processed in arrival order
+    partition_key = models.CharField(max_length=200)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    result = models.CharField(max_length=100, blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    # Set after a failed attempt; the partition isn't drained again before then
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Inbound Event"
+        verbose_name_plural = "Inbound Events"
+        indexes = [
+            models.Index(fields=['partition_key', 'status', 'id']),
+            models.Index(fields=['status', 'received_at']),
+        ]
+
+    def __str__(self):
+        return f"[{self.platform}] {self.partition_key} - {self.status}"
+
+
+class OutboundMessage(models.Model):
+    """
+    Outbox row for an outgoing ChatMessage. Socials.outbound delivers it to the
+    platform and retries failures that can't have been sent with backoff until
+    OUTBOUND_MAX_ATTEMPTS. 'unknown' rows may or may not have reached the customer
+    (read timeout, 5xx, a worker that died mid-send) and wait for a human check
+    before they are resent.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+        ('unknown', 'Unknown'),
+    ]
+
+    message = models.OneToOneField(ChatMessage, related_name='outbox', on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # 0 = conversational reply; higher values are bulk traffic released after replies
+    priority = models.SmallIntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    response = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Outbound Message"
+        verbose_name_plural = "Outbound Messages"
+        indexes = [
+            models.Index(fields=['status', 'priority', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"Outbound #{self.message_id} - {self.status}"
+
+
 class TestChat(models.Model):
     company = models.ForeignKey('Accounts.Company', related_name='test_chats', on_delete=models.CASCADE)
     type = models.CharField(max_length=10, choices=MESSAGE_TYPE)
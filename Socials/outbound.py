@@ -0,0 +1,473 @@
+import json
+import random
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from django_redis import get_redis_connection
+from Accounts.models import Company
+from .models import ChatRoom, ChatMessage, OutboundMessage
+from .consumers import broadcast_message
+from Others.rollups import record_message_stats, record_new_clients
+
+OUTBOUND_MAX_ATTEMPTS = 6
+OUTBOUND_BASE_BACKOFF = 2  # seconds, doubled per attempt
+OUTBOUND_MAX_BACKOFF = 60 * 10  # 10 minutes
+OUTBOUND_SENDING_TIMEOUT = 60 * 5  # a 'sending' row older than this belongs to a crashed worker
+
+# Outbox priorities: conversational replies are released before bulk traffic (reminders, broadcasts)
+OUTBOUND_PRIORITY_REPLY = 0
+OUTBOUND_PRIORITY_BULK = 5
+OUTBOUND_METRICS_TTL = 60 * 60 * 24 * 7  # 7 days
+
+# Graph API error codes meaning "slow down" rather than "this message is invalid"
+META_RATE_LIMIT_CODES = {4, 17, 32, 613, 80007, 130429, 131048, 131056}
+
+#---------------------------------------------
+# HTTP SESSIONS
+#---------------------------------------------
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(platform):
+    """One keep-alive connection pool per platform, shared by the worker's threads."""
+    session = _sessions.get(platform)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(platform)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.OUTBOUND_POOL_SIZE,
+                    max_retries=0  # retries are scheduled through the outbox, never inline
+                )
+                session.mount("https://", adapter)
+                _sessions[platform] = session
+    return session
+
+
+def build_send_request(profile, client_obj, message_text):
+    """Returns (url, params, headers, payload) for a text message on the profile's platform."""
+    if profile.platform == "whatsapp":
+        url = f"https://graph.facebook.com/v17.0/{profile.profile_id}/messages"
+        headers = {"Authorization": f"Bearer {profile.access_token}", "Content-Type": "application/json"}
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": client_obj.client_id,
+            "type": "text",
+            "text": {"body": message_text},
+        }
+        return url, None, headers, payload
+
+    if profile.platform == "facebook":
+        url = "https://graph.facebook.com/v19.0/me/messages"
+    elif profile.platform == "instagram":
+        url = "https://graph.instagram.com/v22.0/me/messages"
+    else:
+        raise ValueError(f"Unknown platform {profile.platform}")
+
+    params = {"access_token": profile.access_token}
+    payload = {"recipient": {"id": client_obj.client_id}, "message": {"text": message_text}}
+    return url, params, None, payload
+
+#---------------------------------------------
+# RETRY POLICY
+#---------------------------------------------
+
+class DeliveryError(Exception):
+    """
+    transient: the message was not sent and may be retried as is (connect error, 429, throttling).
+    unknown: the request may have been sent (read timeout, 5xx); a retry could duplicate it.
+    """
+    def __init__(self, message, transient, retry_after=0, unknown=False):
+        super().__init__(message)
+        self.transient = transient
+        self.retry_after = retry_after
+        self.unknown = unknown
+
+
+def is_unsent_error(exc):
+    """True when the request failed before a connection was made, so Meta never saw it."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError) and exc.args:
+        reason = getattr(exc.args[0], "reason", None)
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def get_rate_limit_wait(response):
+    """
+    Seconds Meta asks us to back off for: Retry-After, or the largest
+    estimated_time_to_regain_access (minutes) in the business use case usage header.
+    """
+    wait = 0
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        wait = int(retry_after)
+
+    usage_header = response.headers.get("X-Business-Use-Case-Usage")
+    if usage_header:
+        try:
+            for entries in json.loads(usage_header).values():
+                for entry in entries:
+                    wait = max(wait, int(entry.get("estimated_time_to_regain_access") or 0) * 60)
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return wait
+
+
+def check_send_response(response):
+    """Returns the response JSON of a successful send, raises DeliveryError otherwise."""
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+
+    error = data.get("error") if isinstance(data, dict) else None
+    if response.ok and not error:
+        return data
+
+    error = error or {}
+    code = error.get("code")
+    message = error.get("message") or f"HTTP {response.status_code}"
+    rate_limited = response.status_code == 429 or code in META_RATE_LIMIT_CODES
+    retry_after = get_rate_limit_wait(response) if rate_limited else 0
+    # Rate limits are rejected before sending; a 5xx may come after the message went out
+    unknown = not rate_limited and response.status_code >= 500
+    raise DeliveryError(f"{message} (code {code})", transient=rate_limited, retry_after=retry_after, unknown=unknown)
+
+
+def get_backoff(attempts, retry_after=0):
+    backoff = max(min(OUTBOUND_MAX_BACKOFF, OUTBOUND_BASE_BACKOFF * 2 ** (attempts - 1)), retry_after)
+    # Jitter on top of Retry-After too, or every row of a held profile retries in lockstep
+    return backoff + random.uniform(0, backoff / 2)
+
+#---------------------------------------------
+# PER-PROFILE RATE LIMITING
+#---------------------------------------------
+
+# Token bucket per ChatProfile. Refills at `rate` tokens/s up to `burst`; a request may
+# only take a token while more than `reserve` remain, which keeps headroom for replies.
+# A hold key (set when Meta answers 429/613) blocks the profile until it expires.
+# Returns 0 when a token was taken, otherwise the milliseconds to wait.
+TOKEN_BUCKET_SCRIPT = """
+local hold_ttl = redis.call('PTTL', KEYS[2])
+if hold_ttl > 0 then
+    return hold_ttl
+end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 + reserve then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 + reserve - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+
+def get_bucket_key(profile_id):
+    return f"send_bucket_{profile_id}"
+
+
+def get_hold_key(profile_id):
+    return f"send_hold_{profile_id}"
+
+
+def get_metrics_key(profile_id):
+    return f"send_metrics_{profile_id}"
+
+
+def get_profile_rate(platform):
+    """(tokens per second, bucket size) for a platform's profiles."""
+    rate = settings.OUTBOUND_RATE_LIMITS.get(platform, 5)
+    return rate, max(1, rate * settings.OUTBOUND_BURST_SECONDS)
+
+
+def acquire_send_slot(profile, priority=OUTBOUND_PRIORITY_REPLY):
+    """
+    Takes one token from the profile's bucket. Returns 0 if the send may go out now,
+    otherwise the seconds until it should be retried. Fails open if Redis is down.
+    """
+    rate, burst = get_profile_rate(profile.platform)
+    reserve = burst * settings.OUTBOUND_BULK_RESERVE if priority > OUTBOUND_PRIORITY_REPLY else 0
+    try:
+        wait_ms = get_redis_connection("default").eval(
+            TOKEN_BUCKET_SCRIPT, 2, get_bucket_key(profile.id), get_hold_key(profile.id), rate, burst, reserve
+        )
+    except Exception as e:
+        print(f"⚠️ Send rate limiter unavailable for profile {profile.id}: {e}")
+        return 0
+    return int(wait_ms) / 1000
+
+
+def hold_profile(profile, seconds):
+    """Meta told us to back off: pause every send of this profile, not just the failed one."""
+    try:
+        get_redis_connection("default").set(get_hold_key(profile.id), 1, px=max(1, int(seconds * 1000)))
+    except Exception as e:
+        print(f"⚠️ Could not pause sends for profile {profile.id}: {e}")
+
+
+def record_send_metric(profile_id, metric):
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline(transaction=False)
+        pipe.hincrby(get_metrics_key(profile_id), metric, 1)
+        pipe.expire(get_metrics_key(profile_id), OUTBOUND_METRICS_TTL)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def get_outbound_queue_stats():
+    """Queue depth per profile plus send / throttle counters, for monitoring."""
+    now = timezone.now()
+    rows = (
+        OutboundMessage.objects.filter(status__in=["pending", "sending"])
+        .values("message__room__profile_id", "message__room__profile__platform")
+        .annotate(depth=Count("id"), oldest=Min("created_at"))
+    )
+    stats = {
+        row["message__room__profile_id"]: {
+            "platform": row["message__room__profile__platform"],
+            "depth": row["depth"],
+            "oldest_age_seconds": (now - row["oldest"]).total_seconds(),
+        }
+        for row in rows
+    }
+
+    try:
+        redis = get_redis_connection("default")
+        for key in redis.scan_iter("send_metrics_*"):
+            key_str = key.decode() if isinstance(key, bytes) else key
+            profile_id = int(key_str.rsplit("_", 1)[-1])
+            counters = {
+                (k.decode() if isinstance(k, bytes) else k): int(v)
+                for k, v in redis.hgetall(key).items()
+            }
+            stats.setdefault(profile_id, {"depth": 0, "oldest_age_seconds": 0}).update(counters)
+            hold_ms = redis.pttl(get_hold_key(profile_id))
+            stats[profile_id]["held_seconds"] = max(0, hold_ms) / 1000
+    except Exception as e:
+        print(f"⚠️ Send metrics unavailable: {e}")
+
+    return stats
+
+#---------------------------------------------
+# OUTBOX
+#---------------------------------------------
+
+def enqueue_outbound_message(profile, client_obj, message_text, send_by_bot=True, priority=OUTBOUND_PRIORITY_REPLY):
+    """Stores the outgoing message together with its outbox row."""
+    room, room_created = ChatRoom.objects.get_or_create(profile=profile, client=client_obj)
+    company_id = Company.objects.filter(user_id=profile.user_id).values_list("id", flat=True).first()
+    if room_created:
+        record_new_clients(company_id, profile.platform)
+    with transaction.atomic():
+        message = ChatMessage.objects.create(
+            room=room,
+            type="outgoing",
+            text=message_text,
+            send_by_bot=send_by_bot,
+            delivery_status="pending",
+        )
+        outbox = OutboundMessage.objects.create(message=message, priority=priority)
+    ChatRoom.objects.filter(id=room.id).update(last_outgoing_time=timezone.now())
+    ChatRoom.record_last_message(room.id, message.text, message.type, message.timestamp)
+    record_message_stats(company_id, profile.platform, [message])
+    return room, outbox
+
+
+def claim_outbound_message(outbox_id):
+    """Moves a due pending row to 'sending'; False if another worker got it or it isn't due."""
+    return OutboundMessage.objects.filter(
+        id=outbox_id, status="pending",
+        # Celery ETAs may fire a moment before the stored next_attempt_at
+        next_attempt_at__lte=timezone.now() + timezone.timedelta(seconds=1)
+    ).update(status="sending", attempts=F("attempts") + 1, updated_at=timezone.now()) == 1
+
+
+def deliver_outbound_message(outbox_id):
+    """
+    Sends one claimed outbox row once the profile's rate limiter allows it. Throttled
+    sends and failures that can't have been sent (connect errors, 429 / rate-limit codes)
+    are rescheduled, the latter with exponential backoff. Read timeouts and 5xx answers
+    are parked as 'unknown' unless OUTBOUND_RESEND_UNKNOWN allows at-least-once resends;
+    other failures mark the message failed.
+    Returns (response_data, retry_in_seconds): retry_in is None once the row is final.
+    """
+    if not claim_outbound_message(outbox_id):
+        return None, None
+
+    outbox = OutboundMessage.objects.select_related(
+        "message__room__profile", "message__room__client"
+    ).get(id=outbox_id)
+    message = outbox.message
+    profile, client_obj = message.room.profile, message.room.client
+
+    wait = acquire_send_slot(profile, outbox.priority)
+    if wait > 0:
+        # Throttled sends don't count as attempts; spread the queue over the wait window
+        retry_in = wait + random.uniform(0, wait)
+        OutboundMessage.objects.filter(id=outbox.id).update(
+            status="pending",
+            attempts=F("attempts") - 1,
+            next_attempt_at=timezone.now() + timezone.timedelta(seconds=retry_in),
+            updated_at=timezone.now()
+        )
+        record_send_metric(profile.id, "throttled")
+        schedule_outbound_delivery(outbox.id, retry_in, outbox.priority)
+        return {"queued": True, "throttled": True}, retry_in
+
+    try:
+        url, params, headers, payload = build_send_request(profile, client_obj, message.text)
+        try:
+            response = get_session(profile.platform).post(
+                url, params=params, headers=headers, json=payload,
+                timeout=(settings.OUTBOUND_CONNECT_TIMEOUT, settings.OUTBOUND_READ_TIMEOUT)
+            )
+        except requests.RequestException as e:
+            if is_unsent_error(e):
+                raise DeliveryError(str(e), transient=True)
+            # Read timeout or dropped connection: the message may have gone out
+            raise DeliveryError(str(e), transient=False, unknown=True)
+        res_data = check_send_response(response)
+
+    except Exception as e:
+        transient = getattr(e, "transient", False)
+        unknown = getattr(e, "unknown", False)
+        retry_after = getattr(e, "retry_after", 0)
+        outbox.last_error = str(e)
+        if retry_after:
+            hold_profile(profile, retry_after)
+            record_send_metric(profile.id, "rate_limited")
+        if unknown and not settings.OUTBOUND_RESEND_UNKNOWN:
+            # Resending could message the customer twice: park it until someone checks the
+            # conversation (resend_outbound_message / outbound_queue_stats --resend)
+            outbox.status = "unknown"
+            outbox.save(update_fields=["status", "last_error", "updated_at"])
+            ChatMessage.objects.filter(id=message.id).update(delivery_status="unknown")
+            print(f"❓ [{profile.platform}] Message {message.id} may not have been delivered: {e}")
+            record_send_metric(profile.id, "unknown")
+            return {"error": str(e), "unknown": True}, None
+        if (transient or unknown) and outbox.attempts < OUTBOUND_MAX_ATTEMPTS:
+            retry_in = get_backoff(outbox.attempts, retry_after)
+            outbox.status = "pending"
+            outbox.next_attempt_at = timezone.now() + timezone.timedelta(seconds=retry_in)
+            outbox.save(update_fields=["status", "next_attempt_at", "last_error", "updated_at"])
+            print(f"🔁 [{profile.platform}] Send of message {message.id} failed ({e}), retry {outbox.attempts} in {retry_in:.0f}s")
+            schedule_outbound_delivery(outbox.id, retry_in, outbox.priority)
+            return {"error": str(e), "queued": True}, retry_in
+
+        outbox.status = "failed"
+        outbox.save(update_fields=["status", "last_error", "updated_at"])
+        ChatMessage.objects.filter(id=message.id).update(delivery_status="failed")
+        print(f"❌ [{profile.platform}] Message {message.id} could not be delivered: {e}")
+        record_send_metric(profile.id, "failed")
+        return {"error": str(e)}, None
+
+    platform_message_id = res_data.get("message_id") or (res_data.get("messages") or [{}])[0].get("id")
+    outbox.status = "sent"
+    outbox.response = res_data
+    outbox.last_error = None
+    outbox.sent_at = timezone.now()
+    outbox.save(update_fields=["status", "response", "last_error", "sent_at", "updated_at"])
+    ChatMessage.objects.filter(id=message.id).update(delivery_status="sent", message_id=platform_message_id)
+    record_send_metric(profile.id, "sent")
+    return res_data, None
+
+
+def resend_outbound_message(outbox_id):
+    """Requeues an 'unknown' row once someone checked the customer didn't get it. Returns True if requeued."""
+    outbox = OutboundMessage.objects.filter(id=outbox_id, status="unknown").first()
+    if not outbox:
+        return False
+    OutboundMessage.objects.filter(id=outbox.id, status="unknown").update(
+        status="pending", next_attempt_at=timezone.now(), updated_at=timezone.now()
+    )
+    ChatMessage.objects.filter(id=outbox.message_id).update(delivery_status="pending")
+    schedule_outbound_delivery(outbox.id, priority=outbox.priority)
+    return True
+
+
+def schedule_outbound_delivery(outbox_id, countdown=0, priority=OUTBOUND_PRIORITY_REPLY):
+    from .tasks import deliver_outbound_message_task
+    # Celery priority follows the outbox priority (0 = replies first on the realtime queue)
+    task_priority = 1 if priority <= OUTBOUND_PRIORITY_REPLY else 6
+    deliver_outbound_message_task.apply_async((outbox_id,), countdown=countdown, priority=task_priority)
+
+
+def get_stalled_outbound_messages(limit=500):
+    """
+    (id, priority) of due rows whose task was lost. Rows left 'sending' by a crashed worker
+    may already have been posted, so they are parked as 'unknown' like a read timeout,
+    and only requeued when OUTBOUND_RESEND_UNKNOWN allows at-least-once resends.
+    """
+    now = timezone.now()
+    crashed = OutboundMessage.objects.filter(
+        status="sending", updated_at__lt=now - timezone.timedelta(seconds=OUTBOUND_SENDING_TIMEOUT)
+    )
+    if settings.OUTBOUND_RESEND_UNKNOWN:
+        crashed.update(status="pending", next_attempt_at=now, updated_at=now)
+    else:
+        with transaction.atomic():
+            message_ids = list(crashed.select_for_update().values_list("message_id", flat=True))
+            if message_ids:
+                OutboundMessage.objects.filter(message_id__in=message_ids, status="sending").update(
+                    status="unknown", last_error="Worker stopped during the send", updated_at=now
+                )
+                ChatMessage.objects.filter(id__in=message_ids).update(delivery_status="unknown")
+                print(f"❓ {len(message_ids)} outbound messages left 'sending' may not have been delivered")
+    return list(
+        OutboundMessage.objects.filter(
+            status="pending", next_attempt_at__lt=now - timezone.timedelta(seconds=30)
+        ).order_by("priority", "next_attempt_at").values_list("id", "priority")[:limit]
+    )
+
+
+def send_message(profile, client_obj, message_text, priority=OUTBOUND_PRIORITY_REPLY):
+    """
+    Records the outgoing message in the outbox and makes the first delivery attempt
+    right away; throttled sends and transient failures are retried by
+    Socials.tasks.deliver_outbound_message_task.
+    Returns the platform response, or {"error": ..., "queued": bool}.
+    """
+    try:
+        room, outbox = enqueue_outbound_message(profile, client_obj, message_text, priority=priority)
+    except Exception as e:
+        print(f"❌ Error sending message: {e}")
+        return {"error": str(e)}
+
+    broadcast_message(profile, client_obj, message_text, 'outgoing', room.id)
+
+    try:
+        res_data, _ = deliver_outbound_message(outbox.id)
+    except Exception as e:
+        # Unexpected (DB) error after the claim: the sweeper picks the row up again
+        print(f"❌ Error sending message: {e}")
+        return {"error": str(e), "queued": True}
+    return res_data
@@ -0,0 +1,154 @@
+"""
+Keyset (cursor) pagination for the inbox and message history, shared by the
+GlobalChatConsumer actions and the REST views.
+
+- rooms: newest conversation first, on (last_message_at, id); rooms without messages last
+- messages: newest first on (timestamp, id), each page returned oldest-first for display
+
+A cursor is the opaque position of the last item served; the next page continues
+strictly after it, so pages don't shift when new messages arrive.
+"""
+import base64
+import json
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+from .models import ChatRoom
+
+ROOMS_PAGE_SIZE = 30
+MESSAGES_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, pk):
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, pk])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns (timestamp or None, id) from encode_cursor's output."""
+    try:
+        timestamp, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        parsed = parse_datetime(timestamp) if timestamp else None
+        if (timestamp and parsed is None) or not isinstance(pk, int):
+            raise ValueError
+        return parsed, pk
+    except Exception:
+        raise InvalidCursor("Invalid cursor")
+
+
+def get_page_size(limit, default):
+    try:
+        limit = int(limit) if limit else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def wants_page(query_params):
+    """
+    REST history endpoints keep answering with a plain list; ?cursor= or ?paginate=1 opts
+    in to the {results, next_cursor} page.
+    """
+    return "cursor" in query_params or query_params.get("paginate", "").lower() in ("1", "true")
+
+
+def split_page(items, limit, get_position):
+    """`items` holds up to one row past the page, which tells whether a next cursor is needed."""
+    next_cursor = encode_cursor(*get_position(items[limit - 1])) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+def get_page(queryset, limit, get_position):
+    return split_page(list(queryset[:limit + 1]), limit, get_position)
+
+#---------------------------------------------
+# ROOMS
+#---------------------------------------------
+
+ROOM_ORDERING = (F('last_message_at').desc(nulls_last=True), F('id').desc())
+
+
+def get_room_position(room):
+    return room.last_message_at, room.id
+
+
+def paginate_rooms(profiles, cursor=None, limit=None):
+    """One page of the inbox of `profiles` (uses chatroom_profile_last_msg_idx). Returns (rooms, next_cursor)."""
+    rooms = ChatRoom.objects.filter(profile__in=profiles).select_related('client', 'profile').order_by(*ROOM_ORDERING)
+    if cursor:
+        last_at, last_id = decode_cursor(cursor)
+        if last_at is None:
+            rooms = rooms.filter(last_message_at__isnull=True, id__lt=last_id)
+        else:
+            rooms = rooms.filter(
+                Q(last_message_at__lt=last_at)
+                | Q(last_message_at=last_at, id__lt=last_id)
+                | Q(last_message_at__isnull=True)
+            )
+    return get_page(rooms, get_page_size(limit, ROOMS_PAGE_SIZE), get_room_position)
+
+
+def get_first_room_pages(profiles, limit=None):
+    """
+    The first inbox page of every profile in one query (rows numbered per profile), for the
+    websocket handshake. Returns {profile pk: (rooms, next_cursor)}; a cursor continues
+    with paginate_rooms([profile], cursor).
+    """
+    limit = get_page_size(limit, ROOMS_PAGE_SIZE)
+    rooms = ChatRoom.objects.filter(profile__in=profiles).select_related('client', 'profile').annotate(
+        position=Window(RowNumber(), partition_by=[F('profile_id')], order_by=list(ROOM_ORDERING))
+    ).filter(position__lte=limit + 1).order_by('profile_id', 'position')
+
+    by_profile = {profile.pk: [] for profile in profiles}
+    for room in rooms:
+        by_profile[room.profile_id].append(room)
+    return {pk: split_page(items, limit, get_room_position) for pk, items in by_profile.items()}
+
+
+def serialize_room(room):
+    return {
+        'room_id': room.id,
+        'platform': room.profile.platform,
+        'profile_id': room.profile.profile_id,
+        'client_id': room.client.name if room.client.name else room.client.client_id,
+        'last_msg': room.last_message_text,
+        'timestamp': room.last_message_at.isoformat() if room.last_message_at else None,
+        'type': room.last_message_type,
+    }
+
+#---------------------------------------------
+# MESSAGES
+#---------------------------------------------
+
+def paginate_messages(queryset, cursor=None, limit=None):
+    """
+    One page of a message queryset (ChatMessage or TestChat), walking back in time.
+    Returns (messages oldest first, next_cursor for the older page).
+    """
+    messages = queryset.order_by('-timestamp', '-id')
+    if cursor:
+        before_at, before_id = decode_cursor(cursor)
+        if before_at is None:
+            raise InvalidCursor("Invalid cursor")
+        messages = messages.filter(Q(timestamp__lt=before_at) | Q(timestamp=before_at, id__lt=before_id))
+
+    page, next_cursor = get_page(
+        messages, get_page_size(limit, MESSAGES_PAGE_SIZE), lambda msg: (msg.timestamp, msg.id)
+    )
+    return page[::-1], next_cursor
+
+
+def serialize_message(msg):
+    return {
+        'id': msg.id,
+        'type': msg.type,
+        'text': msg.text,
+        'message_id': msg.message_id,
+        'delivery_status': msg.delivery_status,
+        'timestamp': msg.timestamp.isoformat(),
+    }
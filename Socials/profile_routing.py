@@ -0,0 +1,215 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+import requests
+import time
+from .models import ChatProfile
+
+# Profile routing index: one Redis hash per platform mapping every known alias of an
+# account (page id, IG business id, IG user id, username) to its ChatProfile pk.
+# ChatProfile.profile_id + ChatProfile.aliases are the durable source; the hash is rebuilt
+# from them by reconcile_profile_routes.
+
+RECONCILE_LOCK_TTL = 60 * 10  # 10 minutes
+ALIAS_REFRESH_TTL = 60 * 60 * 6  # an account's Graph aliases are re-fetched every 6 hours at most
+UNROUTED_REFRESH_TTL = 60 * 10  # a reconcile for an unroutable webhook id re-checks accounts not fetched in the last 10 minutes
+
+
+def get_routes_key(platform):
+    return f"profile_routes_{platform}"
+
+
+def get_refreshed_key(platform):
+    """Hash of ChatProfile pk -> unix time its aliases were last fetched from the Graph API."""
+    return f"profile_aliases_refreshed_{platform}"
+
+
+def get_profile_aliases(profile):
+    return {str(alias) for alias in [profile.profile_id, *(profile.aliases or [])] if alias}
+
+
+def index_profile(profile, *extra_aliases):
+    """
+    Adds a profile's aliases to the routing index. New aliases (e.g. ids learned at connect
+    time) are also stored on the profile so a rebuild keeps them.
+    """
+    new_aliases = {str(alias) for alias in extra_aliases if alias} - get_profile_aliases(profile)
+    if new_aliases:
+        profile.aliases = sorted(set(profile.aliases or []) | new_aliases)
+        ChatProfile.objects.filter(pk=profile.pk).update(aliases=profile.aliases)
+
+    try:
+        get_redis_connection("default").hset(
+            get_routes_key(profile.platform),
+            mapping={alias: profile.pk for alias in get_profile_aliases(profile)}
+        )
+    except Exception as e:
+        print(f"⚠️ Could not index {profile.platform} profile {profile.pk}: {e}")
+
+
+def unindex_profile(profile):
+    try:
+        redis = get_redis_connection("default")
+        key = get_routes_key(profile.platform)
+        # Only drop aliases that still point at this profile
+        aliases = list(get_profile_aliases(profile))
+        stale = [alias for alias, pk in zip(aliases, redis.hmget(key, aliases)) if pk and int(pk) == profile.pk]
+        if stale:
+            redis.hdel(key, *stale)
+    except Exception as e:
+        print(f"⚠️ Could not unindex {profile.platform} profile {profile.pk}: {e}")
+
+
+def resolve_profiles(platform, aliases):
+    """
+    Routes webhook account ids to profiles with one HMGET plus one pk lookup.
+    Aliases missing from the index fall back to a profile_id query and are indexed.
+    Returns {alias: ChatProfile} for the aliases that resolved (active or not).
+    """
+    aliases = list({str(alias) for alias in aliases if alias})
+    if not aliases:
+        return {}
+
+    pks = {}
+    try:
+        redis = get_redis_connection("default")
+        pks = {alias: int(pk) for alias, pk in zip(aliases, redis.hmget(get_routes_key(platform), aliases)) if pk}
+    except Exception as e:
+        print(f"⚠️ Profile routing index unavailable: {e}")
+
+    profiles_by_pk = ChatProfile.objects.filter(
+        pk__in=set(pks.values()), platform=platform
+    ).select_related("user__company").in_bulk()
+    resolved = {alias: profiles_by_pk[pk] for alias, pk in pks.items() if pk in profiles_by_pk}
+
+    missing = set(aliases) - set(resolved)
+    if missing:
+        for profile in ChatProfile.objects.filter(platform=platform, profile_id__in=missing).select_related("user__company"):
+            resolved[profile.profile_id] = profile
+            index_profile(profile)
+    return resolved
+
+
+def fetch_instagram_aliases(access_token):
+    """The ids / username an Instagram Login token resolves to (ig_id is not available on every account)."""
+    aliases = set()
+    for fields in ("user_id,username", "id,username", "ig_id"):
+        try:
+            res = requests.get(
+                "https://graph.instagram.com/me",
+                params={"fields": fields, "access_token": access_token},
+                timeout=5
+            ).json()
+        except Exception as e:
+            print(f"⚠️ [Instagram] Alias lookup failed ({fields}): {e}")
+            continue
+        if "error" in res:
+            if res["error"].get("code") == 190:  # Invalid/Expired token
+                break
+            continue
+        aliases.update(str(res[field]) for field in ("id", "user_id", "ig_id", "username") if res.get(field))
+    return aliases
+
+
+def get_stale_profiles(profiles, max_age=ALIAS_REFRESH_TTL):
+    """The profiles whose aliases weren't fetched from the Graph API in the last `max_age` seconds."""
+    if not profiles:
+        return []
+    try:
+        refreshed = get_redis_connection("default").hmget(
+            get_refreshed_key(profiles[0].platform), [profile.pk for profile in profiles]
+        )
+    except Exception as e:
+        print(f"⚠️ Profile alias refresh times unavailable: {e}")
+        refreshed = [None] * len(profiles)
+    cutoff = time.time() - max_age
+    return [profile for profile, at in zip(profiles, refreshed) if not at or float(at) < cutoff]
+
+
+def get_unindexed_profiles(redis, platform, profiles):
+    """The profiles with an alias the current index doesn't route to them."""
+    routes = {
+        (alias.decode() if isinstance(alias, bytes) else alias): int(pk)
+        for alias, pk in redis.hgetall(get_routes_key(platform)).items()
+    }
+    return [
+        profile for profile in profiles
+        if any(routes.get(alias) != profile.pk for alias in get_profile_aliases(profile))
+    ]
+
+
+def refresh_instagram_aliases(profiles):
+    """
+    Fetches the Graph API aliases of `profiles`, stores the new ones on the profiles and
+    records the refresh time (failed lookups too, so a broken token isn't retried every run).
+    Returns the profiles that gained aliases.
+    """
+    updated = []
+    for profile in profiles:
+        new_aliases = fetch_instagram_aliases(profile.access_token) - get_profile_aliases(profile)
+        if new_aliases:
+            profile.aliases = sorted(set(profile.aliases or []) | new_aliases)
+            ChatProfile.objects.filter(pk=profile.pk).update(aliases=profile.aliases)
+            updated.append(profile)
+    if profiles:
+        try:
+            get_redis_connection("default").hset(
+                get_refreshed_key("instagram"), mapping={profile.pk: time.time() for profile in profiles}
+            )
+        except Exception as e:
+            print(f"⚠️ Could not record Instagram alias refresh: {e}")
+    return updated
+
+
+def reconcile_profile_routes(platform=None, max_age=ALIAS_REFRESH_TTL):
+    """
+    Rebuilds the routing index from the DB. Instagram aliases are re-fetched from the Graph API
+    only for accounts the index doesn't fully route or whose aliases are older than `max_age`
+    (UNROUTED_REFRESH_TTL when an unroutable webhook id asked for the rebuild).
+    The new hash is built under a temporary key and swapped in, so lookups never see it half-built.
+    An account's own profile_id always wins over an alias claimed by another profile.
+    """
+    platforms = [platform] if platform else [choice for choice, _ in ChatProfile.PLATFORM_CHOICES]
+    redis = get_redis_connection("default")
+    counts = {}
+
+    for current in platforms:
+        profiles = list(ChatProfile.objects.filter(platform=current))
+        if current == "instagram":
+            stale = {profile.pk: profile for profile in get_stale_profiles(profiles, max_age)}
+            stale.update({profile.pk: profile for profile in get_unindexed_profiles(redis, current, profiles)})
+            refresh_instagram_aliases(list(stale.values()))
+
+        mapping = {}
+        for profile in profiles:
+            for alias in profile.aliases or []:
+                mapping[str(alias)] = profile.pk
+        for profile in profiles:
+            mapping[str(profile.profile_id)] = profile.pk
+
+        key = get_routes_key(current)
+        if mapping:
+            tmp_key = f"{key}_rebuild"
+            pipe = redis.pipeline()
+            pipe.delete(tmp_key)
+            pipe.hset(tmp_key, mapping=mapping)
+            pipe.rename(tmp_key, key)
+            pipe.execute()
+        else:
+            redis.delete(key)
+        counts[current] = len(mapping)
+
+    return counts
+
+
+def schedule_profile_reconciliation(platform):
+    """
+    Queues a rebuild for an unroutable account id, at most once per RECONCILE_LOCK_TTL.
+    It runs on the maintenance queue, so the Graph API calls stay out of the inbound drain.
+    """
+    if not cache.add(f"profile_routes_reconcile_{platform}", 1, timeout=RECONCILE_LOCK_TTL):
+        return
+    from .tasks import reconcile_profile_routes_task
+    try:
+        reconcile_profile_routes_task.delay(platform, UNROUTED_REFRESH_TTL)
+    except Exception as e:
+        print(f"⚠️ Could not queue profile route reconciliation: {e}")
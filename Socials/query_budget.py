@@ -0,0 +1,145 @@
+"""
+Query-count and full-scan budgets for the hot chat paths.
+
+    with query_budget(3, label="inbox"):
+        paginate_rooms(profiles)
+
+raises QueryBudgetExceeded when the block runs more queries than allowed or, on
+PostgreSQL, when a query reads one of the hot tables with a sequential scan (EXPLAIN).
+Plans are only checked for tables of at least FULL_SCAN_MIN_ROWS rows: below that the
+planner rightly prefers a scan, and sqlite's planner says nothing about production.
+The query_audit command runs every HOT_PATHS entry against a real company; the
+Socials tests run them against fixtures.
+"""
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+FULL_SCAN_MIN_ROWS = 10000
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def get_hot_tables():
+    from Others.models import Booking
+    from .models import ChatMessage, ChatRoom
+    return [ChatMessage._meta.db_table, ChatRoom._meta.db_table, Booking._meta.db_table]
+
+
+def explain(sql):
+    """The PostgreSQL query plan as text lines."""
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN " + sql)
+        return [str(row[0]) for row in cursor.fetchall()]
+
+
+def get_table_rows(table):
+    """The planner's row estimate for a PostgreSQL table (0 if never analyzed)."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+        row = cursor.fetchone()
+    return max(0, int(row[0])) if row else 0
+
+
+def get_scan_checked_tables(tables, min_rows=FULL_SCAN_MIN_ROWS):
+    """The tables whose plans are worth checking: PostgreSQL only, and only once they are big."""
+    if connection.vendor != "postgresql":
+        return []
+    return [table for table in tables if get_table_rows(table) >= min_rows]
+
+
+def get_full_scans(sql, tables):
+    """Tables of `tables` read with a sequential scan by `sql` (PostgreSQL)."""
+    if not tables or not sql.lstrip().upper().startswith("SELECT"):
+        return []
+    scans = []
+    for line in explain(sql):
+        for table in tables:
+            if f"Seq Scan on {table}" in line or f'Seq Scan on "{table}"' in line:
+                scans.append(table)
+    return scans
+
+
+@contextmanager
+def query_budget(max_queries, tables=None, label="", min_rows=FULL_SCAN_MIN_ROWS):
+    """Fails the block if it runs more than `max_queries` queries or full-scans a big hot table."""
+    tables = get_hot_tables() if tables is None else tables
+    with CaptureQueriesContext(connection) as captured:
+        yield captured
+
+    problems = []
+    if len(captured) > max_queries:
+        problems.append(f"{len(captured)} queries (budget {max_queries})")
+    checked_tables = get_scan_checked_tables(tables, min_rows)
+    for query in captured.captured_queries:
+        for table in get_full_scans(query["sql"], checked_tables):
+            problems.append(f"full scan of {table}: {query['sql'][:200]}")
+    if problems:
+        raise QueryBudgetExceeded(f"{label or 'block'}: " + "; ".join(problems))
+
+#---------------------------------------------
+# HOT PATHS
+#---------------------------------------------
+
+def run_inbox(context):
+    from .models import ChatProfile
+    from .pagination import get_first_room_pages, paginate_rooms
+    profiles = list(ChatProfile.objects.filter(user=context["user"]))
+    get_first_room_pages(profiles)
+    paginate_rooms(profiles)
+
+
+def run_message_history(context):
+    from .pagination import paginate_messages
+    paginate_messages(context["room"].messages.all())
+
+
+def run_ai_history(context):
+    from Others.task import get_msg_history
+    get_msg_history(context["room"].id)
+
+
+def run_pending_incoming(context):
+    from .models import ChatMessage
+    room = context["room"]
+    ChatMessage.objects.filter(
+        room=room, type="incoming", processed=False, created_at__gt=room.created_at
+    ).exists()
+
+
+def run_today_meetings(context):
+    from Others.views import DashboardView
+    DashboardView().get_today_meetings(context["company"])
+
+
+def run_view(view_class, path, user):
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    request = APIRequestFactory().get(path)
+    force_authenticate(request, user=user)
+    response = view_class.as_view()(request)
+    if response.status_code != 200:
+        raise QueryBudgetExceeded(f"{path} returned {response.status_code}")
+
+
+def run_dashboard(context):
+    from Others.views import DashboardView
+    run_view(DashboardView, "/dashboard/", context["user"])
+
+
+def run_analytics(context):
+    from Others.views import AnalyticsView
+    run_view(AnalyticsView, "/analytics/?time=all&channel=all", context["user"])
+
+
+# name: (query budget, runner); every runner gets {"company", "user", "room"}
+HOT_PATHS = {
+    "inbox": (3, run_inbox),  # profiles, first page of each profile, merged inbox page
+    "message_history": (1, run_message_history),
+    "ai_history": (1, run_ai_history),
+    "pending_incoming": (1, run_pending_incoming),
+    "today_meetings": (2, run_today_meetings),
+    "dashboard": (12, run_dashboard),
+    "analytics": (12, run_analytics),
+}
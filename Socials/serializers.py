@@ -14,7 +14,7 @@ class ChatProfileSerializers(ModelSerializer):
     
     def update(self, instance, validated_data):
         company = Company.objects.get(user=instance.user)
-        analysis = analyze_company_data(company.id)
+        analysis = analyze_company_data(company.id, wait_if_missing=True)
 
         if validated_data.get('bot_active') == True and analysis["dataHealth"]["score"] < 80:
             raise ValidationError(
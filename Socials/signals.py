@@ -0,0 +1,24 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from Accounts.models import Company
+from Finance.entitlements import invalidate_entitlements
+from .models import ChatProfile
+from .profile_routing import index_profile, unindex_profile
+
+
+@receiver(post_save, sender=ChatProfile)
+def index_chat_profile(sender, instance, **kwargs):
+    index_profile(instance)
+    invalidate_profile_entitlements(instance)
+
+
+@receiver(post_delete, sender=ChatProfile)
+def unindex_chat_profile(sender, instance, **kwargs):
+    unindex_profile(instance)
+    invalidate_profile_entitlements(instance)
+
+
+def invalidate_profile_entitlements(profile):
+    """The company's snapshot carries the bot state of its profiles."""
+    company_id = Company.objects.filter(user_id=profile.user_id).values_list("id", flat=True).first()
+    invalidate_entitlements(company_id)
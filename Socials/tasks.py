@@ -0,0 +1,55 @@
+from celery import shared_task
+from django.core.cache import cache
+from .inbound import drain_inbound_partition, get_stalled_partitions, refresh_sender_name
+from .outbound import deliver_outbound_message, get_stalled_outbound_messages, schedule_outbound_delivery
+from .profile_routing import ALIAS_REFRESH_TTL, reconcile_profile_routes
+
+
+@shared_task(name="Socials.tasks.process_inbound_events")
+def process_inbound_events(partition_key):
+    """Drains one partition of the inbound webhook queue (see unified_webhook)."""
+    processed, needs_requeue = drain_inbound_partition(partition_key)
+    if needs_requeue:
+        process_inbound_events.delay(partition_key)
+    return f"Processed {processed} inbound events for {partition_key}"
+
+
+@shared_task(name="Socials.tasks.requeue_stalled_inbound_events")
+def requeue_stalled_inbound_events():
+    """Periodic safety net for events whose task was lost or whose processing failed."""
+    partitions = get_stalled_partitions()
+    for partition_key in partitions:
+        process_inbound_events.delay(partition_key)
+    return f"Requeued {len(partitions)} inbound partitions"
+
+
+@shared_task(name="Socials.tasks.refresh_sender_name_task")
+def refresh_sender_name_task(platform, profile_id, client_id):
+    """Resolves a Messenger / Instagram sender's display name outside the inbound path."""
+    return refresh_sender_name(platform, profile_id, client_id)
+
+
+@shared_task(name="Socials.tasks.reconcile_profile_routes_task")
+def reconcile_profile_routes_task(platform=None, max_age=ALIAS_REFRESH_TTL):
+    """Rebuilds the webhook profile routing index (see Socials.profile_routing)."""
+    try:
+        return reconcile_profile_routes(platform, max_age)
+    finally:
+        if platform:
+            cache.delete(f"profile_routes_reconcile_{platform}")
+
+
+@shared_task(name="Socials.tasks.deliver_outbound_message_task")
+def deliver_outbound_message_task(outbox_id):
+    """Retries one outbox row (see Socials.outbound.send_message); it reschedules itself if needed."""
+    res_data, retry_in = deliver_outbound_message(outbox_id)
+    return f"Outbound {outbox_id}: {'retry in %ds' % retry_in if retry_in is not None else res_data}"
+
+
+@shared_task(name="Socials.tasks.requeue_stalled_outbound_messages")
+def requeue_stalled_outbound_messages():
+    """Periodic safety net for outbox rows whose retry task was lost."""
+    stalled = get_stalled_outbound_messages()
+    for outbox_id, priority in stalled:
+        schedule_outbound_delivery(outbox_id, priority=priority)
+    return f"Requeued {len(stalled)} outbound messages"
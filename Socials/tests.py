@@ -1,3 +1,341 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from Accounts.models import Company, User
+from Others.models import Booking
+from Socials.inbound import (
+    UnroutedEvent, claim_message_ids, get_cached_sender_names, get_sender_name_cache_key, parse_instagram_event,
+    process_inbound_event, refresh_sender_name,
+)
+from Socials.profile_routing import UNROUTED_REFRESH_TTL
+from Socials.models import ChatClient, ChatMessage, ChatProfile, ChatRoom, InboundEvent, OutboundMessage
+from Socials.outbound import OUTBOUND_SENDING_TIMEOUT
+from Socials.tasks import requeue_stalled_outbound_messages
+from Socials.pagination import get_first_room_pages, paginate_rooms
+from Socials.query_budget import HOT_PATHS, QueryBudgetExceeded, get_scan_checked_tables, query_budget
+from Socials.views import GetOldMessage
 
-# Create your tests here.
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class FakeRedis:
+    """The few string commands the inbound dedup uses (no expiry)."""
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value).encode()
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        redis, calls = self, []
+
+        class Pipeline:
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: calls.append((name, args, kwargs)) or self
+
+            def execute(self):
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+        return Pipeline()
+
+
+class ChatFixtures:
+    """A company user with chat profiles, rooms and messages."""
+
+    def create_user(self, email="owner@example.com"):
+        return User.objects.create(email=email, role="user")
+
+    def create_profile(self, user, profile_id, platform="facebook"):
+        return ChatProfile.objects.create(user=user, platform=platform, profile_id=profile_id, access_token="token")
+
+    def create_rooms(self, profile, count, now=None):
+        """Rooms with a mix of distinct, tied and missing last_message_at values."""
+        now = now or timezone.now()
+        first = ChatRoom.objects.filter(profile=profile).count()
+        rooms = []
+        for i in range(count):
+            client = ChatClient.objects.create(platform=profile.platform, client_id=f"{profile.profile_id}-c{first + i}")
+            last_message_at = None if i % 5 == 0 else now - timedelta(minutes=i // 3)
+            rooms.append(ChatRoom.objects.create(profile=profile, client=client, last_message_at=last_message_at))
+        return rooms
+
+    def create_messages(self, room, count):
+        for i in range(count):
+            ChatMessage.objects.create(room=room, type="incoming", text=f"message {i}")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PaginationTests(ChatFixtures, TestCase):
+    """Inbox and history pagination."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user()
+        self.profiles = [self.create_profile(self.user, f"page{i}") for i in range(3)]
+        for i, profile in enumerate(self.profiles):
+            self.create_rooms(profile, 4 + i * 3)
+
+    def test_first_room_pages_match_per_profile_pagination(self):
+        with self.assertNumQueries(1):
+            pages = get_first_room_pages(self.profiles, limit=5)
+
+        for profile in self.profiles:
+            rooms, next_cursor = paginate_rooms([profile], limit=5)
+            self.assertEqual([room.id for room in pages[profile.pk][0]], [room.id for room in rooms])
+            self.assertEqual(pages[profile.pk][1], next_cursor)
+
+    def test_first_room_page_cursor_continues_the_profile_inbox(self):
+        profile = self.profiles[2]
+        rooms, cursor = get_first_room_pages([profile], limit=4)[profile.pk]
+        seen = [room.id for room in rooms]
+        while cursor:
+            rooms, cursor = paginate_rooms([profile], cursor, limit=4)
+            seen += [room.id for room in rooms]
+
+        self.assertEqual(seen, [room.id for room in paginate_rooms([profile], limit=100)[0]])
+        self.assertEqual(len(set(seen)), ChatRoom.objects.filter(profile=profile).count())
+
+    def get_history(self, room, **params):
+        request = APIRequestFactory().get("/old-message/", params)
+        force_authenticate(request, user=self.user)
+        return GetOldMessage.as_view()(request, room_id=room.id, platform=room.profile.platform)
+
+    def test_message_history_keeps_the_list_shape_by_default(self):
+        room = ChatRoom.objects.filter(profile=self.profiles[0]).first()
+        self.create_messages(room, 60)
+
+        response = self.get_history(room)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.data, list)
+        self.assertEqual([m["text"] for m in response.data], [f"message {i}" for i in range(10, 60)])
+
+    def test_message_history_pages_on_request(self):
+        room = ChatRoom.objects.filter(profile=self.profiles[0]).first()
+        self.create_messages(room, 60)
+
+        first = self.get_history(room, paginate="1")
+        older = self.get_history(room, cursor=first.data["next_cursor"])
+
+        self.assertEqual(len(first.data["results"]), 50)
+        self.assertEqual([m["text"] for m in older.data["results"]], [f"message {i}" for i in range(10)])
+        self.assertIsNone(older.data["next_cursor"])
+        self.assertEqual(self.get_history(room, cursor="junk").status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class QueryBudgetTests(ChatFixtures, TestCase):
+    """The hot paths stay within their query budgets, whatever the amount of data."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user()
+        self.company = Company.objects.get(user=self.user)
+        self.profiles = [
+            self.create_profile(self.user, "page1"),
+            self.create_profile(self.user, "ig1", platform="instagram"),
+        ]
+
+    def add_data(self, rooms_per_profile, messages_per_room):
+        for profile in self.profiles:
+            for room in self.create_rooms(profile, rooms_per_profile):
+                self.create_messages(room, messages_per_room)
+        now = timezone.now()
+        # bulk_create: no reminder scheduling signals
+        Booking.objects.bulk_create([
+            Booking(
+                company=self.company, title=f"Booking {i}",
+                start_time=now + timedelta(hours=i), end_time=now + timedelta(hours=i, minutes=30)
+            )
+            for i in range(rooms_per_profile)
+        ])
+
+    def get_context(self):
+        room = ChatRoom.objects.filter(profile__user=self.user).order_by("-id").first()
+        return {"company": self.company, "user": self.user, "room": room}
+
+    def count_queries(self, name):
+        budget, runner = HOT_PATHS[name]
+        context = self.get_context()
+        with query_budget(budget, label=name) as captured:
+            runner(context)
+        return len(captured)
+
+    def test_hot_paths_stay_within_budget(self):
+        self.add_data(rooms_per_profile=3, messages_per_room=2)
+        for name in HOT_PATHS:
+            with self.subTest(path=name):
+                self.count_queries(name)
+
+    def test_query_counts_do_not_grow_with_the_data(self):
+        self.add_data(rooms_per_profile=2, messages_per_room=1)
+        small = {name: self.count_queries(name) for name in HOT_PATHS}
+
+        self.add_data(rooms_per_profile=15, messages_per_room=4)
+        large = {name: self.count_queries(name) for name in HOT_PATHS}
+
+        self.assertEqual(large, small)
+
+    def test_chat_reads_are_single_queries(self):
+        self.add_data(rooms_per_profile=5, messages_per_room=3)
+        context = self.get_context()
+        for name in ("message_history", "ai_history", "pending_incoming"):
+            with self.subTest(path=name), self.assertNumQueries(1):
+                HOT_PATHS[name][1](context)
+
+    def test_exceeding_the_budget_fails(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1, label="two queries"):
+                list(ChatRoom.objects.all())
+                list(ChatMessage.objects.all())
+
+    def test_plans_are_only_checked_on_postgresql(self):
+        with CaptureQueriesContext(connection) as captured:
+            tables = get_scan_checked_tables(["Socials_chatmessage"], min_rows=0)
+        if connection.vendor == "postgresql":
+            self.assertEqual(tables, ["Socials_chatmessage"])
+        else:
+            self.assertEqual((tables, len(captured)), ([], 0))
+
+
+def whatsapp_payload(phone_number_id, sender, message_ids):
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "waba", "changes": [{"value": {
+            "metadata": {"phone_number_id": phone_number_id},
+            "contacts": [{"profile": {"name": "Bob"}, "wa_id": sender}],
+            "messages": [{"id": mid, "from": sender, "text": {"body": f"text {mid}"}} for mid in message_ids],
+        }}]}],
+    }
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class InboundDedupTests(ChatFixtures, TestCase):
+    """Message ids claimed by an attempt that died before committing."""
+
+    def setUp(self):
+        cache.clear()
+        self.redis = FakeRedis()
+        self.profile = self.create_profile(self.create_user(), "phone1", platform="whatsapp")
+        ChatProfile.objects.filter(pk=self.profile.pk).update(bot_active=True)
+        self.event = InboundEvent.objects.create(
+            platform="whatsapp", partition_key="whatsapp:waba",
+            payload=whatsapp_payload("phone1", "111", ["wamid.1", "wamid.2"])
+        )
+        for target, value in [
+            ("Socials.inbound.get_redis_connection", lambda alias: self.redis),
+            ("Socials.inbound.reserve_tokens", lambda company_id, count: count),
+            ("Socials.inbound.broadcast_messages", mock.Mock()),
+            ("Socials.inbound.schedule_reply", mock.Mock()),
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def claim(self, owner):
+        incoming = [{"message_id": mid} for mid in ("wamid.1", "wamid.2")]
+        return claim_message_ids("whatsapp", incoming, owner)[0]
+
+    def test_ids_claimed_by_the_same_event_are_still_free(self):
+        self.assertEqual(len(self.claim(self.event.id)), 2)
+        self.assertEqual(len(self.claim(self.event.id)), 2)
+        self.assertEqual(self.claim(self.event.id + 1), [])
+        self.assertEqual(len(claim_message_ids("whatsapp", [{"message_id": "x"}, {"message_id": "x"}], 1)[0]), 1)
+
+    def test_event_is_stored_after_a_claim_that_was_never_released(self):
+        # The first attempt claimed the ids, then the worker died before the commit
+        self.claim(self.event.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = process_inbound_event(self.event)
+
+        self.assertNotEqual(result, "duplicate")
+        self.assertEqual(
+            sorted(ChatMessage.objects.values_list("message_id", flat=True)), ["wamid.1", "wamid.2"]
+        )
+        # A later redelivery of the same messages is still dropped
+        self.assertEqual(process_inbound_event(self.event), "duplicate")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SenderNameTests(ChatFixtures, TestCase):
+    """Messenger / Instagram sender names resolved off the inbound path."""
+
+    def setUp(self):
+        cache.clear()
+        self.profile = self.create_profile(self.create_user(), "page1")
+
+    def test_refresh_is_queued_once_the_batch_commits(self):
+        incoming = [{"client_id": "u1", "profile": self.profile}]
+        with mock.patch("Socials.tasks.refresh_sender_name_task.delay") as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                get_cached_sender_names("facebook", incoming, clients={})
+            delay.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+            delay.assert_called_once_with("facebook", self.profile.id, "u1")
+
+    def test_name_is_only_cached_once_stored(self):
+        key = get_sender_name_cache_key("facebook", "u1")
+        with mock.patch("Socials.inbound.fetch_sender_name", return_value="Alice"):
+            refresh_sender_name("facebook", self.profile.id, "u1")
+            self.assertIsNone(cache.get(key))
+
+            ChatClient.objects.create(platform="facebook", client_id="u1", name="Unknown")
+            refresh_sender_name("facebook", self.profile.id, "u1")
+
+        self.assertEqual(cache.get(key), "Alice")
+        self.assertEqual(ChatClient.objects.get(client_id="u1").name, "Alice")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class UnroutedEventTests(ChatFixtures, TestCase):
+    """Webhook ids the routing index doesn't know yet."""
+
+    def test_unrouted_instagram_id_is_left_to_the_reconcile(self):
+        self.create_profile(self.create_user(), "ig1", platform="instagram")
+        payload = {"object": "instagram", "entry": [{"id": "ig-webhook-id", "messaging": []}]}
+
+        with mock.patch("Socials.profile_routing.requests.get") as graph, \
+                mock.patch("Socials.tasks.reconcile_profile_routes_task.delay") as reconcile:
+            with self.assertRaises(UnroutedEvent):
+                parse_instagram_event(payload)
+
+        graph.assert_not_called()
+        reconcile.assert_called_once_with("instagram", UNROUTED_REFRESH_TTL)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, OUTBOUND_RESEND_UNKNOWN=False)
+class OutboundSweepTests(ChatFixtures, TestCase):
+    """The periodic outbox sweep never resends a message that may have gone out."""
+
+    def test_stale_sending_row_is_parked_as_unknown(self):
+        room = self.create_rooms(self.create_profile(self.create_user(), "page1"), 1)[0]
+        message = ChatMessage.objects.create(room=room, type="outgoing", text="hi", delivery_status="pending")
+        outbox = OutboundMessage.objects.create(message=message, status="sending", attempts=1)
+        stale = timezone.now() - timedelta(seconds=OUTBOUND_SENDING_TIMEOUT + 60)
+        OutboundMessage.objects.filter(id=outbox.id).update(updated_at=stale, next_attempt_at=stale)
+
+        with mock.patch("Socials.tasks.schedule_outbound_delivery") as schedule:
+            requeue_stalled_outbound_messages()
+            requeue_stalled_outbound_messages()
+
+        schedule.assert_not_called()
+        self.assertEqual(OutboundMessage.objects.get(id=outbox.id).status, "unknown")
+        self.assertEqual(ChatMessage.objects.get(id=message.id).delivery_status, "unknown")
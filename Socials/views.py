@@ -22,6 +22,8 @@ from collections import Counter
 from django.http import HttpResponseRedirect,HttpResponse
 from Accounts.permissions import *
 from .consumers import send_alert
+from .profile_routing import index_profile
+from .pagination import InvalidCursor, paginate_messages, paginate_rooms, serialize_room, wants_page
 # Create your views here.
 
 
@@ -302,6 +304,9 @@ def instagram_callback(request):
     exchange_data = exchange_resp.json()
     long_lived_token = exchange_data.get("access_token", user_access_token)
 
+    # Every id / username this account may show up as in webhooks, for the routing index
+    ig_aliases = [ig_user_id]
+
     # Try to resolve ID safely
     try:
         # 1. Fetch basic info (always available)
@@ -311,6 +316,7 @@ def instagram_callback(request):
         
         final_ig_id = str(ig_me_data.get("id", ig_user_id))
         profile_name = ig_me_data.get("username", "Instagram Business")
+        ig_aliases += [ig_me_data.get("id"), ig_me_data.get("username")]
         print(f"🔍 [Instagram Callback] Basic Data: {ig_me_data}")
 
         # 2. Optionally try to get ig_id (numeric business ID) without breaking if not available
@@ -319,6 +325,7 @@ def instagram_callback(request):
             ig_id_resp = requests.get(ig_me_url, params=ig_id_params).json()
             if "ig_id" in ig_id_resp:
                 final_ig_id = str(ig_id_resp["ig_id"])
+                ig_aliases.append(final_ig_id)
                 print(f"✨ [Instagram Callback] Found ig_id: {final_ig_id}")
             elif "error" in ig_id_resp:
                 print(f"ℹ️ [Instagram Callback] ig_id field not supported for this account: {ig_id_resp['error'].get('message')}")
@@ -358,6 +365,7 @@ def instagram_callback(request):
         }
     )
     print(f"✅ [Instagram] Profile {'created' if created else 'updated'}: {profile_name} ({final_ig_id})")
+    index_profile(profile, *ig_aliases)
     send_alert(user, "Your instagram page is now connected.")
 
     # 🔗 CRITICAL STEP: Subscribe the account to receive webhook messages
@@ -695,21 +703,50 @@ class CommonAskedLeaderboard(APIView):
         return Response(data)
 
 
+class ChatRoomListView(APIView):
+    permission_classes = [IsAuthenticated, IsEmployeeAndCanAccessCustomerSupport]
+    def get(self, request):
+        """Inbox page: ?platform=&profile_id=&limit=&cursor= (next_cursor from the previous page)."""
+        target_user = get_company_user(request.user)
+        profiles = ChatProfile.objects.filter(user=target_user)
+        if request.query_params.get("platform"):
+            profiles = profiles.filter(platform=request.query_params.get("platform"))
+        if request.query_params.get("profile_id"):
+            profiles = profiles.filter(profile_id=request.query_params.get("profile_id"))
+
+        try:
+            rooms, next_cursor = paginate_rooms(
+                profiles, request.query_params.get("cursor"), request.query_params.get("limit")
+            )
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=400)
+        return Response({"results": [serialize_room(room) for room in rooms], "next_cursor": next_cursor})
+
+
 class GetOldMessage(APIView):
     permission_classes = [IsAuthenticated, IsEmployeeAndCanAccessCustomerSupport]
     def get(self, request,room_id,platform):
+        """
+        Latest messages, oldest first, as a list. With ?paginate=1 the answer is
+        {results, next_cursor}; ?cursor=next_cursor loads the page before.
+        """
         target_user = get_company_user(request.user)
-        if not ChatRoom.objects.filter(id=room_id,profile__user=target_user,profile__platform=platform).exists():
+        room = ChatRoom.objects.filter(id=room_id,profile__user=target_user,profile__platform=platform).first()
+        if not room:
             return Response({"error": "Room not found"}, status=404)
-            
 
         try:
-            room = ChatRoom.objects.get(id=room_id,profile__platform=platform)
-            messages = ChatMessage.objects.filter(room=room).order_by('-timestamp')[:50]
-            serializer = ChatMessageSerializer(messages[::-1], many=True)
+            messages, next_cursor = paginate_messages(
+                ChatMessage.objects.filter(room=room),
+                request.query_params.get("cursor"),
+                request.query_params.get("limit")
+            )
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=400)
+        serializer = ChatMessageSerializer(messages, many=True)
+        if not wants_page(request.query_params):
             return Response(serializer.data)
-        except ChatRoom.DoesNotExist:
-            return Response({"error": "Room not found"}, status=404)
+        return Response({"results": serializer.data, "next_cursor": next_cursor})
 
       
 class GetTestChatOldMessage(APIView):
@@ -724,11 +761,19 @@ class GetTestChatOldMessage(APIView):
         except Exception:
             return Response({"error": "Company not found"}, status=404)
 
-        messages = TestChat.objects.filter(company=company).order_by('-timestamp')[:50]
-        # Reverse to show oldest first in the list if that is desired, or keep as is.
-        # Use [::-1] as in GetOldMessage to likely match frontend expectation (chronological order)
-        serializer = TestChatSerializer(messages[::-1], many=True)
-        return Response(serializer.data)
+        try:
+            messages, next_cursor = paginate_messages(
+                TestChat.objects.filter(company=company),
+                request.query_params.get("cursor"),
+                request.query_params.get("limit")
+            )
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=400)
+        serializer = TestChatSerializer(messages, many=True)
+        # Same opt-in page shape as GetOldMessage
+        if not wants_page(request.query_params):
+            return Response(serializer.data)
+        return Response({"results": serializer.data, "next_cursor": next_cursor})
 
 
 class SubscribeFacebookPageToWebhook(APIView):
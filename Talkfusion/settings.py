@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 from datetime import timedelta
 from celery.schedules import crontab
+from kombu import Queue
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -226,6 +227,55 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 ** 4
 CELERY_BROKER_URL = 'redis://redis:6379/0'  
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
+# Workload classes get their own queue and worker pool (see docker-compose.yml):
+#   realtime    - customer replies and webhook processing, IO-bound, threads pool
+#   ingestion   - knowledge sync / embedding, prefork
+#   analysis    - LLM-heavy company analysis, prefork
+#   reminders   - booking reminders (ETA tasks)
+#   maintenance - periodic cleanup and reconciliation
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default'),
+    Queue('realtime'),
+    Queue('ingestion'),
+    Queue('analysis'),
+    Queue('reminders'),
+    Queue('maintenance'),
+)
+# Priority 0 is served first by the Redis transport
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+CELERY_TASK_ROUTES = {
+    'Others.task.wait_and_reply': {'queue': 'realtime', 'priority': 0},
+    'Socials.tasks.process_inbound_events': {'queue': 'realtime', 'priority': 0},
+    'Socials.tasks.requeue_stalled_inbound_events': {'queue': 'realtime', 'priority': 3},
+    'Socials.tasks.refresh_sender_name_task': {'queue': 'realtime', 'priority': 7},
+    'Socials.tasks.deliver_outbound_message_task': {'queue': 'realtime', 'priority': 1},
+    'Socials.tasks.requeue_stalled_outbound_messages': {'queue': 'realtime', 'priority': 3},
+    'Ai.tasks.sync_company_knowledge_task': {'queue': 'ingestion'},
+    'Ai.tasks.analyze_company_data_task': {'queue': 'analysis', 'priority': 3},
+    'Ai.tasks.refresh_company_analysis_task': {'queue': 'analysis', 'priority': 7},
+    'Others.task.send_booking_reminder': {'queue': 'reminders'},
+    'Others.task.cleanup_system': {'queue': 'maintenance'},
+    'Finance.task.check_subscription_renewals': {'queue': 'maintenance'},
+    'Accounts.tasks.cleanup_inactive_sessions': {'queue': 'maintenance'},
+    'Finance.tasks.flush_quota_counters': {'queue': 'maintenance', 'priority': 0},
+    'Socials.tasks.reconcile_profile_routes_task': {'queue': 'maintenance'},
+}
+# Rate limits apply per worker process, so they scale with the number of workers on a queue
+CELERY_TASK_ANNOTATIONS = {
+    'Ai.tasks.sync_company_knowledge_task': {'rate_limit': os.getenv('INGESTION_RATE_LIMIT', '30/m')},
+    'Ai.tasks.analyze_company_data_task': {'rate_limit': os.getenv('ANALYSIS_RATE_LIMIT', '10/m')},
+    'Ai.tasks.refresh_company_analysis_task': {'rate_limit': os.getenv('ANALYSIS_RATE_LIMIT', '10/m')},
+    'Socials.tasks.refresh_sender_name_task': {'rate_limit': os.getenv('SENDER_NAME_RATE_LIMIT', '120/m')},
+}
+# Long tasks should not hold a prefetched backlog that other processes could serve
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
 CELERY_BEAT_SCHEDULE = {
     'cleanup-system-daily': {
         'task': 'Others.task.cleanup_system',
@@ -235,6 +285,22 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'Finance.task.check_subscription_renewals',
         'schedule': crontab(hour=0, minute=0),
     },
+    'requeue-stalled-inbound-events': {
+        'task': 'Socials.tasks.requeue_stalled_inbound_events',
+        'schedule': crontab(minute='*'),
+    },
+    'requeue-stalled-outbound-messages': {
+        'task': 'Socials.tasks.requeue_stalled_outbound_messages',
+        'schedule': crontab(minute='*'),
+    },
+    'flush-quota-counters': {
+        'task': 'Finance.tasks.flush_quota_counters',
+        'schedule': crontab(minute='*'),
+    },
+    'reconcile-profile-routes': {
+        'task': 'Socials.tasks.reconcile_profile_routes_task',
+        'schedule': crontab(minute='*/30'),
+    },
 }
 
 
@@ -279,3 +345,43 @@ STORAGES = {
 }
 
 MEDIA_URL = f'https://{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/'
+
+# Qdrant (vector store) configuration
+QDRANT_URL = os.getenv("QDRANT_URL", "https://deed639e-bc0e-43fe-8dc2-2edaed834f41.europe-west3-0.gcp.cloud.qdrant.io:6333")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "company_knowledge")
+QDRANT_DEDICATED_COLLECTION_PREFIX = os.getenv("QDRANT_DEDICATED_COLLECTION_PREFIX", "company_knowledge_")
+QDRANT_SCALAR_QUANTIZATION = os.getenv("QDRANT_SCALAR_QUANTIZATION", "True") == "True"
+QDRANT_ON_DISK_VECTORS = os.getenv("QDRANT_ON_DISK_VECTORS", "True") == "True"
+
+# Embedding providers: "openai" (text-embedding-3-small) or "local" (in-process ONNX model via fastembed)
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "64"))
+
+# Company data analysis (Ai.data_analysis): LLM extraction fan-out
+ANALYSIS_EXTRACTION_CONCURRENCY = int(os.getenv("ANALYSIS_EXTRACTION_CONCURRENCY", "8"))
+ANALYSIS_EXTRACTION_TIMEOUT = int(os.getenv("ANALYSIS_EXTRACTION_TIMEOUT", "30"))  # seconds per call
+ANALYSIS_EXTRACTION_RETRIES = int(os.getenv("ANALYSIS_EXTRACTION_RETRIES", "2"))
+# Small sources are packed into one extraction request up to this many content tokens
+PACKED_EXTRACTION_TOKEN_BUDGET = int(os.getenv("PACKED_EXTRACTION_TOKEN_BUDGET", "3000"))
+PACKED_SOURCE_MAX_TOKENS = int(os.getenv("PACKED_SOURCE_MAX_TOKENS", "800"))
+
+# Incoming messages of a room are batched into one AI reply after this many quiet seconds
+REPLY_DEBOUNCE_SECONDS = int(os.getenv("REPLY_DEBOUNCE_SECONDS", "5"))
+
+# Outbound delivery (Socials.outbound): keep-alive pool per platform and per-request timeouts
+OUTBOUND_POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", "50"))
+OUTBOUND_CONNECT_TIMEOUT = float(os.getenv("OUTBOUND_CONNECT_TIMEOUT", "5"))
+OUTBOUND_READ_TIMEOUT = float(os.getenv("OUTBOUND_READ_TIMEOUT", "20"))
+# Read timeouts and 5xx answers leave it unknown whether Meta sent the message. By default such
+# rows are parked as 'unknown' for a check; "true" resends them (at-least-once: possible duplicates).
+OUTBOUND_RESEND_UNKNOWN = os.getenv("OUTBOUND_RESEND_UNKNOWN", "false").lower() == "true"
+# Per-profile send rate (messages/second) enforced by a Redis token bucket
+OUTBOUND_RATE_LIMITS = {
+    "whatsapp": float(os.getenv("OUTBOUND_RATE_WHATSAPP", "20")),
+    "facebook": float(os.getenv("OUTBOUND_RATE_FACEBOOK", "10")),
+    "instagram": float(os.getenv("OUTBOUND_RATE_INSTAGRAM", "5")),
+}
+OUTBOUND_BURST_SECONDS = float(os.getenv("OUTBOUND_BURST_SECONDS", "2"))  # bucket size = rate * this
+OUTBOUND_BULK_RESERVE = float(os.getenv("OUTBOUND_BULK_RESERVE", "0.5"))  # share of the bucket bulk sends leave to replies
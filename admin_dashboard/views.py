@@ -25,6 +25,7 @@ from django.core.mail import send_mail
 from .models import AdminActivity, UserPlanRequest
 from Finance.serializers import SubscriptionSerializer, PlanSerializers
 from Finance.helper import create_stripe_checkout_for_subscription
+from Finance.entitlements import invalidate_entitlements
 from Socials.consumers import send_alert
 from rest_framework import status
 
@@ -181,6 +182,7 @@ class EnableChannelsView(APIView):
             profiles = ChatProfile.objects.filter(platform=channel_name)
 
             profiles.update(bot_active=True)
+            invalidate_entitlements(*Company.objects.filter(user__chat_profiles__platform=channel_name).values_list('id', flat=True).distinct())
             return Response({"status": f"All {channel_name} channels enabled for all users."})
 
         return Response({"error": "Channel name not provided."}, status=400)
@@ -227,6 +229,7 @@ class DisableChannelsView(APIView):
                 return Response({"error": f"No channels found for {channel_name}."}, status=404)
             
             profiles.update(bot_active=False)
+            invalidate_entitlements(*Company.objects.filter(user__chat_profiles__platform=channel_name).values_list('id', flat=True).distinct())
             return Response({"status": f"All {channel_name} channels disabled for all users."})
 
         return Response({"error": "Channel name not provided."}, status=400)